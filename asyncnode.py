@@ -0,0 +1,409 @@
+import asyncio
+import threading
+import time
+
+from cluster import CONNECT_RETRY, join_message
+from failuredetector import reconnect_backoff
+from framing import EOT_CHAR, MAX_FRAME_SIZE, FrameError, encode_frame
+from mutex import RICART_AGRAWALA
+from node import ID_TIMEOUT, Node
+from nodeconnection import ConnectionProtocol
+
+"""
+Asyncio transport for the Node. All the nodes and their connections share one event loop instead of running a
+thread per node and per connection.
+"""
+
+# Bytes that may be buffered by the transport of a connection before the connected node is considered stalled and
+# the connection is closed.
+MAX_WRITE_BUFFER = 1024 * 1024
+
+
+class AsyncNodeConnection(ConnectionProtocol):
+    """The class AsyncNodeConnection is the asyncio counterpart of NodeConnection. It wraps the stream reader and
+       writer of a single peer connection. Received packets are relayed to the main node with receive, exactly
+       like the threaded NodeConnection does, but the receiving is done by a task on the event loop.
+        main_node: The AsyncNode that owns this connection.
+        reader: The asyncio.StreamReader of the connection.
+        writer: The asyncio.StreamWriter of the connection.
+        id: The id of the connected node (at the other side of the TCP/IP connection).
+        host: The host/ip of the connected node.
+        port: The port of the connected node."""
+
+    def __init__(self, main_node, reader, writer, id, host, port):
+        self.init_protocol(main_node, id, host, port)
+        self.reader = reader
+        self.writer = writer
+        self.task = None
+        self.terminated = False
+
+        # End of transmission character for the network streaming messages.
+        self.EOT_CHAR = EOT_CHAR
+
+        # Packets send during the current iteration of the event loop, they are coalesced into one write by flush
+        self.send_queue = []
+
+        # Datastore to store additional information concerning the node.
+        self.info = {}
+
+        self.main_node.debug_print(
+            "AsyncNodeConnection: Started with client (" + self.id + ") '" + self.host + ":" + str(self.port) + "'")
+
+    def start(self):
+        """Start the receiving task of the connection on the running event loop."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def send_packet(self, payload):
+        """Frame the payload and write it to the connected node."""
+        if self.terminated:
+            return
+
+        if len(payload) > MAX_FRAME_SIZE:
+            self.main_node.debug_print("AsyncNodeConnection send: Packet of %d bytes is too large", len(payload))
+            return
+
+        if not self.send_queue:
+            asyncio.get_running_loop().call_soon(self.flush)
+
+        self.send_queue.append(encode_frame(payload, self.framing))
+        self.send_stats["packets"] += 1
+        self.send_stats["max_queue_depth"] = max(self.send_stats["max_queue_depth"], len(self.send_queue))
+
+    def flush(self):
+        """Write all the packets that have been send during this iteration of the event loop with one write. A
+           connected node that lets the transport buffer grow beyond MAX_WRITE_BUFFER is disconnected."""
+        if self.terminated or self.held or not self.send_queue:
+            return
+
+        packets = b''.join(self.send_queue)
+        self.send_queue.clear()
+
+        try:
+            self.writer.write(packets)
+            self.send_stats["writes"] += 1
+            self.send_stats["bytes"] += len(packets)
+
+        except Exception as e:
+            self.main_node.debug_print("AsyncNodeConnection send: Error sending data to node: " + str(e))
+            self.stop()
+            return
+
+        if self.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+            self.send_stats["blocked"] += 1
+            self.main_node.debug_print("AsyncNodeConnection send: Node %s is not reading anymore", self.id)
+            self.stop()
+
+    def get_send_stats(self):
+        """Returns the statistics of the outbound queue, see NodeConnection.get_send_stats. The bytes buffered by the
+           transport are reported as write_buffer."""
+        return dict(self.send_stats, queue_depth=len(self.send_queue),
+                    write_buffer=self.writer.transport.get_write_buffer_size())
+
+    def stop(self):
+        """Terminates the connection. Closing the writer makes the receiving task stop."""
+        if not self.terminated:
+            self.terminated = True
+            self.writer.close()
+
+    async def run(self):
+        """The receiving task of the connection. It waits for complete packets and invokes receive of the main
+           node for every packet. There is no polling, the task is only woken up when data arrives."""
+        while not self.terminated:
+            try:
+                chunk = await self.reader.read(65536)
+
+            except (ConnectionError, asyncio.CancelledError):
+                break
+
+            except Exception as e:
+                self.main_node.debug_print('Unexpected error')
+                self.main_node.debug_print(e)
+                break
+
+            if chunk == b'':
+                break
+
+            if self.held:
+                self.held = False
+                self.flush()
+
+            if self.metrics.enabled:
+                self.metrics.count("bytes_received", len(chunk))
+
+            try:
+                for packet in self.frame_reader.feed(chunk):
+                    if len(packet) > 0:
+                        self.process_packet(packet)
+
+            except FrameError as e:
+                self.main_node.debug_print('AsyncNodeConnection: ' + str(e))
+                break
+
+        self.stop()
+        self.main_node.node_disconnected(self)
+        self.main_node.debug_print("AsyncNodeConnection: Stopped")
+
+
+class AsyncNode(Node):
+    """Node that runs on an asyncio event loop. The mutual exclusion logic (election, node_message) and the
+       callbacks are inherited from Node, only the transport is replaced. The node must be created and started from
+       within a running event loop. Because no thread is started per node or per connection, a single process is
+       able to host hundreds of nodes.
+        host: The host name or ip address that is used to bind the TCP/IP server to.
+        port: The port number that is used to bind the TCP/IP server to.
+        id: (optional) This id will be associated with the node.
+        callback: (optional) The callback that is invokes when events happen inside the network.
+        n: The number of nodes in the network.
+        algorithm: (optional) The mutual exclusion algorithm, see mutex.py."""
+
+    def __init__(self, host, port, id=None, callback=None, n=1, algorithm=RICART_AGRAWALA):
+        super(AsyncNode, self).__init__(host, port, id=id, callback=callback, n=n, algorithm=algorithm)
+        self.task = None
+
+        # Set by wake_scheduler to make the main task re-evaluate the election. Other threads, like the one that stops
+        # the node, set it through the event loop.
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+
+        # Mirrors the mesh_ready barrier so it can be awaited
+        self.mesh_ready_event = asyncio.Event()
+        if self.mesh_ready.is_set():
+            self.mesh_ready_event.set()
+
+    def init_server(self):
+        """The server is started by run on the event loop, nothing is bound here."""
+        print("Initialisation of the Node on port: " + str(self.port) + " on node (" + self.id + ")")
+        self.sock = None
+
+    def start(self):
+        """Start the main task of the node on the running event loop."""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def wait_for_server(self):
+        """Wait until the server of the node is listening for connections."""
+        while self.sock is None:
+            await asyncio.sleep(0)
+
+    async def connect_with_node(self, host, port, reconnect=False):
+        """Asyncio version of Node.connect_with_node. The id's are exchanged the same way as the threaded node does
+           it, so both kinds of nodes could be connected together."""
+        if host == self.host and port == self.port:
+            print("connect_with_node: Cannot connect with yourself!!")
+            return False
+
+        node = self.peers.find_outbound(host, port)
+        if node is not None:
+            print("connect_with_node: Already connected with this node (" + node.id + ").")
+            return True
+
+        try:
+            self.debug_print("connecting to %s port %s", host, port)
+            # A node that hangs must not block us forever
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), ID_TIMEOUT)
+
+            # Basic information exchange (not secure) of the id's of the nodes!
+            writer.write(self.id.encode('utf-8'))
+            connected_node_id = (await asyncio.wait_for(reader.read(4096), ID_TIMEOUT)).decode('utf-8')
+
+            if self.id == connected_node_id:
+                print("connect_with_node: You cannot connect with yourself?!")
+                writer.write("CLOSING: Already having a connection together".encode('utf-8'))
+                writer.close()
+                return True
+
+            node = self.peers.find_by_id(connected_node_id)
+            if node is not None and self.peers.is_inbound(node) and node.host == host:
+                print("connect_with_node: This node (" + node.id + ") is already connected with us.")
+                writer.write("CLOSING: Already having a connection together".encode('utf-8'))
+                writer.close()
+                return True
+
+            connection = self.create_new_connection((reader, writer), connected_node_id, host, port)
+            self.peers.add(connection, inbound=False)
+            connection.start()
+            connection.offer_framing()
+
+            self.outbound_node_connected(connection)
+
+            if reconnect:
+                self.debug_print("connect_with_node: Reconnection check is enabled on node " + host + ":" + str(port))
+                self.reconnect_to_nodes.append({
+                    "host": host, "port": port, "trials": 0
+                })
+
+            return True
+
+        except Exception as e:
+            self.debug_print("AsyncNode.connect_with_node: Could not connect with node. (" + str(e) + ")")
+            return False
+
+    async def connect_with_nodes(self, addresses, reconnect=False):
+        """Asyncio version of Node.connect_with_nodes, the connections are made concurrently."""
+        return list(await asyncio.gather(
+            *[self.connect_with_node(host, port, reconnect) for (host, port) in addresses]))
+
+    async def connect_cluster(self, members, timeout=None):
+        """Asyncio version of Node.connect_cluster."""
+        self.set_cluster(members)
+        ids = [member[0] for member in members]
+        above = [(id, host, port) for (id, host, port) in members[:ids.index(self.id)]]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not self.terminate_flag.is_set():
+            await self.connect_with_nodes([(host, port) for (id, host, port) in above
+                                           if self.peers.find_by_id(id) is None])
+            if await self.wait_for_mesh(CONNECT_RETRY):
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+        return False
+
+    async def join_cluster(self, host, port, timeout=None):
+        """Asyncio version of Node.join_cluster, begin_join is invoked before the node is started."""
+        if not self.joining and self.task is not None:
+            raise RuntimeError("join_cluster: The node has been started before begin_join")
+        self.begin_join()
+        if not await self.connect_with_node(host, port):
+            return False
+
+        self.peers.find_outbound(host, port).send(join_message(self.id, self.host, self.port))
+        return await self.wait_for_mesh(timeout)
+
+    async def leave_cluster(self, timeout=None):
+        """Asyncio version of Node.leave_cluster, the event loop runs the election so it is done right away."""
+        left = threading.Event()
+        self.leave_election(left)
+        return left.is_set()
+
+    def connect_members(self, addresses):
+        """Connect with members that have been announced, in a task on the event loop."""
+        asyncio.get_running_loop().create_task(self.connect_with_nodes(addresses))
+
+    async def wait_for_mesh(self, timeout=None):
+        """Asyncio version of Node.wait_for_mesh."""
+        try:
+            await asyncio.wait_for(self.mesh_ready_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def update_mesh_ready(self):
+        super(AsyncNode, self).update_mesh_ready()
+        if self.mesh_ready.is_set():
+            self.mesh_ready_event.set()
+        else:
+            self.mesh_ready_event.clear()
+
+    def create_new_connection(self, connection, id, host, port):
+        """Create the connection object for a new peer. The connection is the (reader, writer) pair of the stream."""
+        reader, writer = connection
+        return AsyncNodeConnection(self, reader, writer, id, host, port)
+
+    def wake_main_loop(self):
+        """The main task is the scheduler, see run."""
+        self.wake_scheduler()
+
+    async def reconnect_nodes(self):
+        """Asyncio version of Node.reconnect_nodes."""
+        now = time.monotonic()
+        for node_to_check in list(self.reconnect_to_nodes):
+            if self.peers.find_outbound(node_to_check["host"], node_to_check["port"]) is not None:
+                node_to_check["trials"] = 0
+                node_to_check["next_trial"] = 0.0
+
+            elif now < node_to_check.get("next_trial", 0.0):
+                pass
+
+            else:
+                node_to_check["trials"] += 1
+                if self.node_reconnection_error(node_to_check["host"], node_to_check["port"], node_to_check["trials"]):
+                    await self.connect_with_node(node_to_check["host"], node_to_check["port"])
+                    if self.peers.find_outbound(node_to_check["host"], node_to_check["port"]) is None:
+                        node_to_check["next_trial"] = now + reconnect_backoff(node_to_check["trials"], self.random)
+
+                else:
+                    self.reconnect_to_nodes.remove(node_to_check)
+
+    async def handle_inbound(self, reader, writer):
+        """Invoked by the asyncio server for every node that connects with us. First we receive the id of the
+           connected node and secondly we send our node id to the connected node. A node that does not send its id
+           within ID_TIMEOUT seconds is disconnected, see Node.accept_connection."""
+        try:
+            # Basic information exchange (not secure) of the id's of the nodes!
+            connected_node_id = (await asyncio.wait_for(reader.read(4096), ID_TIMEOUT)).decode('utf-8')
+            if connected_node_id == "":
+                raise ConnectionError("closed before sending its id")
+            writer.write(self.id.encode('utf-8'))
+
+        except Exception as e:
+            self.debug_print("AsyncNode handle_inbound: Could not exchange the id's (" + str(e) + ")")
+            writer.close()
+            return
+
+        client_address = writer.get_extra_info('peername')
+
+        connection = self.create_new_connection((reader, writer), connected_node_id, client_address[0],
+                                                client_address[1])
+        connection.hold_until_received()
+        self.peers.add(connection, inbound=True)
+        connection.start()
+
+        self.inbound_node_connected(connection)
+
+    def wake_scheduler(self):
+        """Wake up the main task so that it re-evaluates the election immediately. May be invoked from any thread,
+           asyncio.Event is not thread-safe."""
+        try:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            pass  # The event loop has been closed, the node has stopped
+
+    def post(self, handler, *args):
+        """The event loop is the single owner of the election state, the handler runs at once."""
+        handler(*args)
+
+    async def run(self):
+        """The main task of the node. The server accepts the connections in the background, the task itself only
+           drives the failure detector, the reconnections and the election. It sleeps until the next timed transition
+           of the election or until it is woken up, the peers are checked at least every loop_timeout seconds."""
+        server = await asyncio.start_server(self.handle_inbound, self.host, self.port, reuse_address=True)
+        self.sock = server
+
+        while not self.terminate_flag.is_set():
+            self.check_peers()
+            await self.reconnect_nodes()
+            timeout = self.scheduler_timeout()
+            loop_timeout = self.loop_timeout()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), loop_timeout if timeout is None else min(timeout,
+                                                                                                     loop_timeout))
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+        self.fail_waiters()
+        await self.close()
+
+    async def close(self):
+        print("Node stopping...")
+        nodes = self.all_nodes
+        for t in nodes:
+            t.stop()
+
+        tasks = [t.task for t in nodes if t.task is not None]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.sock.close()
+        await self.sock.wait_closed()
+        if self.wal is not None:
+            self.wal.close()
+        print("Node stopped")
+
+    async def join(self):
+        """Wait until the node has been stopped and closed."""
+        if self.task is not None:
+            await self.task
+
+    def __repr__(self):
+        return '<AsyncNode {}:{} id: {}>'.format(self.host, self.port, self.id)
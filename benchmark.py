@@ -0,0 +1,1034 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from codec import JsonCodec, StructCodec
+from failuredetector import HEARTBEAT_INTERVAL, RECONNECT_BACKOFF
+from mutex import ALGORITHMS, EXCLUSIVE, RICART_AGRAWALA, SHARED
+from node import Node, connect_mesh
+from selectornode import SelectorNode
+from topology import MESH, TOPOLOGIES
+from tracing import TraceRecorder
+from wal import SYNC_BATCH, SYNC_POLICIES
+
+"""
+Benchmarks of the mutual exclusion running on localhost.
+"""
+
+# Seconds a restarted node may take to connect with the others and let them enter again, besides its downtime and
+# the backoff of the reconnections (see recovery)
+RECOVERY_SLACK = 1.0
+
+
+class StateRecorder:
+    """Callback of the nodes that records every state transition with a high resolution timestamp. The transitions
+       are recorded by the scheduler thread of the node, before the release is send and after the grant has been
+       received, so the order of the recorded events follows the order of the critical sections. This is used to
+       check that no two nodes are HELD at the same time, unless all of them hold it SHARED.
+        entries: Set the finished event once this many critical section entries have been recorded.
+        clock: The clock of the timestamps, the virtual clock in a simulation.
+        nodes: (optional) Only count the entries once this many nodes have requested the critical section, a node
+               only requests once it is connected with the others. Before that one node may enter over and over
+               without any contention."""
+
+    def __init__(self, entries=None, clock=time.perf_counter, nodes=None):
+        self.events = []
+        self.lock = threading.Lock()
+        self.clock = clock
+
+        # The nodes that have requested, whether the entries are counted and the time they are counted from
+        self.nodes = nodes
+        self.requested = set()
+        self.counting = nodes is None
+        self.started = None
+
+        self.holders = {}
+        self.violations = 0
+        self.entries = 0
+        self.shared_entries = 0
+        self.max_holders = 0
+        self.target = entries
+        self.finished = threading.Event()
+
+    def __call__(self, event, main_node, connected_node, data):
+        if event == "node_state_changed":
+            with self.lock:
+                state = data["state"]
+                now = self.clock()
+                self.events.append((now, main_node.id, state))
+                if state == "WANTED" and not self.counting:
+                    self.requested.add(main_node.id)
+                    if len(self.requested) >= self.nodes:
+                        self.counting = True
+                        self.started = now
+                elif state == "HELD":
+                    mode = data.get("mode", EXCLUSIVE)
+                    if conflicts(self.holders.values(), mode):
+                        self.violations += 1
+                    self.holders[main_node.id] = mode
+                    self.max_holders = max(self.max_holders, len(self.holders))
+                    if not self.counting:
+                        return
+                    self.entries += 1
+                    if mode == SHARED:
+                        self.shared_entries += 1
+                    if self.target is not None and self.entries >= self.target:
+                        self.finished.set()
+                else:
+                    self.holders.pop(main_node.id, None)
+
+    def sorted_events(self):
+        """The events in time order, events with the same timestamp stay in the order they were recorded."""
+        with self.lock:
+            return sorted(self.events, key=lambda event: event[0])
+
+    def grant_latencies(self):
+        """Time between a node requesting the critical section and entering it."""
+        return [wait for (node_id, wait, overtaken) in self.waits()]
+
+    def waits(self):
+        """The granted requests as (node id, time between the request and the grant, number of entries of other
+           nodes in between). The entries that overtook a request measure how far it was starved."""
+        waits = []
+        requested_at = {}
+        granted = 0
+        for (t, node_id, state) in self.sorted_events():
+            if state == "WANTED":
+                requested_at[node_id] = (t, granted)
+            elif state == "HELD":
+                if node_id in requested_at:
+                    (requested, granted_before) = requested_at.pop(node_id)
+                    waits.append((node_id, t - requested, granted - granted_before))
+                granted += 1
+        return waits
+
+    def handoff_latencies(self):
+        """Time between a node releasing the critical section and the next node entering it."""
+        latencies = []
+        released_at = None
+        for (t, node_id, state) in self.sorted_events():
+            if state == "DO-NOT-WANT":
+                released_at = t
+            elif state == "HELD" and released_at is not None:
+                latencies.append(t - released_at)
+                released_at = None
+        return latencies
+
+
+def conflicts(modes, mode):
+    """Whether a node may not hold the critical section in the mode while it is held in the modes."""
+    return any(held == EXCLUSIVE or mode == EXCLUSIVE for held in modes)
+
+
+class LockRecorder:
+    """Callback of the nodes that records the critical sections of the named resources of the lock tables (see
+       locktable.py): the entries per resource and the times two nodes held the same resource at once.
+        entries: Set the finished event once this many entries have been recorded, over all the resources."""
+
+    def __init__(self, entries=None):
+        self.lock = threading.Lock()
+        self.holders = collections.defaultdict(dict)
+        self.resource_entries = collections.Counter()
+        self.violations = 0
+        self.entries = 0
+        self.target = entries
+        self.finished = threading.Event()
+        self.started = None
+        self.ended = None
+
+    def __call__(self, event, main_node, connected_node, data):
+        if event == "resource_state_changed":
+            with self.lock:
+                (resource, state) = (data["resource"], data["state"])
+                if state == "WANTED" and self.started is None:
+                    self.started = time.perf_counter()
+                elif state == "HELD":
+                    mode = data.get("mode", EXCLUSIVE)
+                    if conflicts(self.holders[resource].values(), mode):
+                        self.violations += 1
+                    self.holders[resource][main_node.id] = mode
+                    self.resource_entries[resource] += 1
+                    self.entries += 1
+                    if self.target is not None and self.entries == self.target:
+                        self.ended = time.perf_counter()
+                        self.finished.set()
+                elif state == "DO-NOT-WANT":
+                    self.holders[resource].pop(main_node.id, None)
+
+
+class CountingNode(Node):
+    """Node that counts the messages of the mutual exclusion it receives, per message type. Every message that is
+       send to another node is received exactly once, so this is also the number of messages send. A message that
+       is routed through the neighbours (see topology.py) counts as ROUTE at every node that forwards it and by its
+       own type where it arrives."""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingNode, self).__init__(*args, **kwargs)
+        self.received = collections.Counter()
+
+    def node_message(self, node, data):
+        if isinstance(data, dict):
+            self.received[data.get("message")] += 1
+        super(CountingNode, self).node_message(node, data)
+
+    def forward(self, node, data):
+        if data["to"] != self.id:
+            self.received["ROUTE"] += 1
+        super(CountingNode, self).forward(node, data)
+
+
+class SelectorCountingNode(CountingNode, SelectorNode):
+    """CountingNode whose connections are served by one selector thread, see selectornode.py."""
+    pass
+
+
+# The node classes of the transports, the connections get a thread each or are served by one selector thread
+TRANSPORTS = {"threads": CountingNode, "selectors": SelectorCountingNode}
+
+
+class SuspicionRecorder(StateRecorder):
+    """StateRecorder that also records when a node suspects another node, see Node.suspect_node."""
+
+    def __init__(self, entries=None, clock=time.perf_counter):
+        super(SuspicionRecorder, self).__init__(entries, clock)
+        self.suspicions = []
+
+    def __call__(self, event, main_node, connected_node, data):
+        if event == "node_suspected":
+            with self.lock:
+                self.suspicions.append((self.clock(), main_node.id, connected_node.id, data["silence"]))
+        else:
+            super(SuspicionRecorder, self).__call__(event, main_node, connected_node, data)
+
+
+class StallingNode(CountingNode):
+    """Node that hangs in the critical section on its stall_entry-th entry. It keeps its sockets open, but it does
+       not send, receive or change its state anymore, heartbeats included, like a process that is stuck. The stall
+       is reported to the callback as the state FAILED, the node is not HELD anymore from then on."""
+
+    def __init__(self, *args, **kwargs):
+        super(StallingNode, self).__init__(*args, **kwargs)
+        self.stall_entry = None
+        self.held_count = 0
+        self.stalled = False
+
+    def enter_critical_section(self):
+        super(StallingNode, self).enter_critical_section()
+        self.held_count += 1
+        if self.held_count == self.stall_entry:
+            self.stalled = True
+            if self.callback is not None:
+                self.callback("node_state_changed", self, {}, {"state": "FAILED"})
+
+    def election(self):
+        if not self.stalled:
+            super(StallingNode, self).election()
+
+    def check_peers(self):
+        if not self.stalled:
+            super(StallingNode, self).check_peers()
+
+    def send_to_node(self, n, data):
+        if not self.stalled:
+            super(StallingNode, self).send_to_node(n, data)
+
+    def node_message(self, node, data):
+        if not self.stalled:
+            super(StallingNode, self).node_message(node, data)
+
+
+class CrashingNode(CountingNode):
+    """Node that crashes when it would leave the critical section on its crash_entry-th entry, with the requests it
+       deferred in the critical section still unanswered. It stops without releasing, like a process that is
+       killed, its write-ahead log is all that is left of it. The crash is reported to the callback as the state
+       FAILED and the crashed event is set."""
+
+    def __init__(self, *args, **kwargs):
+        super(CrashingNode, self).__init__(*args, **kwargs)
+        self.crash_entry = None
+        self.held_count = 0
+        self.crashed = threading.Event()
+
+    def enter_critical_section(self):
+        super(CrashingNode, self).enter_critical_section()
+        self.held_count += 1
+
+    def election(self):
+        if self.crashed.is_set():
+            return
+        if self.state == "HELD" and self.held_count == self.crash_entry and self.next_execution <= self.now():
+            self.crashed.set()
+            if self.callback is not None:
+                self.callback("node_state_changed", self, {}, {"state": "FAILED"})
+            self.stop()
+            return
+        super(CrashingNode, self).election()
+
+    def send_to_node(self, n, data):
+        if not self.crashed.is_set():
+            super(CrashingNode, self).send_to_node(n, data)
+
+
+def start_nodes(n, port, callback, time_cs, time_p, algorithm=RICART_AGRAWALA, node_class=Node, wal=None,
+                sync=SYNC_BATCH, heartbeat=None, load_generator=True, topology=None, degree=None, connect=True,
+                tracer=None, reconnect=False):
+    """Start n nodes on localhost and connect them to a full mesh, or to the given topology (see topology.py). With
+       wal set every node logs its state to a new write-ahead log in that directory, with heartbeat set the failure
+       detector sends a heartbeat every heartbeat seconds. Without the load generator the critical sections are only
+       taken with acquire. Without connect the nodes are left unconnected, see connect_mesh. With tracer set the
+       nodes record their messages to it (see tracing.py). With reconnect the nodes connect again to a node that
+       has been restarted."""
+    host = "127.0.0.1"
+    nodes = []
+    for i in range(n):
+        node = node_class(host, port + i, id=f"P{i + 1}", callback=callback, n=n, algorithm=algorithm)
+        node.time_cs_min = node.time_cs = time_cs
+        node.time_p_min = node.time_p = time_p
+        node.load_generator = load_generator
+        if topology is not None:
+            node.set_topology(topology, degree)
+        if wal is not None:
+            path = os.path.join(wal, f"P{i + 1}.wal")
+            if os.path.exists(path):
+                os.remove(path)
+            node.open_wal(path, sync)
+        if heartbeat is not None:
+            node.enable_failure_detector(heartbeat)
+        node.enable_trace(tracer)
+        node.start()
+        nodes.append(node)
+
+    if connect:
+        connect_mesh(nodes, host, timeout=60, reconnect=reconnect)
+    return nodes
+
+
+def stop_nodes(nodes):
+    for node in nodes:
+        node.stop()
+    for node in nodes:
+        node.join()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def jain_index(values):
+    """Jain's fairness index of the values, 1.0 when they are all equal and 1 / len(values) when one value has
+       everything."""
+    squares = sum(value * value for value in values)
+    return sum(values) ** 2 / (len(values) * squares) if squares else None
+
+
+def set_priorities(nodes, urgent, priority, read_ratio=0.0):
+    """Give the first urgent nodes the priority and let the load generators read for read_ratio of their requests,
+       returns the priority of every node by id."""
+    for node in nodes:
+        node.read_ratio = read_ratio
+    for node in nodes[:urgent]:
+        node.priority = priority
+    return {node.id: node.priority for node in nodes}
+
+
+def handoff(n, duration, port, time_cs, time_p, algorithm=RICART_AGRAWALA):
+    """Measure the critical section handoff latency under full contention."""
+    recorder = StateRecorder()
+    nodes = start_nodes(n, port, recorder, time_cs, time_p, algorithm)
+    time.sleep(duration)
+    stop_nodes(nodes)
+
+    latencies = recorder.handoff_latencies()
+    if not latencies:
+        print("No critical section handoffs recorded")
+        return
+
+    print("Handoffs: %d" % len(latencies))
+    print("Handoff latency ms: mean %.3f, p50 %.3f, p99 %.3f, max %.3f" % (
+        statistics.mean(latencies) * 1000, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies) * 1000))
+
+
+def git_revision():
+    """Returns the commit the benchmark runs on, or None when it is not run from a git checkout."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def throughput(n, entries, port, time_cs, time_p, algorithm=RICART_AGRAWALA, timeout=60.0, wal=None,
+               sync=SYNC_BATCH, topology=None, degree=None, transport="threads", trace=None, urgent=0, priority=1,
+               read_ratio=0.0):
+    """Run the nodes until the given number of critical section entries have been made and return the results:
+       throughput, request to grant latency, messages per entry and the number of times two nodes were HELD at
+       the same time. With wal set the nodes log to a write-ahead log in that directory and the results include
+       the time spend logging. With topology set the nodes only connect with their neighbours. The transport is
+       one of TRANSPORTS. With trace set the messages are recorded to that trace file (see tracing.py). The first
+       urgent nodes request with the priority, the results include the latency of every priority. The read_ratio of
+       the requests are SHARED, the readers hold the critical section together. The entries are counted once every
+       node has requested the critical section."""
+    recorder = StateRecorder(entries, nodes=n)
+    tracer = TraceRecorder(trace) if trace is not None else None
+    nodes = start_nodes(n, port, recorder, time_cs, time_p, algorithm, node_class=TRANSPORTS[transport], wal=wal,
+                        sync=sync, topology=topology, degree=degree, tracer=tracer)
+    priorities = set_priorities(nodes, urgent, priority, read_ratio)
+    completed = recorder.finished.wait(timeout)
+    connections = sum(len(node.all_nodes) for node in nodes) // 2
+    threads = threading.active_count()
+    stop_nodes(nodes)
+    if tracer is not None:
+        tracer.close()
+
+    messages = collections.Counter()
+    for node in nodes:
+        messages.update(node.received)
+
+    results = {
+        "revision": git_revision(),
+        "algorithm": algorithm,
+        "nodes": n,
+        "topology": topology or MESH,
+        "connections": connections,
+        "transport": transport,
+        "threads": threads,
+        "time_cs": time_cs,
+        "time_p": time_p,
+        "read_ratio": read_ratio,
+        "completed": completed
+    }
+    results.update(summarize(recorder, entries, messages, priorities))
+    if wal is not None:
+        results["wal"] = wal_stats(nodes, sync, results["entries"])
+    if tracer is not None:
+        results["trace"] = tracer.get_stats()
+    return results
+
+
+def resident_memory():
+    """Returns the resident set size of this process in bytes, or None when /proc is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def connection_overhead(n, port, transport="threads", topology=None, degree=None):
+    """Connect n idle nodes and return the threads and the memory the connections take. Every connection has two
+       ends, one at each node, the memory is measured with tracemalloc (the Python objects and buffers) and as the
+       growth of the resident set size (which includes the stacks of the threads) and reported per end."""
+    tracemalloc.start()
+    nodes = start_nodes(n, port, None, 0.0, 0.0, node_class=TRANSPORTS[transport], load_generator=False,
+                        topology=topology, degree=degree, connect=False)
+    time.sleep(0.5)
+    (threads, traced, resident) = (threading.active_count(), tracemalloc.get_traced_memory()[0], resident_memory())
+
+    started = time.perf_counter()
+    connected = connect_mesh(nodes, "127.0.0.1", timeout=60)
+    connect_time = time.perf_counter() - started
+    time.sleep(0.5)
+    ends = sum(len(node.all_nodes) for node in nodes)
+    results = {
+        "revision": git_revision(),
+        "nodes": n,
+        "topology": topology or MESH,
+        "transport": transport,
+        "connected": connected,
+        "connections": ends // 2,
+        "connect_time": connect_time,
+        "threads": threading.active_count(),
+        "threads_per_connection": (threading.active_count() - threads) / max(ends, 1),
+        "traced_bytes_per_connection": (tracemalloc.get_traced_memory()[0] - traced) / max(ends, 1),
+        "resident_bytes_per_connection": None if resident is None else (resident_memory() - resident) / max(ends, 1)
+    }
+    tracemalloc.stop()
+    stop_nodes(nodes)
+    return results
+
+
+def wal_stats(nodes, sync, entries):
+    """Returns the write-ahead log statistics of all the nodes together, and the logging time per entry."""
+    stats = collections.Counter()
+    for node in nodes:
+        stats.update(node.wal.get_stats())
+
+    results = {"sync": sync}
+    results.update(stats)
+    results["ms_per_entry"] = stats["seconds"] * 1000 / entries if entries else None
+    return results
+
+
+def failover(n, entries, port, time_cs, time_p, heartbeat, stall_entry, algorithm=RICART_AGRAWALA, timeout=60.0):
+    """Run the nodes with the failure detector until the given number of critical section entries have been made,
+       while the last node hangs in its stall_entry-th critical section. Returns the results of throughput plus
+       how long it took the other nodes to suspect the stalled node (detection latency) and how long no node could
+       enter the critical section because of it."""
+    recorder = SuspicionRecorder(entries)
+    nodes = start_nodes(n, port, recorder, time_cs, time_p, algorithm, node_class=StallingNode, heartbeat=heartbeat)
+    stalled = nodes[-1]
+    stalled.stall_entry = stall_entry
+    completed = recorder.finished.wait(timeout)
+    stop_nodes(nodes)
+
+    messages = collections.Counter()
+    for node in nodes:
+        messages.update(node.received)
+
+    events = recorder.sorted_events()
+    stalled_at = next((t for (t, node_id, state) in events if state == "FAILED"), None)
+    detections = {}
+    for (t, node_id, suspected_id, silence) in recorder.suspicions:
+        if suspected_id == stalled.id and stalled_at is not None and t >= stalled_at and node_id not in detections:
+            detections[node_id] = t - stalled_at
+    resumed_at = next((t for (t, node_id, state) in events if state == "HELD" and stalled_at is not None and
+                       t > stalled_at), None)
+
+    results = {
+        "revision": git_revision(),
+        "algorithm": algorithm,
+        "nodes": n,
+        "time_cs": time_cs,
+        "time_p": time_p,
+        "heartbeat": heartbeat,
+        "completed": completed,
+        "stalled": stalled_at is not None,
+        "detection_latency_ms": {
+            "min": min(detections.values()) * 1000 if detections else None,
+            "max": max(detections.values()) * 1000 if detections else None,
+            "detected_by": len(detections)
+        },
+        "suspicions": len(recorder.suspicions),
+        "unavailable_ms": (resumed_at - stalled_at) * 1000 if resumed_at is not None else None
+    }
+    results.update(summarize(recorder, entries, messages))
+    return results
+
+
+def recovery(n, entries, port, time_cs, time_p, crash_entry, downtime=1.0, wal=None, sync=SYNC_BATCH, timeout=60.0):
+    """Run Ricart-Agrawala with write-ahead logs until the given number of critical section entries have been made,
+       while the last node crashes in its crash_entry-th critical section and is restarted from its log after
+       downtime seconds. The other nodes connect to it again and repeat their requests. Returns the results of
+       throughput plus the clock the node crashed with, the clock and the deferred requests it recovered, the
+       entries it made after the restart and how long no node could enter the critical section. A safe recovery has
+       no safety violations, a recovered clock that is not behind the crashed clock (see wal.py) and completes: the
+       requests that waited for the deferred OKs are granted. A fast recovery is unavailable for at most the time
+       the node took to stop, its downtime and the reconnection that follows: the backoff of the others is at most
+       twice the time they have been retrying (see failuredetector.reconnect_backoff)."""
+    with contextlib.ExitStack() as stack:
+        if wal is None:
+            wal = stack.enter_context(tempfile.TemporaryDirectory())
+
+        recorder = StateRecorder(entries)
+        nodes = start_nodes(n, port, recorder, time_cs, time_p, node_class=CrashingNode, wal=wal, sync=sync,
+                            reconnect=True)
+        crashed = nodes[-1]
+        crashed.crash_entry = crash_entry
+        if crashed.crashed.wait(timeout):
+            crashed.join()
+        stopped_at = recorder.clock()
+        crashed_clock = crashed.timestamp
+        time.sleep(downtime)
+
+        # The restarted node runs on the same port with the same id, the others reconnect to it
+        restarted = CountingNode(crashed.host, crashed.port, id=crashed.id, callback=recorder, n=n)
+        restarted.time_cs_min = restarted.time_cs = time_cs
+        restarted.time_p_min = restarted.time_p = time_p
+        recovered = restarted.open_wal(os.path.join(wal, crashed.id + ".wal"), sync)
+        recovered_clock = restarted.timestamp
+        recovered_deferred = len(restarted.recovered_deferred)
+        restarted_at = recorder.clock()
+        restarted.start()
+        nodes[-1] = restarted
+
+        completed = recorder.finished.wait(timeout)
+        stop_nodes(nodes[:-1] + [restarted])
+
+    messages = collections.Counter(crashed.received)
+    for node in nodes:
+        messages.update(node.received)
+
+    events = recorder.sorted_events()
+    crashed_at = next((t for (t, node_id, state) in events if state == "FAILED"), None)
+    resumed_at = next((t for (t, node_id, state) in events if state == "HELD" and crashed_at is not None and
+                       t > crashed_at), None)
+    unavailable = resumed_at - crashed_at if resumed_at is not None else None
+    bound = None
+    if crashed_at is not None:
+        bound = stopped_at - crashed_at + 3 * downtime + RECONNECT_BACKOFF + RECOVERY_SLACK
+    restarted_entries = sum(1 for (t, node_id, state) in events
+                            if node_id == restarted.id and state == "HELD" and t >= restarted_at)
+    results = {
+        "revision": git_revision(),
+        "algorithm": RICART_AGRAWALA,
+        "nodes": n,
+        "time_cs": time_cs,
+        "time_p": time_p,
+        "sync": sync,
+        "downtime": downtime,
+        "completed": completed and restarted_entries > 0,
+        "crashed": crashed.crashed.is_set(),
+        "recovered": recovered,
+        "crashed_clock": crashed_clock,
+        "recovered_clock": recovered_clock,
+        "clock_safe": recovered_clock >= crashed_clock,
+        "recovered_deferred": recovered_deferred,
+        "restarted_entries": restarted_entries,
+        "unavailable_ms": unavailable * 1000 if unavailable is not None else None,
+        "unavailable_bound_ms": bound * 1000 if bound is not None else None,
+        "recovered_in_time": unavailable is not None and unavailable <= bound
+    }
+    results.update(summarize(recorder, entries, messages))
+    return results
+
+
+def stress(n, entries, port, time_cs, time_p, timeout=60.0, read_ratio=0.0):
+    """Run every algorithm with many nodes that request the critical section over and over, the connection threads
+       of all of them deliver messages concurrently. Returns the results of throughput per algorithm, a safe run
+       has no safety violations and completes all the entries. The entries are counted once every node has
+       requested and a run where a node never entered is not completed: a token that stays with one node never
+       meets a concurrent requester. With read_ratio the readers and the writers are mixed, a writer must never
+       hold the critical section together with another node."""
+    results = {}
+    for (i, algorithm) in enumerate(sorted(ALGORITHMS)):
+        result = throughput(n, entries, port + i * n, time_cs, time_p, algorithm, timeout, read_ratio=read_ratio)
+        result["completed"] = result["completed"] and result["nodes_entered"] == n
+        results[algorithm] = result
+    return results
+
+
+def locks(n, resources, entries, port, time_cs, timeout=60.0, algorithm=RICART_AGRAWALA):
+    """Let every node request every named resource of the lock table over and over, holding it for time_cs seconds,
+       until the given number of entries over all the resources have been made. Returns the aggregate throughput,
+       the entries per resource and the number of times two nodes held the same resource at once."""
+    recorder = LockRecorder(entries)
+    nodes = start_nodes(n, port, recorder, time_cs, 0.0, algorithm, node_class=CountingNode, load_generator=False)
+    names = ["resource-%d" % i for i in range(resources)]
+
+    def worker(node, name):
+        while not recorder.finished.is_set():
+            if node.acquire(name, 1.0):
+                time.sleep(time_cs)
+                node.release(name)
+
+    workers = [threading.Thread(target=worker, args=(node, name)) for node in nodes for name in names]
+    for thread in workers:
+        thread.start()
+    completed = recorder.finished.wait(timeout)
+    recorder.finished.set()
+    for thread in workers:
+        thread.join()
+    stop_nodes(nodes)
+
+    messages = collections.Counter()
+    for node in nodes:
+        messages.update(node.received)
+
+    with recorder.lock:
+        elapsed = recorder.ended - recorder.started if completed else None
+        return {
+            "revision": git_revision(),
+            "algorithm": algorithm,
+            "nodes": n,
+            "resources": resources,
+            "time_cs": time_cs,
+            "completed": completed,
+            "entries": recorder.entries,
+            "seconds": elapsed,
+            "entries_per_second": entries / elapsed if elapsed else None,
+            "resource_entries": dict(recorder.resource_entries),
+            "messages_per_entry": sum(messages.values()) / recorder.entries if recorder.entries else None,
+            "safety_violations": recorder.violations
+        }
+
+
+def acquire_latency(n, contenders, entries, port, time_cs, timeout=60.0, algorithm=RICART_AGRAWALA):
+    """Let the first contenders nodes take the critical section of the node with acquire over and over, holding it
+       for time_cs seconds, without the load generator. Returns the results of throughput plus the time acquire
+       waited, from the call until the caller was woken up."""
+    recorder = StateRecorder(entries)
+    nodes = start_nodes(n, port, recorder, time_cs, 0.0, algorithm, node_class=CountingNode, load_generator=False)
+    waits = []
+
+    def worker(node):
+        while not recorder.finished.is_set():
+            started = time.perf_counter()
+            if node.acquire(timeout=1.0):
+                waits.append(time.perf_counter() - started)
+                time.sleep(time_cs)
+                node.release()
+
+    workers = [threading.Thread(target=worker, args=(node,)) for node in nodes[:contenders]]
+    for thread in workers:
+        thread.start()
+    completed = recorder.finished.wait(timeout)
+    recorder.finished.set()
+    for thread in workers:
+        thread.join()
+    stop_nodes(nodes)
+
+    messages = collections.Counter()
+    for node in nodes:
+        messages.update(node.received)
+
+    results = {
+        "revision": git_revision(),
+        "algorithm": algorithm,
+        "nodes": n,
+        "contenders": contenders,
+        "time_cs": time_cs,
+        "completed": completed,
+        "acquire_ms": {
+            "mean": statistics.mean(waits) * 1000 if waits else None,
+            "p50": percentile(waits, 50) * 1000 if waits else None,
+            "p99": percentile(waits, 99) * 1000 if waits else None,
+            "max": max(waits) * 1000 if waits else None
+        }
+    }
+    results.update(summarize(recorder, entries, messages))
+    return results
+
+
+def summarize(recorder, entries, messages, priorities=None):
+    """Returns the results of a run from the recorded events: throughput of the first entries, request to grant
+       latency, messages per entry, the safety violations and the most nodes that held the critical section at once
+       (readers, see mutex.SHARED). The fairness is Jain's index of the entries and of the
+       mean latency of every node, the starvation the longest wait and the most entries that overtook a request.
+       With the priority of every node by id the latency of every priority is reported as well. The entries are
+       counted from the time the recorder started counting, nodes_entered is the number of nodes that entered since
+       then."""
+    with recorder.lock:
+        made = recorder.entries
+        violations = recorder.violations
+        (shared_entries, max_holders) = (recorder.shared_entries, recorder.max_holders)
+        (counting, started) = (recorder.counting, recorder.started)
+    events = recorder.sorted_events()
+
+    if started is None:
+        started = next((t for (t, node_id, state) in events if state == "WANTED"), None)
+    held = [(t, node_id) for (t, node_id, state) in events if state == "HELD" and counting and t >= started]
+    counted = [t for (t, node_id) in held[:entries]]
+    first_request = started
+    elapsed = counted[-1] - first_request if counted and first_request is not None else 0.0
+    waits = recorder.waits()
+    latencies = [wait for (node_id, wait, overtaken) in waits]
+    overtaken = [overtaken for (node_id, wait, overtaken) in waits]
+    node_waits = collections.defaultdict(list)
+    for (node_id, wait, count) in waits:
+        node_waits[node_id].append(wait)
+    node_entries = collections.Counter(node_id for (t, node_id) in held)
+
+    def latency(p):
+        return percentile(latencies, p) * 1000 if latencies else None
+
+    results = {
+        "entries": made,
+        "nodes_entered": len(node_entries),
+        "seconds": elapsed,
+        "entries_per_second": len(counted) / elapsed if elapsed > 0 else None,
+        "grant_latency_ms": {
+            "mean": statistics.mean(latencies) * 1000 if latencies else None,
+            "p50": latency(50),
+            "p95": latency(95),
+            "p99": latency(99),
+            "max": max(latencies) * 1000 if latencies else None
+        },
+        "fairness": {
+            "entries_jain": jain_index(list(node_entries.values())) if node_entries else None,
+            "latency_jain": jain_index([statistics.mean(node_wait) for node_wait in node_waits.values()])
+            if node_waits else None
+        },
+        "starvation": {
+            "max_wait_ms": max(latencies) * 1000 if latencies else None,
+            "p99_overtaken": percentile(overtaken, 99) if overtaken else None,
+            "max_overtaken": max(overtaken) if overtaken else None
+        },
+        "messages": dict(messages),
+        "messages_per_entry": sum(messages.values()) / made if made else None,
+        "shared_entries": shared_entries,
+        "max_holders": max_holders,
+        "safety_violations": violations
+    }
+    if priorities is not None and len(set(priorities.values())) > 1:
+        results["priorities"] = {}
+        for level in sorted(set(priorities.values()), reverse=True):
+            level_waits = [wait for (node_id, wait, count) in waits if priorities.get(node_id) == level]
+            results["priorities"][str(level)] = {
+                "nodes": sum(1 for value in priorities.values() if value == level),
+                "entries": len(level_waits),
+                "p50_ms": percentile(level_waits, 50) * 1000 if level_waits else None,
+                "p99_ms": percentile(level_waits, 99) * 1000 if level_waits else None,
+                "max_ms": max(level_waits) * 1000 if level_waits else None
+            }
+    return results
+
+
+def simulate(n, entries, time_cs, time_p, algorithm=RICART_AGRAWALA, seed=0, latency=0.0001, jitter=0.0, loss=0.0,
+             topology=None, degree=None, trace=None, urgent=0, priority=1, read_ratio=0.0):
+    """Run the nodes in the in-memory simulation (see simulator.py) until the given number of critical section
+       entries have been made. The times are virtual, the wall clock time of the run is reported as wall_seconds.
+       With topology set the nodes only connect with their neighbours (see topology.py). With trace set the messages
+       are recorded to that trace file with the virtual times. The first urgent nodes request with the priority, the
+       read_ratio of the requests are SHARED."""
+    from simulator import Simulator
+
+    simulator = Simulator(seed, latency, jitter, loss)
+    recorder = StateRecorder(entries, clock=lambda: simulator.now, nodes=n)
+    tracer = TraceRecorder(trace) if trace is not None else None
+
+    started = time.perf_counter()
+    nodes = simulator.create_nodes(n, recorder, algorithm, topology=topology, degree=degree)
+    for node in nodes:
+        node.time_cs_min = node.time_cs = time_cs
+        node.time_p_min = node.time_p = time_p
+        node.enable_trace(tracer)
+    priorities = set_priorities(nodes, urgent, priority, read_ratio)
+    events = simulator.run(stop=recorder.finished.is_set)
+    wall = time.perf_counter() - started
+    if tracer is not None:
+        tracer.close()
+
+    results = {
+        "revision": git_revision(),
+        "algorithm": algorithm,
+        "nodes": n,
+        "topology": topology or MESH,
+        "connections": simulator.connections,
+        "time_cs": time_cs,
+        "time_p": time_p,
+        "read_ratio": read_ratio,
+        "seed": seed,
+        "latency": latency,
+        "jitter": jitter,
+        "loss": loss,
+        "completed": recorder.finished.is_set(),
+        "events": events,
+        "dropped": simulator.dropped,
+        "wall_seconds": wall
+    }
+    results.update(summarize(recorder, entries, simulator.messages, priorities))
+    if tracer is not None:
+        results["trace"] = tracer.get_stats()
+    return results
+
+
+def codec_throughput(count):
+    """Measure the encode and decode throughput of the codecs for the GIVE and OK messages."""
+    messages = [{"timestamp": 1000000 + i, "message": "GIVE" if i % 2 == 0 else "OK"} for i in range(count)]
+
+    for codec in (JsonCodec(), StructCodec("P1")):
+        start = time.perf_counter()
+        packets = [codec.encode(message) for message in messages]
+        encode_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        decoded = [codec.decode(packet) for packet in packets]
+        decode_time = time.perf_counter() - start
+
+        assert decoded == messages
+        print("%-6s packet %2d bytes, encode %9.0f msg/s, decode %9.0f msg/s" % (
+            codec.name, len(packets[0]), count / encode_time, count / decode_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the mutual exclusion.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_handoff = subparsers.add_parser("handoff", help="critical section handoff latency")
+    parser_handoff.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_handoff.add_argument("--duration", type=float, default=5.0, help="seconds to run")
+    parser_handoff.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_handoff.add_argument("--time-cs", type=float, default=0.001, help="seconds a node holds the critical section")
+    parser_handoff.add_argument("--time-p", type=float, default=0.0, help="seconds between the critical sections")
+    parser_handoff.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+
+    parser_throughput = subparsers.add_parser("throughput", help="critical section throughput and latency, as json")
+    parser_throughput.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_throughput.add_argument("--entries", type=int, default=1000, help="number of critical section entries")
+    parser_throughput.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_throughput.add_argument("--time-cs", type=float, default=0.001,
+                                   help="seconds a node holds the critical section")
+    parser_throughput.add_argument("--time-p", type=float, default=0.0, help="seconds between the critical sections")
+    parser_throughput.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+    parser_throughput.add_argument("--timeout", type=float, default=60.0, help="give up after this many seconds")
+    parser_throughput.add_argument("--output", help="write the results to this file instead of stdout")
+    parser_throughput.add_argument("--wal", help="log the state of the nodes to write-ahead logs in this directory")
+    parser_throughput.add_argument("--topology", choices=TOPOLOGIES,
+                                   help="only connect the nodes with their neighbours")
+    parser_throughput.add_argument("--degree", type=int, help="degree of the topology")
+    parser_throughput.add_argument("--sync", choices=SYNC_POLICIES, default=SYNC_BATCH,
+                                   help="when the write-ahead logs are forced to disk")
+    parser_throughput.add_argument("--transport", choices=sorted(TRANSPORTS), default="threads",
+                                   help="a thread per connection or one selector thread per node")
+    parser_throughput.add_argument("--trace", help="record the messages to this trace file, see tracing.py")
+    parser_throughput.add_argument("--urgent", type=int, default=0, help="number of nodes that request with a priority")
+    parser_throughput.add_argument("--priority", type=int, default=1, help="priority of the urgent nodes")
+    parser_throughput.add_argument("--read-ratio", type=float, default=0.0,
+                                   help="fraction of the requests that only read, they share the critical section")
+
+    parser_connections = subparsers.add_parser("connections", help="threads and memory per connection of idle nodes")
+    parser_connections.add_argument("-n", type=int, default=50, help="number of nodes")
+    parser_connections.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_connections.add_argument("--transport", choices=sorted(TRANSPORTS), nargs="+",
+                                    default=sorted(TRANSPORTS), help="transports to measure, one after the other")
+    parser_connections.add_argument("--topology", choices=TOPOLOGIES,
+                                    help="only connect the nodes with their neighbours")
+    parser_connections.add_argument("--degree", type=int, help="degree of the topology")
+    parser_connections.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_failover = subparsers.add_parser("failover", help="detection latency and availability with a stalled node")
+    parser_failover.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_failover.add_argument("--entries", type=int, default=1000, help="number of critical section entries")
+    parser_failover.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_failover.add_argument("--time-cs", type=float, default=0.001,
+                                 help="seconds a node holds the critical section")
+    parser_failover.add_argument("--time-p", type=float, default=0.0, help="seconds between the critical sections")
+    parser_failover.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL,
+                                 help="seconds between the heartbeats")
+    parser_failover.add_argument("--stall-entry", type=int, default=10,
+                                 help="the last node hangs in its critical section on this entry")
+    parser_failover.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+    parser_failover.add_argument("--timeout", type=float, default=60.0, help="give up after this many seconds")
+    parser_failover.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_recovery = subparsers.add_parser("recovery", help="safety of a node that crashes and recovers from its log")
+    parser_recovery.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_recovery.add_argument("--entries", type=int, default=1000, help="number of critical section entries")
+    parser_recovery.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_recovery.add_argument("--time-cs", type=float, default=0.001,
+                                 help="seconds a node holds the critical section")
+    parser_recovery.add_argument("--time-p", type=float, default=0.0, help="seconds between the critical sections")
+    parser_recovery.add_argument("--crash-entry", type=int, default=10,
+                                 help="the last node crashes in its critical section on this entry")
+    parser_recovery.add_argument("--downtime", type=float, nargs="+", default=[0.1, 1.0, 3.0],
+                                 help="seconds before the crashed node is restarted, one run per downtime")
+    parser_recovery.add_argument("--wal", help="keep the write-ahead logs in this directory, not in a temporary one")
+    parser_recovery.add_argument("--sync", choices=SYNC_POLICIES, default=SYNC_BATCH,
+                                 help="when the write-ahead logs are forced to disk")
+    parser_recovery.add_argument("--timeout", type=float, default=60.0, help="give up after this many seconds")
+    parser_recovery.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_stress = subparsers.add_parser("stress", help="safety of all the algorithms with many concurrent requesters")
+    parser_stress.add_argument("-n", type=int, default=16, help="number of nodes")
+    parser_stress.add_argument("--entries", type=int, default=2000, help="number of critical section entries")
+    parser_stress.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_stress.add_argument("--time-cs", type=float, default=0.001,
+                               help="seconds a node holds the critical section")
+    parser_stress.add_argument("--time-p", type=float, default=0.001, help="seconds between the critical sections")
+    parser_stress.add_argument("--timeout", type=float, default=120.0, help="give up after this many seconds")
+    parser_stress.add_argument("--read-ratio", type=float, default=0.0,
+                               help="fraction of the requests that only read, they share the critical section")
+    parser_stress.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_locks = subparsers.add_parser("locks", help="aggregate throughput of the named resources of the lock table")
+    parser_locks.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_locks.add_argument("--resources", type=int, nargs="+", default=[1, 2, 4, 8],
+                              help="numbers of named resources to run with")
+    parser_locks.add_argument("--entries", type=int, default=500, help="number of entries over all the resources")
+    parser_locks.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_locks.add_argument("--time-cs", type=float, default=0.01, help="seconds a node holds a resource")
+    parser_locks.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+    parser_locks.add_argument("--timeout", type=float, default=60.0, help="give up after this many seconds")
+    parser_locks.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_acquire = subparsers.add_parser("acquire", help="wait time of acquire without the load generator")
+    parser_acquire.add_argument("-n", type=int, default=5, help="number of nodes")
+    parser_acquire.add_argument("--contenders", type=int, default=5, help="number of nodes that call acquire")
+    parser_acquire.add_argument("--entries", type=int, default=500, help="number of critical section entries")
+    parser_acquire.add_argument("--port", type=int, default=8001, help="first port of the nodes")
+    parser_acquire.add_argument("--time-cs", type=float, default=0.001, help="seconds a caller holds the critical section")
+    parser_acquire.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+    parser_acquire.add_argument("--timeout", type=float, default=60.0, help="give up after this many seconds")
+    parser_acquire.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_simulate = subparsers.add_parser("simulate", help="throughput and latency in the in-memory simulation")
+    parser_simulate.add_argument("-n", type=int, default=100, help="number of nodes")
+    parser_simulate.add_argument("--entries", type=int, default=1000, help="number of critical section entries")
+    parser_simulate.add_argument("--time-cs", type=float, default=0.001,
+                                 help="seconds a node holds the critical section")
+    parser_simulate.add_argument("--time-p", type=float, default=0.0, help="seconds between the critical sections")
+    parser_simulate.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA)
+    parser_simulate.add_argument("--seed", type=int, default=0, help="seed of the simulation")
+    parser_simulate.add_argument("--latency", type=float, default=0.0001, help="seconds a message is in transit")
+    parser_simulate.add_argument("--jitter", type=float, default=0.0, help="random extra latency up to seconds")
+    parser_simulate.add_argument("--loss", type=float, default=0.0, help="probability that a message is dropped")
+    parser_simulate.add_argument("--topology", choices=TOPOLOGIES,
+                                 help="only connect the nodes with their neighbours")
+    parser_simulate.add_argument("--degree", type=int, help="degree of the topology")
+    parser_simulate.add_argument("--trace", help="record the messages to this trace file, see tracing.py")
+    parser_simulate.add_argument("--urgent", type=int, default=0, help="number of nodes that request with a priority")
+    parser_simulate.add_argument("--priority", type=int, default=1, help="priority of the urgent nodes")
+    parser_simulate.add_argument("--read-ratio", type=float, default=0.0,
+                                 help="fraction of the requests that only read, they share the critical section")
+    parser_simulate.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_codec = subparsers.add_parser("codec", help="encode and decode throughput of the codecs")
+    parser_codec.add_argument("--count", type=int, default=200000, help="number of messages")
+
+    args = parser.parse_args()
+    json_output = args.benchmark in ("throughput", "connections", "failover", "recovery", "stress", "locks", "acquire",
+                                     "simulate")
+
+    # The nodes print their status, stdout only gets the json results
+    with contextlib.redirect_stdout(sys.stderr if json_output else sys.stdout):
+        if args.benchmark == "handoff":
+            handoff(args.n, args.duration, args.port, args.time_cs, args.time_p, args.algorithm)
+        elif args.benchmark == "throughput":
+            results = throughput(args.n, args.entries, args.port, args.time_cs, args.time_p, args.algorithm,
+                                 args.timeout, args.wal, args.sync, args.topology, args.degree, args.transport,
+                                 args.trace, args.urgent, args.priority, args.read_ratio)
+        elif args.benchmark == "connections":
+            results = [connection_overhead(args.n, args.port + i * args.n, transport, args.topology, args.degree)
+                       for (i, transport) in enumerate(args.transport)]
+        elif args.benchmark == "failover":
+            results = failover(args.n, args.entries, args.port, args.time_cs, args.time_p, args.heartbeat,
+                               args.stall_entry, args.algorithm, args.timeout)
+        elif args.benchmark == "recovery":
+            results = [recovery(args.n, args.entries, args.port + i * args.n, args.time_cs, args.time_p,
+                                args.crash_entry, downtime, args.wal, args.sync, args.timeout)
+                       for (i, downtime) in enumerate(args.downtime)]
+        elif args.benchmark == "stress":
+            results = stress(args.n, args.entries, args.port, args.time_cs, args.time_p, args.timeout, args.read_ratio)
+        elif args.benchmark == "locks":
+            results = [locks(args.n, resources, args.entries, args.port + i * args.n, args.time_cs, args.timeout,
+                             args.algorithm) for (i, resources) in enumerate(args.resources)]
+        elif args.benchmark == "acquire":
+            results = acquire_latency(args.n, args.contenders, args.entries, args.port, args.time_cs, args.timeout,
+                                      args.algorithm)
+        elif args.benchmark == "simulate":
+            results = simulate(args.n, args.entries, args.time_cs, args.time_p, args.algorithm, args.seed, args.latency,
+                               args.jitter, args.loss, args.topology, args.degree, args.trace, args.urgent,
+                               args.priority, args.read_ratio)
+        elif args.benchmark == "codec":
+            codec_throughput(args.count)
+
+    if json_output:
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+
+    if args.benchmark == "recovery" and any(result["safety_violations"] or not result["completed"] or
+                                            not result["clock_safe"] or not result["recovered_in_time"]
+                                            for result in results):
+        sys.exit(1)
+    if args.benchmark == "stress" and any(result["safety_violations"] or not result["completed"]
+                                          for result in results.values()):
+        sys.exit(1)
@@ -0,0 +1,76 @@
+import re
+
+"""
+Cluster membership of the nodes. A cluster that spans hosts is described by its member list, one member per line with
+its id and the address its server listens on, e.g.
+  P1 10.0.0.1:8001
+  P2 10.0.0.2:8001
+The id of a member is P followed by a number, the requests are ordered by that number (see mutex.get_id_as_int).
+Blank lines and lines starting with # are skipped. Every process runs one member of the list (main.py --cluster), it
+connects with the members above it in the list and waits for the members below it to connect.
+A running cluster changes with the membership messages, they are handled by the connection like the heartbeats:
+  JOIN: a new node asks a member of the cluster, the seed, to join with its id and address.
+  MEMBERS: the answer of the seed, the member list. The new node connects with all the members.
+  JOINED: the seed tells the other members about the new node, they wait for it to connect.
+  LEAVE: a node leaves the cluster after it has answered the requests it deferred, it is not waited for anymore.
+The members agree on the number of nodes in the network and wait for every member to connect. Changing the members
+needs an algorithm that does not depend on the number of nodes, ricart-agrawala: the quorums of maekawa and a
+topology are fixed and a token may leave with its holder. Nodes join one at a time, through the same seed.
+"""
+
+MEMBERSHIP_MESSAGES = ("JOIN", "MEMBERS", "JOINED", "LEAVE")
+
+# Seconds between the connection attempts with a member that is not listening yet
+CONNECT_RETRY = 0.5
+
+MEMBER_ID = re.compile(r"P\d+")
+
+
+def parse_address(address):
+    """Returns the (host, port) of an address of the form host:port."""
+    (host, separator, port) = address.rpartition(":")
+    if not separator or not host or not port.isdigit():
+        raise ValueError("Invalid address, expected host:port: " + str(address))
+    return (host, int(port))
+
+
+def check_member_id(id):
+    """Returns the id of a member when it is valid, P followed by a number, raises ValueError otherwise."""
+    if not isinstance(id, str) or MEMBER_ID.fullmatch(id) is None:
+        raise ValueError("Invalid member id, expected P followed by a number: " + str(id))
+    return id
+
+
+def load_cluster(path):
+    """Returns the members of the cluster file as a list of (id, host, port) in the order of the file."""
+    members = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+
+            fields = line.split()
+            if len(fields) != 2:
+                raise ValueError("Invalid member, expected an id and host:port: " + line)
+            members.append((check_member_id(fields[0]),) + parse_address(fields[1]))
+
+    if len({member[0] for member in members}) != len(members):
+        raise ValueError("The ids of the members are not unique")
+    return members
+
+
+def join_message(id, host, port):
+    return {"timestamp": 0, "message": "JOIN", "id": id, "host": host, "port": port}
+
+
+def joined_message(id, host, port):
+    return {"timestamp": 0, "message": "JOINED", "id": id, "host": host, "port": port}
+
+
+def members_message(members):
+    return {"timestamp": 0, "message": "MEMBERS", "members": [list(member) for member in members]}
+
+
+def leave_message():
+    return {"timestamp": 0, "message": "LEAVE"}
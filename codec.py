@@ -0,0 +1,110 @@
+import json
+import struct
+
+"""
+Encoding of the data that is send between the nodes. The codec is negotiated per connection together with the framing
+(see framing.py):
+  json: str is send as text, dict as json and bytes as is. This is the original encoding.
+  struct: the {"timestamp", "message"} messages of the mutual exclusion algorithms (see mutex.py) are send as a
+          fixed width packet of the message type byte, the Lamport timestamp and the id of the sender. The messages of
+          a named resource (see locktable.py) have the RESOURCE bit set in the type byte and the name of the resource
+          appended in utf-8. All other data is send as json. The message type bytes are control characters, json and
+          text never start with them. The struct codec is only used on connections with the len framing, because the
+          packets may contain the end of transmission character.
+"""
+
+JSON = "json"
+STRUCT = "struct"
+
+
+class JsonCodec:
+    """Encodes str as text, dict as json and bytes as is. Decoding determines whether the packet has been send in
+       str, json or byte format."""
+
+    name = JSON
+
+    def encode(self, data, encoding_type='utf-8'):
+        """Returns the payload bytes of the data. Raises TypeError when the data can not be encoded."""
+        if isinstance(data, str):
+            return data.encode(encoding_type)
+
+        elif isinstance(data, dict):
+            return json.dumps(data).encode(encoding_type)
+
+        elif isinstance(data, bytes):
+            return data
+
+        raise TypeError('datatype used is not valid plese use str, dict (will be send as json) or bytes')
+
+    def decode(self, packet):
+        """Returns the data of a packet, the packet may be any bytes-like object."""
+        try:
+            packet_decoded = str(packet, 'utf-8')
+
+            try:
+                return json.loads(packet_decoded)
+
+            except json.decoder.JSONDecodeError:
+                return packet_decoded
+
+        except UnicodeDecodeError:
+            return bytes(packet)
+
+
+class StructCodec(JsonCodec):
+    """Encodes the {"timestamp", "message"} messages of the mutual exclusion as a fixed width packet, everything
+       else is encoded as json.
+        sender_id: The id of the node that sends with this codec."""
+
+    name = STRUCT
+
+    # Message type, Lamport timestamp and the numeric part of the sender id
+    PACKET = struct.Struct("!BQI")
+    MESSAGE_TYPES = {"GIVE": 1, "OK": 2, "RELEASE": 3, "FAILED": 4, "INQUIRE": 5, "RELINQUISH": 6, "GIVE-OK": 7,
+                     "TOKEN": 8}
+    MESSAGE_NAMES = {value: key for (key, value) in MESSAGE_TYPES.items()}
+    RESOURCE = 0x10
+
+    def __init__(self, sender_id):
+        # Node ids are of the form P<number>
+        self.sender = int(sender_id[1:]) if sender_id[1:].isdigit() else 0
+
+    def encode(self, data, encoding_type='utf-8'):
+        if type(data) is dict and data.get("message") in self.MESSAGE_TYPES:
+            timestamp = data.get("timestamp")
+            if type(timestamp) is int and 0 <= timestamp < 2 ** 64:
+                if len(data) == 2:
+                    return self.PACKET.pack(self.MESSAGE_TYPES[data["message"]], timestamp, self.sender)
+                if len(data) == 3 and type(data.get("resource")) is str:
+                    return self.PACKET.pack(self.MESSAGE_TYPES[data["message"]] | self.RESOURCE, timestamp,
+                                            self.sender) + data["resource"].encode("utf-8")
+
+        return super(StructCodec, self).encode(data, encoding_type)
+
+    def decode(self, packet):
+        if len(packet) >= self.PACKET.size and packet[0] & ~self.RESOURCE in self.MESSAGE_NAMES:
+            if len(packet) == self.PACKET.size and packet[0] in self.MESSAGE_NAMES:
+                (message_type, timestamp, sender) = self.PACKET.unpack(packet)
+                return {"timestamp": timestamp, "message": self.MESSAGE_NAMES[message_type]}
+
+            if packet[0] & self.RESOURCE:
+                (message_type, timestamp, sender) = self.PACKET.unpack_from(packet)
+                return {"timestamp": timestamp, "message": self.MESSAGE_NAMES[message_type & ~self.RESOURCE],
+                        "resource": str(packet[self.PACKET.size:], "utf-8")}
+
+        return super(StructCodec, self).decode(packet)
+
+
+def create_codec(name, node_id):
+    """Returns the codec with the given name for the node with the given id."""
+    if name == STRUCT:
+        return StructCodec(node_id)
+    return JsonCodec()
+
+
+def choose_codec(offered, supported):
+    """Returns the first supported codec that has been offered by the other node."""
+    for name in supported:
+        if name in offered:
+            return name
+    return JSON
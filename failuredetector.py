@@ -0,0 +1,84 @@
+import collections
+import math
+import time
+
+"""
+Phi accrual failure detector of the connections (Hayashibara et al.). A node that has the failure detector enabled
+sends a HEARTBEAT on every connection once per heartbeat interval. Instead of a fixed time-out the detector keeps the
+intervals between the last heartbeats of the connected node and expresses its silence as phi: the chance that a node
+that is alive stays silent this long is 10 ** -phi, given the mean and standard deviation of the intervals seen so
+far. The time-out adapts to the network and the load of the nodes, a peer is suspected when phi passes the threshold.
+The HEARTBEAT messages are consumed by the connection, like the PING and PONG messages (see metrics.py). Nodes that
+do not know them pass them to the mutual exclusion algorithm that ignores them.
+"""
+
+HEARTBEAT_MESSAGES = ("HEARTBEAT",)
+
+# Seconds between the heartbeats of an idle connection
+HEARTBEAT_INTERVAL = 0.5
+
+# A phi of 8 means a chance of 1 in 10 ** 8 that an alive node is suspected
+PHI_THRESHOLD = 8.0
+
+# Number of heartbeat intervals the estimate is based on and the minimal standard deviation in seconds, which keeps
+# a perfectly regular heartbeat from making the detector oversensitive
+WINDOW = 100
+MIN_STD_DEVIATION = 0.1
+
+# Seconds of silence on top of the mean interval that are not suspicious yet, e.g. a garbage collection or a node
+# that is busy with a burst of messages
+ACCEPTABLE_PAUSE = 1.0
+
+# Reconnections of suspected and disconnected nodes back off exponentially, from RECONNECT_BACKOFF up to
+# RECONNECT_BACKOFF_MAX seconds between the attempts
+RECONNECT_BACKOFF = 0.5
+RECONNECT_BACKOFF_MAX = 30.0
+
+
+def heartbeat_message():
+    return {"timestamp": 0, "message": "HEARTBEAT"}
+
+
+def reconnect_backoff(trials, random):
+    """Returns the seconds to wait before the next reconnection after the given number of failed trials. The delay
+       is drawn between half and the full backoff, so nodes that lost the same peer do not reconnect all at once."""
+    backoff = min(RECONNECT_BACKOFF * 2 ** max(trials - 1, 0), RECONNECT_BACKOFF_MAX)
+    return random.uniform(backoff / 2, backoff)
+
+
+class PhiAccrualDetector:
+    """Estimates the suspicion level of a single connected node from the arrival times of its heartbeats.
+        interval: The expected heartbeat interval, the estimate starts from it until intervals have been seen.
+        window: Number of intervals that are kept."""
+
+    def __init__(self, interval=HEARTBEAT_INTERVAL, window=WINDOW):
+        self.intervals = collections.deque(maxlen=window)
+        self.intervals.append(interval)
+        self.last_arrival = time.monotonic()
+        self.heartbeats = 0
+
+    def heartbeat(self, now=None):
+        """Record the arrival of a heartbeat of the connected node."""
+        now = time.monotonic() if now is None else now
+        self.intervals.append(now - self.last_arrival)
+        self.last_arrival = now
+        self.heartbeats += 1
+
+    def silence(self, now=None):
+        """Returns the seconds since the last heartbeat."""
+        return (time.monotonic() if now is None else now) - self.last_arrival
+
+    def phi(self, now=None):
+        """Returns the suspicion level of the connected node, -log10 of the chance that the next heartbeat is still
+           coming after this much silence. The normal distribution is approximated with a logistic function."""
+        intervals = self.intervals
+        mean = sum(intervals) / len(intervals)
+        variance = sum((interval - mean) ** 2 for interval in intervals) / len(intervals)
+        std_deviation = max(math.sqrt(variance), MIN_STD_DEVIATION)
+
+        # Beyond 10 standard deviations phi is far past any sensible threshold, clamp it to keep the exp finite
+        y = max(-10.0, min((self.silence(now) - mean - ACCEPTABLE_PAUSE) / std_deviation, 10.0))
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
@@ -0,0 +1,155 @@
+import struct
+
+"""
+Framing of the packets on the TCP/IP stream between two nodes. Two formats are supported:
+  eot: every packet is terminated with the end of transmission character 0x04. This is the original format, the
+       payload may not contain 0x04.
+  len: every packet is prefixed with its length as a 4 byte unsigned big endian integer. The payload may contain any
+       byte.
+The format is negotiated per connection right after the id exchange. The node that made the connection offers the
+formats it supports with a HELLO message, the other node answers with HELLO-ACK and the chosen format, after which the
+first node confirms with HELLO-DONE. The codec of the connection (see codec.py) is negotiated by the same messages.
+Every node switches its sending after its last handshake message and its receiving after the last handshake message
+of the other node, so no packet is ever read with the wrong format. Nodes that do not know the handshake ignore the
+HELLO message and the connection stays on the eot format.
+HELLO and HELLO-ACK also carry the optional features the node understands, e.g. the OK that is piggybacked on a GIVE
+(see mutex.py). A feature is only used towards a node that has announced it.
+"""
+
+EOT = "eot"
+LENGTH = "len"
+
+EOT_CHAR = 0x04.to_bytes(1, 'big')
+HEADER = struct.Struct("!I")
+
+# Packets larger than this are refused, a peer that sends one is disconnected.
+MAX_FRAME_SIZE = 1024 * 1024
+
+HANDSHAKE_MESSAGES = ("HELLO", "HELLO-ACK", "HELLO-DONE")
+
+# Optional features of the protocol
+PIGGYBACK = "piggyback"
+
+
+class FrameError(Exception):
+    """Raised when the stream contains a frame that is not valid, for example a frame larger than the maximum."""
+    pass
+
+
+def encode_frame(payload, framing):
+    """Returns the payload bytes framed with the given format."""
+    if framing == LENGTH:
+        return HEADER.pack(len(payload)) + payload
+    return payload + EOT_CHAR
+
+
+def handshake_message(message, framing, codec, features=None):
+    """Returns a handshake message. It carries a timestamp so that nodes without the handshake process it as an
+       unknown message and ignore it."""
+    data = {"timestamp": 0, "message": message, "framing": framing, "codec": codec}
+    if features is not None:
+        data["features"] = list(features)
+    return data
+
+
+def choose_framing(offered, supported):
+    """Returns the first supported framing that has been offered by the other node."""
+    for framing in supported:
+        if framing in offered:
+            return framing
+    return EOT
+
+
+class FrameReader:
+    """Reassembles the frames of a stream in one reusable receive buffer. Data is received directly into the buffer
+       with recv_into (or copied in with feed) and the frames are returned as memoryviews on the buffer, so no bytes
+       are copied per packet. A memoryview is only valid until the next receive. The buffer only grows when a single
+       frame does not fit in it, up to the maximum frame size.
+        framing: The framing that is used to read the stream, it can be changed between frames.
+        max_frame_size: The maximum size of a single frame."""
+
+    def __init__(self, framing=EOT, max_frame_size=MAX_FRAME_SIZE, buffer_size=65536):
+        self.framing = framing
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray(min(buffer_size, max_frame_size + HEADER.size))
+        self.view = memoryview(self.buffer)
+        self.start = 0  # Start of the first frame that has not been returned
+        self.end = 0  # End of the received data
+        self.scan = 0  # Position from where the next EOT_CHAR is searched
+
+    def make_room(self):
+        """Make sure there is free space at the end of the buffer. The unread data is moved to the front of the
+           buffer, which only copies the partial frame, or the buffer is grown when it is full with one frame."""
+        if self.end < len(self.buffer):
+            return
+
+        if self.start > 0:
+            remaining = self.end - self.start
+            self.buffer[:remaining] = bytes(self.view[self.start:self.end])
+            self.scan -= self.start
+            self.start = 0
+            self.end = remaining
+
+        elif len(self.buffer) < self.max_frame_size + HEADER.size:
+            buffer = bytearray(min(len(self.buffer) * 2, self.max_frame_size + HEADER.size))
+            buffer[:self.end] = self.view[:self.end]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+
+        else:
+            raise FrameError("Frame is larger than %d bytes" % self.max_frame_size)
+
+    def recv_into(self, sock):
+        """Receive data from the socket directly into the buffer. Returns the number of bytes received, 0 when the
+           connection was closed."""
+        self.make_room()
+        received = sock.recv_into(self.view[self.end:])
+        self.end += received
+        return received
+
+    def feed(self, data):
+        """Copy received data into the buffer and returns the complete frames, used by transports that do not
+           receive from a socket. The data may be larger than the free space of the buffer."""
+        data = memoryview(data)
+        while len(data) > 0:
+            self.make_room()
+            size = min(len(data), len(self.buffer) - self.end)
+            self.view[self.end:self.end + size] = data[:size]
+            self.end += size
+            data = data[size:]
+            yield from self.frames()
+
+    def frames(self):
+        """Returns the complete frames in the buffer. The framing may be changed while iterating, the frames that
+           follow are then read with the new framing."""
+        while self.start < self.end:
+            if self.framing == LENGTH:
+                if self.end - self.start < HEADER.size:
+                    break
+
+                size = HEADER.unpack_from(self.buffer, self.start)[0]
+                if size > self.max_frame_size:
+                    raise FrameError("Frame of %d bytes is larger than %d bytes" % (size, self.max_frame_size))
+
+                frame_end = self.start + HEADER.size + size
+                if frame_end > self.end:
+                    break
+
+                frame = self.view[self.start + HEADER.size:frame_end]
+                self.start = self.scan = frame_end
+
+            else:
+                eot_pos = self.buffer.find(EOT_CHAR, max(self.start, self.scan), self.end)
+                if eot_pos == -1:
+                    if self.end - self.start > self.max_frame_size:
+                        raise FrameError("Frame is larger than %d bytes" % self.max_frame_size)
+                    self.scan = self.end
+                    break
+
+                frame = self.view[self.start:eot_pos]
+                self.start = self.scan = eot_pos + 1
+
+            yield frame
+
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
@@ -0,0 +1,199 @@
+import multiprocessing
+import os
+import types
+
+from mutex import RICART_AGRAWALA
+from node import Node
+from tracing import process_trace
+
+"""
+Launcher that spreads the nodes over worker processes, so they are not all sharing the interpreter lock of a single
+process. Every worker runs its nodes as threads, exactly like main.py does in one process, and the nodes connect with
+each other over TCP/IP whether they run in the same worker or not. The coordinator in the main process controls the
+workers over a pipe per worker: it starts the nodes, builds the full mesh (or the topology, see topology.py) once all
+servers are listening and relays the commands of the prompt.
+"""
+
+
+def run_worker(pipe, indexes, n, host, port, algorithm, metrics, wal=None, heartbeat=None, topology=None, degree=None,
+               trace=None):
+    """Main function of a worker process. Starts the nodes with the given indexes and handles the commands of the
+       coordinator until it is told to stop. Every command is a (command, args) tuple that is answered with one
+       reply."""
+    nodes = {}
+    tracer = process_trace(trace) if trace is not None else None
+    for i in indexes:
+        node = Node(host, port + i, id=f"P{i + 1}", n=n, algorithm=algorithm)
+        node.enable_metrics(metrics)
+        if topology is not None:
+            node.set_topology(topology, degree)
+        if wal is not None:
+            node.open_wal(os.path.join(wal, f"{node.id}.wal"))
+        if heartbeat is not None:
+            node.enable_failure_detector(heartbeat)
+        node.enable_trace(tracer)
+        node.start()
+        nodes[node.id] = node
+    pipe.send("started")
+
+    while True:
+        (command, args) = pipe.recv()
+        if command == "connect":
+            # Every node connects with its neighbours that have a higher index
+            for i in indexes:
+                node = nodes[f"P{i + 1}"]
+                node.connect_with_nodes([(host, port + j) for j in range(i + 1, n) if node.is_neighbour(f"P{j + 1}")])
+            pipe.send(True)
+
+        elif command == "wait_for_mesh":
+            pipe.send(all(node.wait_for_mesh(args[0]) for node in nodes.values()))
+
+        elif command == "list":
+            pipe.send({node_id: str(node) for (node_id, node) in nodes.items()})
+
+        elif command == "get":
+            (node_id, name) = args
+            pipe.send(getattr(nodes[node_id], name))
+
+        elif command == "set":
+            (node_id, name, value) = args
+            setattr(nodes[node_id], name, value)
+            pipe.send(True)
+
+        elif command == "stats":
+            pipe.send(nodes[args[0]].get_stats())
+
+        elif command == "ping":
+            nodes[args[0]].ping_nodes()
+            pipe.send(True)
+
+        elif command == "stop":
+            for node in nodes.values():
+                node.stop()
+            for node in nodes.values():
+                node.join()
+            if tracer is not None:
+                tracer.close()
+            pipe.send(True)
+            break
+
+        else:
+            pipe.send(None)
+
+
+class RemoteNode:
+    """Stands in for a node that runs in a worker process, so the commands of main.py work the same as with local
+       nodes. Every attribute access is a round trip to the worker.
+        coordinator: The coordinator of the worker.
+        worker: The pipe of the worker that runs the node.
+        id: The id of the node.
+        metrics: Whether the metrics of the node are enabled."""
+
+    def __init__(self, coordinator, worker, id, metrics):
+        self.coordinator = coordinator
+        self.worker = worker
+        self.id = id
+        self.metrics = types.SimpleNamespace(enabled=metrics)
+
+    @property
+    def time_cs(self):
+        return self.coordinator.request(self.worker, "get", self.id, "time_cs")
+
+    @time_cs.setter
+    def time_cs(self, value):
+        self.coordinator.request(self.worker, "set", self.id, "time_cs", value)
+
+    @property
+    def time_p(self):
+        return self.coordinator.request(self.worker, "get", self.id, "time_p")
+
+    @time_p.setter
+    def time_p(self, value):
+        self.coordinator.request(self.worker, "set", self.id, "time_p", value)
+
+    def get_stats(self):
+        return self.coordinator.request(self.worker, "stats", self.id)
+
+    def ping_nodes(self):
+        self.coordinator.request(self.worker, "ping", self.id)
+
+    def __str__(self):
+        return self.coordinator.request(self.worker, "list")[self.id]
+
+    def __repr__(self):
+        return '<RemoteNode id: {}>'.format(self.id)
+
+
+class Coordinator:
+    """Starts n nodes spread over a number of worker processes and relays the commands to them. The nodes are
+       assigned to the workers in consecutive blocks, with as many processes as nodes every node runs in its own
+       process.
+        n: The number of nodes.
+        processes: The number of worker processes.
+        host: The host the servers of the nodes bind to.
+        port: The port of the first node, the other nodes use the following ports.
+        algorithm: (optional) The mutual exclusion algorithm, see mutex.py.
+        metrics: (optional) Enable the metrics of the nodes.
+        wal: (optional) Directory of the write-ahead logs of the nodes, see wal.py.
+        heartbeat: (optional) Heartbeat interval of the failure detector of the nodes, see failuredetector.py.
+        topology: (optional) Only connect the nodes with their neighbours in this topology, see topology.py.
+        degree: (optional) The degree of the topology.
+        trace: (optional) Directory of the traces of the workers, see tracing.py."""
+
+    def __init__(self, n, processes, host="127.0.0.1", port=8001, algorithm=RICART_AGRAWALA, metrics=False,
+                 wal=None, heartbeat=None, topology=None, degree=None, trace=None):
+        self.n = n
+        self.processes = max(1, min(processes, n))
+        self.host = host
+        self.port = port
+        self.algorithm = algorithm
+        self.metrics = metrics
+        self.wal = wal
+        self.heartbeat = heartbeat
+        self.topology = topology
+        self.degree = degree
+        self.trace = trace
+
+        self.workers = []
+        self.worker_processes = []
+        self.nodes = []
+
+    def start(self):
+        """Start the workers, wait until all the servers are listening and connect the nodes to a full mesh. The
+           workers build their part of the mesh in parallel, see wait_for_mesh."""
+        for worker in range(self.processes):
+            indexes = [i for i in range(self.n) if i * self.processes // self.n == worker]
+            (pipe, child_pipe) = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_worker, daemon=True, args=(
+                child_pipe, indexes, self.n, self.host, self.port, self.algorithm, self.metrics, self.wal,
+                self.heartbeat, self.topology, self.degree, self.trace))
+            process.start()
+            self.workers.append(pipe)
+            self.worker_processes.append(process)
+            self.nodes.extend(RemoteNode(self, pipe, f"P{i + 1}", self.metrics) for i in indexes)
+
+        for worker in self.workers:
+            worker.recv()
+
+        self.broadcast("connect")
+
+    def wait_for_mesh(self, timeout=None):
+        """Wait until all the nodes are connected with each other. Returns False on a timeout."""
+        return all(self.broadcast("wait_for_mesh", timeout))
+
+    def request(self, worker, command, *args):
+        """Send a command to one worker and return its reply."""
+        worker.send((command, args))
+        return worker.recv()
+
+    def broadcast(self, command, *args):
+        """Send a command to all the workers at once and return their replies."""
+        for worker in self.workers:
+            worker.send((command, args))
+        return [worker.recv() for worker in self.workers]
+
+    def stop(self):
+        """Stop all the nodes and wait for the workers to exit."""
+        self.broadcast("stop")
+        for process in self.worker_processes:
+            process.join()
@@ -0,0 +1,249 @@
+import collections
+import threading
+
+from mutex import EXCLUSIVE, push_request
+
+"""
+Lock table of a node: named resources that are requested and released independently of each other and of the
+election of the node itself. Every resource has its own election state and its own instance of the mutual exclusion
+algorithm of the node, the messages of the algorithm carry the name of the resource in the "resource" field and are
+send over the same connections. The resources are created on first use, by a request of the node or by a message of
+another node, so two nodes agree on a resource by its name alone. Resources that are not in use are not dropped:
+the algorithms keep state across the critical sections, like the token of Suzuki-Kasami.
+The Lamport clock is shared by all the resources. The write-ahead log (see wal.py) only covers the election of the
+node itself.
+The critical sections are taken with Node.acquire and Node.release, a blocking, an asyncio and a context manager
+interface. The callers that wait for the same critical section of a node are queued, the first of the most urgent ones
+is woken up the moment the critical section is granted. When it releases, the next one requests it again. Readers
+(mode SHARED) hold it together: a SHARED grant wakes up all the readers that are waiting at once, and it is released
+when the last of them releases.
+"""
+
+
+class Resource:
+    """The election state of one named resource. It stands in for the node towards the mutual exclusion algorithm:
+       the algorithm reads the state of the resource, everything else is passed on to the node and the messages it
+       sends are tagged with the name of the resource. The state is kept in slots, a resource costs a few hundred
+       bytes plus the state of its algorithm.
+        node: The node that owns the resource.
+        name: The name of the resource, it is the same on all the nodes."""
+
+    __slots__ = ("node", "name", "state", "request_timestamp", "request_priority", "request_mode", "election_approvals",
+                 "request_que", "mutex", "waiters", "holders")
+
+    # Deferred OKs are never piggybacked, the next request of a resource is not timed by the node
+    request_next = False
+
+    def __init__(self, node, name, mutex_factory):
+        self.node = node
+        self.name = name
+        self.state = "DO-NOT-WANT"
+        self.request_timestamp = None
+        self.request_priority = 0
+        self.request_mode = EXCLUSIVE
+        self.election_approvals = 0
+        self.request_que = []
+        self.mutex = mutex_factory(self)
+
+        # The callers of Node.acquire waiting for the resource and the number that hold it, several readers may
+        self.waiters = collections.deque()
+        self.holders = 0
+
+    # The node as seen by the algorithm
+
+    @property
+    def id(self):
+        return self.node.id
+
+    @property
+    def timestamp(self):
+        return self.node.timestamp
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self.node.timestamp = value
+
+    @property
+    def nodes_in_network(self):
+        return self.node.nodes_in_network
+
+    @property
+    def peers(self):
+        return self.node.peers
+
+    @property
+    def all_nodes(self):
+        return self.node.all_nodes
+
+    @property
+    def members(self):
+        return self.node.members
+
+    @property
+    def live_nodes(self):
+        return self.node.live_nodes
+
+    @property
+    def next_hops(self):
+        return self.node.next_hops
+
+    @property
+    def suspected(self):
+        return self.node.suspected
+
+    @property
+    def recovered_clock(self):
+        return self.node.recovered_clock
+
+    def find_member(self, node_id):
+        return self.node.find_member(node_id)
+
+    def awaited_ids(self):
+        return self.node.awaited_ids()
+
+    def debug_print(self, message, *args):
+        if self.node.debug:
+            self.node.debug_print("[%s] %s", self.name, message % args if args else message)
+
+    def tag(self, data):
+        """Returns a copy of the data with the name of the resource."""
+        data = dict(data)
+        data["resource"] = self.name
+        return data
+
+    def send_to_nodes(self, data, exclude=[]):
+        self.node.send_to_nodes(self.tag(data), exclude)
+
+    def send_to_node(self, n, data):
+        self.node.send_to_node(n, self.tag(data))
+
+    def send_ok_response(self, node):
+        self.node.send_to_node(node, {"timestamp": self.node.timestamp, "message": "OK", "resource": self.name})
+
+    def send_ok_responses(self, nodes):
+        for node in nodes:
+            self.send_ok_response(node)
+
+    def defer_request(self, node, data):
+        push_request(self.request_que, node, data)
+
+    # Transitions, invoked on the scheduler thread of the node
+
+    def request_critical_section(self):
+        """Move to WANTED and let the algorithm ask for the resource."""
+        self.state = "WANTED"
+        self.election_approvals = 0
+        self.node.timestamp = self.node.timestamp + 1
+        self.request_timestamp = self.node.timestamp
+        waiter = self.node.next_waiter(self)
+        (self.request_priority, self.request_mode) = (waiter.priority, waiter.mode) if waiter is not None else \
+            (self.node.priority, EXCLUSIVE)
+        self.node.resource_state_changed(self)
+        self.mutex.request()
+
+    def enter_critical_section(self):
+        """Move to HELD, invoked by the algorithm when the resource is granted."""
+        self.election_approvals = 0
+        self.state = "HELD"
+        self.node.resource_state_changed(self)
+        self.node.grant_waiter(self)
+
+    def release_critical_section(self, request_waiter=True):
+        """Move to DO-NOT-WANT and let the algorithm answer the deferred requests. A resource always answers them
+           right away, request_waiter is there for the interface of the node."""
+        self.state = "DO-NOT-WANT"
+        self.node.resource_state_changed(self)
+        self.mutex.release()
+
+    def __repr__(self):
+        return '<Resource {} of {}: {}>'.format(self.name, self.node.id, self.state)
+
+
+class LockTable:
+    """The named resources of a node by name.
+        node: The node that owns the table.
+        mutex_factory: Creates the mutual exclusion algorithm of a resource, see mutex.create_mutex."""
+
+    def __init__(self, node, mutex_factory):
+        self.node = node
+        self.mutex_factory = mutex_factory
+        self.resources = {}
+
+    def __len__(self):
+        return len(self.resources)
+
+    def __iter__(self):
+        return iter(self.resources.values())
+
+    def get(self, name):
+        """Returns the resource with the given name, it is created when it does not exist yet."""
+        resource = self.resources.get(name)
+        if resource is None:
+            resource = self.resources[name] = Resource(self.node, name, self.mutex_factory)
+        return resource
+
+    def held(self):
+        """Returns the names of the resources that are HELD."""
+        return [resource.name for resource in self.resources.values() if resource.state == "HELD"]
+
+
+class Waiter:
+    """A caller of Node.acquire that waits for a critical section. It is woken up by the scheduler thread of the node,
+       a blocking caller through the event and an asyncio caller through a future on its own event loop.
+        loop: (optional) The event loop of an asyncio caller.
+        priority: The priority of the caller, the most urgent waiter is granted first.
+        mode: SHARED for a reader, EXCLUSIVE for a writer (see mutex.py)."""
+
+    __slots__ = ("event", "loop", "future", "granted", "priority", "mode")
+
+    def __init__(self, loop=None, priority=0, mode=EXCLUSIVE):
+        self.event = threading.Event()
+        self.loop = loop
+        self.priority = priority
+        self.mode = mode
+        self.future = loop.create_future() if loop is not None else None
+        self.granted = False
+
+    def wake(self, granted):
+        """Wake up the caller, granted is False when the node stops before the critical section is granted."""
+        self.granted = granted
+        self.event.set()
+        if self.future is not None:
+            self.loop.call_soon_threadsafe(self.resolve, granted)
+
+    def resolve(self, granted):
+        if not self.future.done():
+            self.future.set_result(granted)
+
+
+class CriticalSection:
+    """Context manager of Node.critical_section, for with and async with. Entering raises TimeoutError when the
+       critical section is not granted within the timeout.
+        node: The node.
+        name: The named resource, None for the critical section of the node itself.
+        timeout: Seconds to wait for the critical section, None waits forever.
+        priority: The priority of the caller, see Node.acquire.
+        mode: SHARED for a reader, EXCLUSIVE for a writer."""
+
+    def __init__(self, node, name=None, timeout=None, priority=None, mode=EXCLUSIVE):
+        self.node = node
+        self.name = name
+        self.timeout = timeout
+        self.priority = priority
+        self.mode = mode
+
+    def __enter__(self):
+        if not self.node.acquire(self.name, self.timeout, self.priority, self.mode):
+            raise TimeoutError("The critical section has not been granted")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.node.release(self.name)
+
+    async def __aenter__(self):
+        if not await self.node.acquire_async(self.name, self.timeout, self.priority, self.mode):
+            raise TimeoutError("The critical section has not been granted")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.node.release(self.name)
@@ -1,64 +1,293 @@
 #!/usr/bin/python
 
-import sys
-from node import Node
+import argparse
+import asyncio
+import os
 
+from cluster import check_member_id, load_cluster, parse_address
+from mutex import ALGORITHMS, RICART_AGRAWALA
+from node import Node, connect_mesh
+from selectornode import SelectorNode
+from topology import TOPOLOGIES, Topology
+from tracing import process_trace
 
-def start(n=2):
+
+def print_commands():
+    print("Available commands:")
+    print("\t* List - List all nodes and their statuses")
+    print("\t* time-cs p - change the critical section timeout. timeout range [10, p]")
+    print("\t* time-p p - change the time-out interval. timeout range [5, p]")
+    print("\t* stats - Show the metrics of all nodes (start with --metrics)")
+    print("\t* q - Quit")
+
+
+def print_stats(node):
+    """Print the metrics of a node, times are in milliseconds. The round trip times are measured by the pings that
+       are send when a node connects and after every stats command."""
+    stats = node.get_stats()
+    print("%s %s, request queue %d" % (node.id, stats["state"], stats["request_que"]))
+    for (name, histogram) in sorted(stats["histograms"].items()):
+        if histogram["count"] > 0:
+            # The request queue length is a number of requests, all the other histograms are times
+            scale = 1 if name == "request_que" else 1000
+            print("\t%-24s count %6d, mean %9.3f, p50 %9.3f, p99 %9.3f" % (
+                name, histogram["count"], histogram["mean"] * scale, histogram["p50"] * scale,
+                histogram["p99"] * scale))
+
+    for (peer, peer_stats) in sorted(stats["peers"].items()):
+        rtt = peer_stats["histograms"].get("rtt")
+        print("\t%s: rtt %s ms, %d bytes send, %d bytes received, %s" % (
+            peer, "%.3f" % (rtt["min"] * 1000) if rtt and rtt["count"] else "-", peer_stats["send"]["bytes"],
+            peer_stats["counters"].get("bytes_received", 0),
+            ", ".join("%s %d" % item for item in sorted(peer_stats["counters"].items()) if item[0] != "bytes_received")))
+
+
+def handle_command(command, nodes):
+    """Handle a single command of the prompt. Returns False when the program should exit."""
+    if command == "List":
+        for node in nodes:
+            print(node)
+    elif "time-cs" in command:
+        t = float(command.replace("time-cs ", ""))
+        if t < 10:
+            print("t must be larger than or equal to 10")
+        else:
+            for node in nodes:
+                node.time_cs = t
+    elif "time-p" in command:
+        t = float(command.replace("time-p ", ""))
+        if t < 5:
+            print("t must be larger than or equal to 5")
+        else:
+            for node in nodes:
+                node.time_p = t
+    elif command == "stats":
+        if not nodes or not nodes[0].metrics.enabled:
+            print("Metrics are disabled, start with --metrics")
+        for node in nodes:
+            if node.metrics.enabled:
+                print_stats(node)
+                node.ping_nodes()
+    elif command == "q":
+        return False
+    else:
+        print("Unknown command")
+    return True
+
+
+def start(n=2, algorithm=RICART_AGRAWALA, metrics=False, wal=None, heartbeat=None, topology=None, degree=None,
+          node_class=Node, trace=None):
     nodes = []
     port = 8001
     host = "127.0.0.1"
+    tracer = process_trace(trace) if trace is not None else None
 
     # Create the nodes
     for i in range(n):
-        node = Node(host, port, id=f"P{i + 1}", n=n)
+        node = node_class(host, port, id=f"P{i + 1}", n=n, algorithm=algorithm)
+        node.enable_metrics(metrics)
+        if topology is not None:
+            node.set_topology(topology, degree)
+        if wal is not None:
+            node.open_wal(os.path.join(wal, f"{node.id}.wal"))
+        if heartbeat is not None:
+            node.enable_failure_detector(heartbeat)
+        node.enable_trace(tracer)
         port += 1
         node.start()
         nodes.append(node)
 
     # Connect the nodes
-    for i in range(len(nodes)):
-        node = nodes[i]
-        for j in range(i + 1, len(nodes)):
-            other_node = nodes[j]
-            node.connect_with_node(host, other_node.port)
+    if not connect_mesh(nodes, host, timeout=60):
+        print("Not all the nodes are connected with each other")
 
-    print("Available commands:")
-    print("\t* List - List all nodes and their statuses")
-    print("\t* time-cs p - change the critical section timeout. timeout range [10, p]")
-    print("\t* time-p p - change the time-out interval. timeout range [5, p]")
-    print("\t* q - Quit")
-    while True:
-        command = input("Enter command, press q to exit: \n")
+    print_commands()
+    while handle_command(input("Enter command, press q to exit: \n"), nodes):
+        pass
+
+    for node in nodes:
+        node.stop()
+    if tracer is not None:
+        for node in nodes:
+            node.join()
+        tracer.close()
 
-        if command == "List":
-            for node in nodes:
-                print(node)
-        elif "time-cs" in command:
-            t = float(command.replace("time-cs ", ""))
-            if t < 10:
-                print("t must be larger than or equal to 10")
-            else:
-                for node in nodes:
-                    node.time_cs = t
-        elif "time-p" in command:
-            t = float(command.replace("time-p ", ""))
-            if t < 5:
-                print("t must be larger than or equal to 5")
-            else:
-                for node in nodes:
-                    node.time_p = t
-        elif command == "q":
-            break
-        else:
-            print("Unknown command")
+
+def start_processes(n=2, algorithm=RICART_AGRAWALA, metrics=False, processes=2, wal=None, heartbeat=None,
+                    topology=None, degree=None, trace=None):
+    """Same as start, but the nodes are spread over worker processes (see launcher.py)."""
+    from launcher import Coordinator
+
+    coordinator = Coordinator(n, processes, algorithm=algorithm, metrics=metrics, wal=wal, heartbeat=heartbeat,
+                              topology=topology, degree=degree, trace=trace)
+    coordinator.start()
+    if not coordinator.wait_for_mesh(timeout=60):
+        print("Not all the nodes are connected with each other")
+
+    print_commands()
+    while handle_command(input("Enter command, press q to exit: \n"), coordinator.nodes):
+        pass
+
+    coordinator.stop()
+
+
+def start_member(node_id, members=None, seed=None, host="127.0.0.1", port=8001, algorithm=RICART_AGRAWALA,
+                 metrics=False, wal=None, heartbeat=None, node_class=Node, trace=None):
+    """Run one member of a cluster in this process (see cluster.py), the member with the given id of the member list
+       or a new member at host, port that joins through the seed address. Quitting leaves the cluster."""
+    if members is not None:
+        (host, port) = next(((member[1], member[2]) for member in members if member[0] == node_id), (None, None))
+        if host is None:
+            print("%s is not a member of the cluster" % node_id)
+            return
+
+    node = node_class(host, port, id=node_id, n=len(members) if members is not None else 1, algorithm=algorithm)
+    node.enable_metrics(metrics)
+    if wal is not None:
+        node.open_wal(os.path.join(wal, f"{node.id}.wal"))
+    if heartbeat is not None:
+        node.enable_failure_detector(heartbeat)
+    tracer = process_trace(trace) if trace is not None else None
+    node.enable_trace(tracer)
+    if members is None:
+        node.begin_join()
+    node.start()
+
+    if members is not None:
+        connected = node.connect_cluster(members, timeout=60)
+    else:
+        connected = node.join_cluster(seed[0], seed[1], timeout=60)
+    if not connected:
+        print("Not all the members are connected with this node")
+
+    print_commands()
+    while handle_command(input("Enter command, press q to exit: \n"), [node]):
+        pass
+
+    node.leave_cluster(timeout=10)
+    node.stop()
+    if tracer is not None:
+        node.join()
+        tracer.close()
+
+
+async def start_async(n=2, algorithm=RICART_AGRAWALA, metrics=False, wal=None, heartbeat=None, topology=None,
+                      degree=None, trace=None):
+    """Same as start, but all the nodes run on a single asyncio event loop."""
+    from asyncnode import AsyncNode
+
+    nodes = []
+    port = 8001
+    host = "127.0.0.1"
+    tracer = process_trace(trace) if trace is not None else None
+
+    for i in range(n):
+        node = AsyncNode(host, port, id=f"P{i + 1}", n=n, algorithm=algorithm)
+        node.enable_metrics(metrics)
+        if topology is not None:
+            node.set_topology(topology, degree)
+        if wal is not None:
+            node.open_wal(os.path.join(wal, f"{node.id}.wal"))
+        if heartbeat is not None:
+            node.enable_failure_detector(heartbeat)
+        node.enable_trace(tracer)
+        port += 1
+        node.start()
+        nodes.append(node)
+
+    for node in nodes:
+        await node.wait_for_server()
+
+    await asyncio.gather(*[node.connect_with_nodes([(host, other_node.port) for other_node in nodes[i + 1:]
+                                                    if node.is_neighbour(other_node.id)])
+                           for (i, node) in enumerate(nodes)])
+    if not all(await asyncio.gather(*[node.wait_for_mesh(60) for node in nodes])):
+        print("Not all the nodes are connected with each other")
+
+    # The prompt is blocking, so it is read from a worker thread to keep the nodes running.
+    loop = asyncio.get_running_loop()
+    print_commands()
+    while handle_command(await loop.run_in_executor(None, input, "Enter command, press q to exit: \n"), nodes):
+        pass
 
     for node in nodes:
         node.stop()
+    for node in nodes:
+        await node.join()
+    if tracer is not None:
+        tracer.close()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        start(int(sys.argv[1]))
+    parser = argparse.ArgumentParser(description="Mutual exclusion between n nodes.")
+    parser.add_argument("n", type=int, nargs="?", help="number of nodes, not used with --cluster and --join")
+    parser.add_argument("--algorithm", choices=sorted(ALGORITHMS), default=RICART_AGRAWALA,
+                        help="mutual exclusion algorithm")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="run all the nodes on one asyncio event loop instead of a thread per connection")
+    parser.add_argument("--selectors", action="store_true",
+                        help="serve all the connections of a node with one selector thread instead of a thread per "
+                             "connection")
+    parser.add_argument("--metrics", action="store_true", help="enable the metrics shown by the stats command")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="spread the nodes over this many worker processes, n runs every node in its own process")
+    parser.add_argument("--wal", help="log the state of the nodes to write-ahead logs in this directory and recover "
+                                      "it on a restart (ricart-agrawala only)")
+    parser.add_argument("--trace", help="record the messages and state transitions to a trace per process in this "
+                                        "directory, see python tracing.py analyze")
+    parser.add_argument("--heartbeat", type=float,
+                        help="enable the failure detector with a heartbeat every this many seconds, suspected nodes "
+                             "are not waited for (ricart-agrawala only)")
+    parser.add_argument("--topology", choices=TOPOLOGIES,
+                        help="only connect every node with its neighbours in this topology, the messages to the other "
+                             "nodes are forwarded")
+    parser.add_argument("--degree", type=int,
+                        help="degree of the topology: branching of a tree, neighbours of a regular topology or size of "
+                             "a cluster")
+    parser.add_argument("--cluster", help="run one member of the cluster in this file in this process, every line has "
+                                           "the id and the host:port of a member")
+    parser.add_argument("--join", metavar="HOST:PORT", help="join the cluster of the member at this address")
+    parser.add_argument("--id", help="id of the member that runs in this process, with --cluster or --join")
+    parser.add_argument("--host", default="127.0.0.1", help="host the server of the member binds to, with --join")
+    parser.add_argument("--port", type=int, default=8001, help="port of the server of the member, with --join")
+    args = parser.parse_args()
+    node_class = SelectorNode if args.selectors else Node
+    if args.selectors and (args.asyncio or args.processes > 0):
+        parser.error("--selectors runs the nodes in this process, without --asyncio and --processes")
+    if args.wal is not None and args.algorithm != RICART_AGRAWALA:
+        parser.error("--wal only recovers the state of ricart-agrawala")
+    if args.heartbeat is not None and args.algorithm != RICART_AGRAWALA:
+        parser.error("--heartbeat only lets ricart-agrawala stop waiting for a suspected node")
+    if args.topology is not None and args.n is not None:
+        # Reject an impossible topology before any node is started
+        try:
+            Topology(args.topology, args.n, args.degree)
+        except ValueError as error:
+            parser.error(str(error))
+
+    if args.cluster is not None or args.join is not None:
+        if args.id is None:
+            parser.error("--cluster and --join need the --id of the member")
+        if args.asyncio or args.processes > 0 or args.topology is not None:
+            parser.error("--cluster and --join run a single threaded member without a topology")
+        if args.algorithm != RICART_AGRAWALA:
+            parser.error("--cluster and --join change the members, only ricart-agrawala supports that")
+        try:
+            check_member_id(args.id)
+            members = load_cluster(args.cluster) if args.cluster is not None else None
+            seed = parse_address(args.join) if args.join is not None else None
+        except ValueError as error:
+            parser.error(str(error))
+        start_member(args.id, members, seed, args.host, args.port, args.algorithm, args.metrics, args.wal,
+                     args.heartbeat, node_class, args.trace)
+    elif args.n is None:
+        parser.error("the number of nodes is required")
+    elif args.asyncio:
+        asyncio.run(start_async(args.n, args.algorithm, args.metrics, args.wal, args.heartbeat, args.topology,
+                                args.degree, args.trace))
+    elif args.processes > 0:
+        start_processes(args.n, args.algorithm, args.metrics, args.processes, args.wal, args.heartbeat, args.topology,
+                        args.degree, args.trace)
     else:
-        raise ValueError("Need to specifify n")
+        start(args.n, args.algorithm, args.metrics, args.wal, args.heartbeat, args.topology, args.degree, node_class,
+              args.trace)
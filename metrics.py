@@ -0,0 +1,131 @@
+import math
+import threading
+import time
+
+"""
+Instrumentation of the nodes and their connections. Every Node and every connection has a Metrics object that is
+disabled by default, the instrumented code only checks the enabled flag and does nothing else when it is not set.
+  counters: messages send and received by type, bytes received.
+  histograms: encode and decode time, the time spend in every state transition (e.g. WANTED->HELD is the time waiting
+              for the critical section), the length of the request queue at release and the round trip time to the
+              connected nodes.
+  marks: the wall clock time of the last occurrence of an event, e.g. of the last time the node became HELD.
+The round trip time is measured with PING and PONG messages that are answered by the connection itself, like the
+handshake messages. Nodes without the instrumentation pass them to the mutual exclusion algorithm that ignores them.
+"""
+
+RTT_MESSAGES = ("PING", "PONG")
+
+
+class Histogram:
+    """Histogram with four buckets per power of two, recording a value only costs a frexp and a dict update. The
+       percentiles are the upper bound of the bucket they fall in, so they are at most 25% too high, and never higher
+       than the maximum."""
+
+    SUB_BUCKETS = 4
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        # value = mantissa * 2 ** exponent with 0.5 <= mantissa < 1
+        (mantissa, exponent) = math.frexp(value)
+        bucket = exponent * self.SUB_BUCKETS + int((mantissa - 0.5) * 2 * self.SUB_BUCKETS)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                (exponent, sub_bucket) = divmod(bucket, self.SUB_BUCKETS)
+                upper = math.ldexp(0.5 + (sub_bucket + 1) / (2.0 * self.SUB_BUCKETS), exponent)
+                return min(upper, self.max)
+        return self.max
+
+    def snapshot(self):
+        if self.count == 0:
+            return {"count": 0}
+
+        return {
+            "count": self.count,
+            "mean": self.total / self.count,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99)
+        }
+
+
+class Metrics:
+    """Counters, histograms and marks of a node or a connection. The instrumented code must check the enabled flag
+       before it does any measurement, the methods themselves always record.
+        enabled: Whether the instrumentation is enabled."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.marks = {}
+
+    def count(self, name, amount=1):
+        """Add amount to the counter name."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def count_message(self, direction, data):
+        """Count a message that is send or received by its type, e.g. send.GIVE."""
+        if isinstance(data, dict):
+            self.count(direction + "." + str(data.get("message")))
+        else:
+            self.count(direction + "." + type(data).__name__)
+
+    def observe(self, name, value):
+        """Record value in the histogram name."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(value)
+
+    def mark(self, name):
+        """Remember the wall clock time of the event name."""
+        self.marks[name] = time.time()
+
+    def snapshot(self):
+        """Returns a copy of all the counters, histograms and marks."""
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.snapshot() for (name, histogram) in self.histograms.items()},
+                "marks": dict(self.marks)
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.marks = {}
+
+
+def ping_message():
+    """Returns a PING message, the connected node echoes the send time in its PONG."""
+    return {"timestamp": 0, "message": "PING", "sent": time.perf_counter()}
+
+
+def pong_message(ping):
+    return {"timestamp": 0, "message": "PONG", "sent": ping.get("sent")}
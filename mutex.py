@@ -0,0 +1,581 @@
+import collections
+import heapq
+import itertools
+import math
+
+from framing import PIGGYBACK
+
+"""
+Mutual exclusion algorithms of the Node. The Node keeps the state of the election (DO-NOT-WANT, WANTED, HELD) and the
+timers, the algorithm decides which messages are send and when the critical section is granted. An algorithm is
+only invoked by the owner of the election state, the scheduler thread of the node (see Node.post):
+  request(): the node has moved to WANTED.
+  release(): the node has moved from HELD to DO-NOT-WANT.
+  on_message(node, data): a message of the algorithm has been received from the connected node.
+  on_connected(node): a connection with a node has been made, it may be a node that has recovered from a crash.
+  on_suspected(node): the connection with a node that is suspected to have failed has been closed (see
+                      failuredetector.py), or a node has left the cluster (see cluster.py).
+When the critical section is granted the algorithm invokes node.enter_critical_section(). The named resources of
+the lock table run an algorithm each, the resource stands in for the node (see locktable.py).
+The algorithms send to the members of the node (see Node.members): the connections, and on a partial topology the
+stand-ins of the nodes that are reached through the neighbours (see topology.py).
+A request may carry a priority, higher is more urgent (see Node.priority). The requests are ordered by request_key,
+the same order on every node: the priority moves a request back in time by PRIORITY_TICKS ticks of the Lamport clock
+per level, so it overtakes the less urgent requests that are not much older, while a request that keeps waiting ages
+into the higher priorities as the clock moves on and is not starved. ricart-agrawala answers its deferred requests,
+the voters of maekawa vote and suzuki-kasami queues the token in this order, a node of ricart-agrawala that requests
+again keeps the requests that go after its own deferred. raymond serves its neighbours first come first served, its
+queue holds the neighbours that asked and not their requests.
+A request is EXCLUSIVE, a writer, or SHARED, a reader: readers may hold the critical section at the same time. Only
+ricart-agrawala lets them, its readers answer each other right away. The other algorithms hand out one vote or one
+token and grant a SHARED request alone, like an EXCLUSIVE one.
+"""
+
+RICART_AGRAWALA = "ricart-agrawala"
+MAEKAWA = "maekawa"
+SUZUKI_KASAMI = "suzuki-kasami"
+RAYMOND = "raymond"
+
+# Modes of a request, readers share the critical section and a writer holds it alone
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+MODES = (SHARED, EXCLUSIVE)
+
+
+# Ticks of the Lamport clock a request is moved back per level of priority. The clocks advance a few ticks per
+# critical section entry, a request of priority 1 overtakes the requests of priority 0 of the last few dozen entries.
+PRIORITY_TICKS = 64
+
+# Breaks the ties between deferred requests with the same key, a request that has been repeated
+DEFERRED = itertools.count()
+
+
+def get_id_as_int(str_id):
+    return int(str_id[1:])
+
+
+def request_rank(timestamp, priority):
+    """Returns the timestamp of a request aged by its priority."""
+    return timestamp - priority * PRIORITY_TICKS
+
+
+def request_key(timestamp, priority, node_id):
+    """Returns the key of the order of the requests: the rank, then the timestamp and the id of the node, so there
+       are no ties between requests of different nodes."""
+    return (request_rank(timestamp, priority), timestamp, get_id_as_int(node_id))
+
+
+def request_message(message, timestamp, priority, mode=EXCLUSIVE):
+    """Returns a request message, the priority and the mode are only send when they are not the default."""
+    data = {"timestamp": timestamp, "message": message}
+    if priority:
+        data["priority"] = priority
+    if mode == SHARED:
+        data["mode"] = mode
+    return data
+
+
+def push_request(queue, node, data):
+    """Add the request of the node to the heap of deferred requests."""
+    key = request_key(data["timestamp"], data.get("priority", 0), node.id)
+    heapq.heappush(queue, (key, next(DEFERRED), node, data))
+
+
+def pop_requests(queue):
+    """Empty the heap of deferred requests, returns the (node, data) of the requests in the order of their keys."""
+    requests = [(node, data) for (key, sequence, node, data) in sorted(queue)]
+    queue.clear()
+    return requests
+
+
+class RicartAgrawala:
+    """Every request is broadcast to all the nodes and the critical section is granted when all of them have
+       answered OK. A node that is HELD, or WANTED with an earlier request, defers its OK until it releases. Costs
+       2(n-1) messages per critical section entry. The deferred OKs are send at once on release, one per node. When
+       the node requests again right away only the deferred requests that go before the new request are answered,
+       piggybacked on its GIVE as a single GIVE-OK message to the nodes that have announced the feature (see
+       framing.py), the others stay deferred until the node releases again. Conflicting requests and the deferred
+       OKs are ordered by request_key. An OK can not be taken back, so a request never goes before a request the
+       node has already answered: its priority is lowered until its rank is not below theirs, until they have been
+       granted (see enter). As a node that requests again keeps the less urgent requests deferred, an urgent node
+       overtakes them at full contention as well. A SHARED request does not conflict with the other SHARED
+       requests, a reader that is WANTED or HELD answers them right away. A release answers all the readers that
+       waited for the writer at once, they enter together.
+        node: The node that runs the algorithm."""
+
+    name = RICART_AGRAWALA
+
+    def __init__(self, node):
+        self.node = node
+
+        # The ids of the nodes that have answered OK to the current request
+        self.approved = set()
+
+        # The priority of the current request and the highest rank of the requests we have answered OK by the id of
+        # the requester, they may still be waiting (see enter). A node that recovered from a crash may have answered
+        # any request up to its recovered clock (see Node.open_wal).
+        self.priority = 0
+        self.answered = {}
+        self.recovered = node.recovered_clock
+
+    def request(self):
+        node = self.node
+        self.approved = set()
+        self.priority = node.request_priority
+        answered = list(self.answered.values()) + ([self.recovered] if self.recovered is not None else [])
+        if answered:
+            self.priority = min(self.priority, (node.request_timestamp - max(answered)) // PRIORITY_TICKS)
+        piggyback = self.answer_deferred()
+        if not piggyback:
+            node.send_to_nodes(data=request_message("GIVE", node.request_timestamp, self.priority, node.request_mode))
+        else:
+            node.send_ok_responses([connected_node for connected_node in piggyback
+                                    if PIGGYBACK not in connected_node.features])
+            for connected_node in node.members:
+                give_ok = connected_node in piggyback and PIGGYBACK in connected_node.features
+                node.send_to_node(connected_node, request_message("GIVE-OK" if give_ok else "GIVE",
+                                                                  node.request_timestamp, self.priority,
+                                                                  node.request_mode))
+
+        if self.granted():
+            self.enter()
+
+    def granted(self):
+        """Whether all the members that are waited for have answered OK, see Node.awaited_ids. A member that is
+           disconnected is still waited for, only a suspected member (see failuredetector.py) or one that left the
+           cluster (see cluster.py) is not. A member that joined is waited for before it has connected."""
+        awaited = self.node.awaited_ids()
+        return awaited is not None and awaited <= self.approved
+
+    def answer_deferred(self):
+        """The deferred requests of a release that is followed by a request right away, see release. The requests
+           that go before the new request, or that read along with it, are answered: returns their nodes, the OKs
+           are piggybacked on the request. The others stay deferred, the new request goes first."""
+        node = self.node
+        key = request_key(node.request_timestamp, self.priority, node.id)
+        replies = []
+        for (connected_node, data) in pop_requests(node.request_que):
+            if request_key(data["timestamp"], data.get("priority", 0), connected_node.id) < key or \
+                    (node.request_mode == SHARED and data.get("mode") == SHARED):
+                self.answer(connected_node, data)
+                replies.append(connected_node)
+            else:
+                node.defer_request(connected_node, data)
+        return set(replies)
+
+    def release(self):
+        node = self.node
+        if node.request_next:
+            # The node requests again in the same step, the request answers the deferred requests that go before it
+            return
+
+        # Drain the deferred requests once in order, a node that asked more than once gets a single OK
+        requests = pop_requests(node.request_que)
+        for (connected_node, data) in requests:
+            self.answer(connected_node, data)
+        node.send_ok_responses(list(dict.fromkeys(connected_node for (connected_node, data) in requests)))
+
+    def on_message(self, connected_node, data):
+        node = self.node
+        if data["message"] == "GIVE-OK":
+            # The OK of our request comes first, it may grant the critical section before the request is handled
+            self.on_message(connected_node, {"timestamp": data["timestamp"], "message": "OK"})
+            self.on_message(connected_node, request_message("GIVE", data["timestamp"], data.get("priority", 0),
+                                                            data.get("mode", EXCLUSIVE)))
+
+        elif data["message"] == "GIVE":
+            if node.state == "DO-NOT-WANT" or (node.request_mode == SHARED and data.get("mode") == SHARED):
+                # Readers do not wait for each other
+                self.answer(connected_node, data)
+                node.send_ok_response(connected_node)
+            elif node.state == "HELD":
+                node.defer_request(connected_node, data)
+            elif node.state == "WANTED":
+                if request_key(data["timestamp"], data.get("priority", 0), connected_node.id) < \
+                        request_key(node.request_timestamp, self.priority, node.id):
+                    # Its request goes first
+                    self.answer(connected_node, data)
+                    node.send_ok_response(connected_node)
+                else:
+                    # Our request goes first, que the request
+                    node.defer_request(connected_node, data)
+        elif data["message"] == "OK":
+            if node.state != "WANTED" or data["timestamp"] < node.request_timestamp or \
+                    connected_node.id in self.approved:
+                # An OK is send after the request has been received, so its timestamp is at least the one of the
+                # request. An older or a second OK answers an earlier or a repeated request, e.g. one replayed by a
+                # node that recovered from a crash (see wal.py).
+                return
+            self.approved.add(connected_node.id)
+            node.election_approvals += 1
+            if self.granted():
+                # The last OK grants the critical section right away
+                self.enter()
+
+    def answer(self, connected_node, data):
+        """Remember the rank of a request that is answered OK, our next request goes after it."""
+        rank = request_rank(data["timestamp"], data.get("priority", 0))
+        if rank > self.answered.get(connected_node.id, rank - 1):
+            self.answered[connected_node.id] = rank
+
+    def enter(self):
+        """Enter the critical section. A node only answers an EXCLUSIVE request after the requests of it we have
+           answered before, so they have been granted and released when it is granted. Our next request may go before
+           the next requests of the nodes that approved it. The readers that were answered right away may still
+           wait."""
+        if self.node.request_mode == EXCLUSIVE:
+            for node_id in self.approved:
+                self.answered.pop(node_id, None)
+        self.node.enter_critical_section()
+
+    def on_connected(self, connected_node):
+        """Repeat the request to a node that has (re)connected while we wait for its OK, it has lost the request
+           when it crashed or when the connection broke."""
+        node = self.node
+        if node.state == "WANTED" and connected_node.id not in self.approved:
+            node.send_to_node(connected_node, request_message("GIVE", node.request_timestamp, self.priority,
+                                                              node.request_mode))
+
+    def on_suspected(self, connected_node):
+        """A suspected node, or one that left the cluster (see cluster.py), is not waited for anymore, its OK may be
+           the only one that is missing. Its OK is forgotten, the approvals are counted against the members."""
+        node = self.node
+        self.approved.discard(connected_node.id)
+        if node.state == "WANTED" and self.granted():
+            self.enter()
+
+
+def grid_quorum(index, n):
+    """Returns the indexes of the quorum of node index (0 based) out of n nodes. The nodes are placed row by row on a
+       grid of ceil(sqrt(n)) columns and the quorum is the row and the column of the node, so any two quorums
+       intersect and a quorum has at most 2 * sqrt(n) - 1 members."""
+    columns = int(math.ceil(math.sqrt(n)))
+    (row, column) = divmod(index, columns)
+    quorum = set(range(row * columns, min((row + 1) * columns, n)))
+    quorum.update(range(column, n, columns))
+    return quorum
+
+
+class Maekawa:
+    """Maekawa's algorithm: a node only asks the nodes of its quorum, every node votes for one request at a time and
+       the critical section is granted when the whole quorum voted for the request. Deadlocks between requests that
+       got part of the votes are resolved with INQUIRE, FAILED and RELINQUISH: a voter that has voted for a later
+       request asks it to give the vote back, which it does when it knows it can not get all the votes. Costs
+       between 3 and 6 times sqrt(n) messages per critical section entry. A voter votes for the requests in the
+       order of request_key.
+       The nodes must have the ids P1 .. Pn, the quorums are computed from them.
+        node: The node that runs the algorithm."""
+
+    name = MAEKAWA
+
+    def __init__(self, node):
+        self.node = node
+        index = get_id_as_int(node.id) - 1
+        self.quorum = ["P%d" % (member + 1) for member in sorted(grid_quorum(index, node.nodes_in_network))]
+
+        # Requester state: the voters that voted for our request, whether a voter has refused and the voters that
+        # asked their vote back while we still had a chance to get all votes
+        self.votes = set()
+        self.failed = False
+        self.inquiries = set()
+
+        # Voter state: the request (key, id, timestamp) we voted for and the heap of waiting requests
+        self.voted_for = None
+        self.inquired = False
+        self.waiting = []
+
+    def send(self, node_id, message, timestamp=None, priority=0):
+        """Send a message to a member of the quorum. Messages to ourselves are handled directly."""
+        node = self.node
+        data = request_message(message, node.timestamp if timestamp is None else timestamp, priority)
+        if node_id == node.id:
+            self.on_message(node, data)
+        else:
+            connected_node = node.find_member(node_id)
+            if connected_node is not None:
+                node.send_to_node(connected_node, data)
+            else:
+                node.debug_print("Maekawa: node %s is not connected", node_id)
+
+    def request(self):
+        self.votes = set()
+        self.failed = False
+        self.inquiries = set()
+        for member in self.quorum:
+            self.send(member, "GIVE", self.node.request_timestamp, self.node.request_priority)
+
+    def release(self):
+        self.votes = set()
+        self.inquiries = set()
+        for member in self.quorum:
+            self.send(member, "RELEASE")
+
+    def vote(self, request):
+        """Vote for the request (key, id, timestamp)."""
+        self.voted_for = request
+        self.inquired = False
+        self.send(request[1], "OK", request[2])
+
+    def on_message(self, connected_node, data):
+        node = self.node
+        message = data["message"]
+        sender = connected_node.id
+
+        # Voter side
+        if message == "GIVE":
+            request = (request_key(data["timestamp"], data.get("priority", 0), sender), sender, data["timestamp"])
+            if self.voted_for is None:
+                self.vote(request)
+                return
+
+            heapq.heappush(self.waiting, request)
+            if request[0] < self.voted_for[0] and self.waiting[0] is request:
+                # Before the request we voted for and every waiting request, ask our vote back
+                if not self.inquired:
+                    self.inquired = True
+                    self.send(self.voted_for[1], "INQUIRE", self.voted_for[2])
+            else:
+                self.send(sender, "FAILED", data["timestamp"])
+
+        elif message == "RELINQUISH":
+            if self.voted_for is not None and self.voted_for[1] == sender:
+                heapq.heappush(self.waiting, self.voted_for)
+                self.vote(heapq.heappop(self.waiting))
+
+        elif message == "RELEASE":
+            if self.voted_for is not None and self.voted_for[1] == sender:
+                self.voted_for = None
+                if self.waiting:
+                    self.vote(heapq.heappop(self.waiting))
+
+        # Requester side, messages about an older request are ignored
+        elif node.state != "WANTED" and node.state != "HELD":
+            return
+
+        elif data["timestamp"] != node.request_timestamp:
+            return
+
+        elif message == "OK":
+            self.votes.add(sender)
+            self.inquiries.discard(sender)
+            node.election_approvals = len(self.votes)
+            if node.state == "WANTED" and len(self.votes) == len(self.quorum):
+                node.enter_critical_section()
+
+        elif message == "FAILED":
+            self.failed = True
+            for inquirer in list(self.inquiries):
+                self.relinquish(inquirer)
+
+        elif message == "INQUIRE":
+            if node.state == "HELD" or sender not in self.votes:
+                return
+            if self.failed:
+                self.relinquish(sender)
+            else:
+                self.inquiries.add(sender)
+
+    def relinquish(self, voter):
+        """Give the vote of the voter back."""
+        self.votes.discard(voter)
+        self.inquiries.discard(voter)
+        self.node.election_approvals = len(self.votes)
+        self.send(voter, "RELINQUISH", self.node.request_timestamp)
+
+    def on_connected(self, connected_node):
+        """The votes are not recovered, a node that crashed with a vote in hand is not supported."""
+        pass
+
+    def on_suspected(self, connected_node):
+        """The quorums are fixed, a request waits for the vote of a suspected node until it reconnects."""
+        pass
+
+
+class SuzukiKasami:
+    """Suzuki-Kasami's token based algorithm: the node holding the token may enter the critical section. A node
+       without the token broadcasts a request with its request number, the holder passes the token on when it
+       releases. The token carries the number of the last granted request of every node and the queue of nodes
+       waiting for it. Entering again while holding the token costs no messages, a contended entry costs n messages.
+       The holder queues the nodes in the order of request_key of their requests.
+       The token starts at node P1.
+        node: The node that runs the algorithm."""
+
+    name = SUZUKI_KASAMI
+
+    def __init__(self, node):
+        self.node = node
+
+        # Highest request number received of every node and the key of that request
+        self.requested = {}
+        self.keys = {}
+
+        # The token: the last granted request number of every node and the queue of the nodes waiting for it
+        self.has_token = node.id == "P1"
+        self.granted = {}
+        self.queue = []
+
+    def request(self):
+        node = self.node
+        if self.has_token:
+            node.enter_critical_section()
+            return
+
+        self.requested[node.id] = self.requested.get(node.id, 0) + 1
+        data = request_message("GIVE", node.request_timestamp, node.request_priority)
+        data["sequence"] = self.requested[node.id]
+        node.send_to_nodes(data=data)
+
+    def release(self):
+        node = self.node
+        self.granted[node.id] = self.requested.get(node.id, 0)
+        for (node_id, sequence) in self.requested.items():
+            if sequence == self.granted.get(node_id, 0) + 1 and node_id not in self.queue:
+                self.queue.append(node_id)
+        # A node that is queued has a request with a key, unless the token overtook its request on the way here
+        self.queue.sort(key=lambda node_id: self.keys.get(node_id, (math.inf,)))
+
+        if self.queue:
+            self.send_token(self.queue.pop(0))
+
+    def send_token(self, node_id):
+        """Pass the token on to the node with the given id."""
+        node = self.node
+        connected_node = node.find_member(node_id)
+        if connected_node is None:
+            node.debug_print("SuzukiKasami: node %s is not connected", node_id)
+            return
+
+        self.has_token = False
+        node.send_to_node(connected_node, {
+            "timestamp": node.timestamp,
+            "message": "TOKEN",
+            "granted": self.granted,
+            "queue": self.queue
+        })
+        self.granted = {}
+        self.queue = []
+
+    def on_message(self, connected_node, data):
+        node = self.node
+        if data["message"] == "GIVE":
+            sender = connected_node.id
+            if data["sequence"] > self.requested.get(sender, 0):
+                self.requested[sender] = data["sequence"]
+                self.keys[sender] = request_key(data["timestamp"], data.get("priority", 0), sender)
+            if self.has_token and node.state == "DO-NOT-WANT" and \
+                    self.requested[sender] == self.granted.get(sender, 0) + 1:
+                self.send_token(sender)
+
+        elif data["message"] == "TOKEN":
+            self.has_token = True
+            self.granted = data["granted"]
+            self.queue = data["queue"]
+            if node.state == "WANTED":
+                node.enter_critical_section()
+            else:
+                # Not wanted anymore, pass it on as if we released
+                self.release()
+
+    def on_connected(self, connected_node):
+        """The token is not recovered, a node that crashed with the token in hand is not supported."""
+        pass
+
+    def on_suspected(self, connected_node):
+        """A token held by a suspected node is not regenerated, the requests wait until it reconnects."""
+        pass
+
+
+class Raymond:
+    """Raymond's tree based token algorithm: the nodes form a tree and every node points to its neighbour on the way
+       to the token, the holder. A request travels along the holders to the token, which travels back along the
+       same edges while the edges are turned around, so every node only talks with its neighbours. A node asks its
+       holder once for all the requests that are queued at it, its own and those of its neighbours, and serves the
+       queue in order when the token arrives. Costs O(log n) messages per critical section entry on a balanced tree
+       and O(diameter) on other topologies, entering again while holding the token costs no messages.
+       The tree is the shortest path tree towards P1 of the topology (see Node.set_topology), the token starts at
+       P1. On a full mesh the tree is a star around P1. The queue is first come first served, priorities are not
+       supported: a neighbour asks once for all the requests behind it.
+        node: The node that runs the algorithm."""
+
+    name = RAYMOND
+
+    def __init__(self, node):
+        self.node = node
+
+        # The neighbour on the way to the token, or our own id when we hold it
+        self.holder = node.id if node.id == "P1" else node.next_hops.get("P1", "P1")
+
+        # The ids of the nodes that asked us for the token in order, our own id for our own request, and whether we
+        # have asked the holder for it
+        self.queue = collections.deque()
+        self.asked = False
+
+    def send(self, node_id, message):
+        node = self.node
+        connected_node = node.find_member(node_id)
+        if connected_node is None:
+            node.debug_print("Raymond: node %s is not connected", node_id)
+            return
+        node.send_to_node(connected_node, {"timestamp": node.timestamp, "message": message})
+
+    def assign_privilege(self):
+        """Pass the token to the first node in the queue, or enter when it is our own request."""
+        node = self.node
+        if self.holder != node.id or node.state == "HELD" or not self.queue:
+            return
+
+        self.holder = self.queue.popleft()
+        self.asked = False
+        if self.holder == node.id:
+            node.enter_critical_section()
+        else:
+            self.send(self.holder, "TOKEN")
+
+    def make_request(self):
+        """Ask the holder for the token when there are requests queued at this node."""
+        if self.holder != self.node.id and self.queue and not self.asked:
+            self.asked = True
+            self.send(self.holder, "GIVE")
+
+    def request(self):
+        self.queue.append(self.node.id)
+        self.assign_privilege()
+        self.make_request()
+
+    def release(self):
+        self.assign_privilege()
+        self.make_request()
+
+    def on_message(self, connected_node, data):
+        if data["message"] == "GIVE":
+            self.queue.append(connected_node.id)
+        elif data["message"] == "TOKEN":
+            self.holder = self.node.id
+        else:
+            return
+        self.assign_privilege()
+        self.make_request()
+
+    def on_connected(self, connected_node):
+        """The token and the holders are not recovered, a node that crashed on the path to the token is not
+           supported."""
+        pass
+
+    def on_suspected(self, connected_node):
+        """The tree is fixed, the requests behind a suspected node wait until it reconnects."""
+        pass
+
+
+ALGORITHMS = {
+    RICART_AGRAWALA: RicartAgrawala,
+    MAEKAWA: Maekawa,
+    SUZUKI_KASAMI: SuzukiKasami,
+    RAYMOND: Raymond,
+}
+
+
+def create_mutex(name, node):
+    """Returns the mutual exclusion algorithm with the given name for the node."""
+    if name not in ALGORITHMS:
+        raise ValueError("Unknown mutual exclusion algorithm: " + str(name))
+    return ALGORITHMS[name](node)
@@ -1,17 +1,48 @@
+import asyncio
+import collections
+import concurrent.futures
+import queue
+import selectors
 import socket
 import time
 import threading
 import random
 
+from cluster import CONNECT_RETRY, MEMBER_ID, join_message, joined_message, leave_message, members_message
+from codec import JSON, STRUCT
+from failuredetector import HEARTBEAT_INTERVAL, PHI_THRESHOLD, PhiAccrualDetector, reconnect_backoff
+from framing import EOT, LENGTH, PIGGYBACK
+from locktable import CriticalSection, LockTable, Waiter
+from metrics import Metrics
+from mutex import EXCLUSIVE, MODES, RICART_AGRAWALA, SHARED, create_mutex, get_id_as_int, push_request
 from nodeconnection import NodeConnection
+from peerregistry import PeerRegistry
+from topology import RoutedNode, Topology
+from tracing import FORWARD, RECEIVE, SEND
+from wal import CLOCK_LEASE, SYNC_BATCH, WriteAheadLog
 
 """
 Implementation based of https://github.com/macsnoeren/python-p2p-network
 """
 
+# Connections that may wait to be accepted by the server of a node, the number of connections connect_with_nodes
+# establishes in parallel and the seconds an accepted connection may take to send its id.
+LISTEN_BACKLOG = 128
+CONNECT_WORKERS = 32
+ID_TIMEOUT = 10.0
 
-def get_id_as_int(str_id):
-    return int(str_id[1:])
+
+def connect_mesh(nodes, host, timeout=None, reconnect=False):
+    """Connect the nodes to a full mesh, or to the topology of the nodes (see Node.set_topology). Every node connects
+       with its neighbours after it in the list. All the nodes make their connections at the same time. With
+       reconnect the connections are made again when they are lost (see Node.reconnect_nodes). Returns True when
+       every node is connected with all its neighbours before the timeout, see Node.wait_for_mesh."""
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max(len(nodes), 1), CONNECT_WORKERS)) as executor:
+        for (i, node) in enumerate(nodes):
+            executor.submit(node.connect_with_nodes, [(host, other_node.port) for other_node in nodes[i + 1:]
+                                                      if node.is_neighbour(other_node.id)], reconnect)
+
+    return all([node.wait_for_mesh(timeout) for node in nodes])
 
 
 class Node(threading.Thread):
@@ -28,13 +59,15 @@ class Node(threading.Thread):
                  connected_node: Which connected node caused the event.
                  data: The data that is send by the connected node."""
 
-    def __init__(self, host, port, id=None, callback=None, n=1):
+    def __init__(self, host, port, id=None, callback=None, n=1, algorithm=RICART_AGRAWALA):
         """Create instance of a Node. If you want to implement the Node functionality with a callback, you should
            provide a callback method. It is preferred to implement a new node by extending this Node class.
             host: The host name or ip address that is used to bind the TCP/IP server to.
             port: The port number that is used to bind the TCP/IP server to.
             id: (optional) This id will be associated with the node. When not given a unique ID will be created.
-            callback: (optional) The callback that is invokes when events happen inside the network."""
+            callback: (optional) The callback that is invokes when events happen inside the network.
+            n: The number of nodes in the network.
+            algorithm: (optional) The mutual exclusion algorithm, see mutex.py."""
         super(Node, self).__init__()
 
         # When this flag is set, the node will stop and close
@@ -47,27 +80,131 @@ class Node(threading.Thread):
         # Events are send back to the given callback
         self.callback = callback
 
-        # Nodes that have established a connection with this node
-        self.nodes_inbound = []  # Nodes that are connect with us N->(US)
-
-        # Nodes that this nodes is connected to
-        self.nodes_outbound = []  # Nodes that we are connected to (US)->N
+        # Nodes that have established a connection with this node N->(US) and nodes that we are connected to
+        # (US)->N, indexed by id and address
+        self.peers = PeerRegistry()
 
         # A list of nodes that should be reconnected to whenever the connection was lost
         self.reconnect_to_nodes = []
 
+        # The socket pair that wakes up the main loop when a node to reconnect has disconnected, see create_selector
+        self.loop_wakeup = None
+
+        # Packet framings and codecs this node supports in order of preference, negotiated per connection (see
+        # framing.py and codec.py)
+        self.framings = [LENGTH, EOT]
+        self.codecs = [STRUCT, JSON]
+
+        # Optional features of the protocol this node understands, announced by the same handshake
+        self.features = [PIGGYBACK]
+
         self.id = str(id)
         self.state = "DO-NOT-WANT"
         self.request_timestamp = None
         self.election_approvals = 0
         self.request_que = []
         self.nodes_in_network = n
+
+        # The priority of the requests of the load generator and of the callers of acquire that do not give one,
+        # higher is more urgent (see mutex.py). The priority and the mode of the current request.
+        self.priority = 0
+        self.request_priority = 0
+        self.request_mode = EXCLUSIVE
+
+        # The fraction of the requests of the load generator that only read, they are requested SHARED
+        self.read_ratio = 0.0
+
+        # The clock of a node that recovered from a crash, it may have answered the requests up to it (see open_wal)
+        self.recovered_clock = None
         self.next_execution = 0
+        self.request_next = False
         self.time_cs = 10
         self.time_p = 5
 
+        # The random timers request and release the critical section of the node, a load generator. Without it the
+        # critical section is only taken by acquire, the callers waiting for it and the one that holds it.
+        self.load_generator = True
+        self.waiters = collections.deque()
+        self.holders = 0
+
+        # Lower bounds of the random critical section and time-out intervals
+        self.time_cs_min = 10
+        self.time_p_min = 5.0
+
+        # Source of the random intervals, a simulation replaces it with a seeded random.Random (see simulator.py)
+        self.random = random
+
+        # The members of the cluster other than this node by id with the address of their server, empty when the
+        # network is a fixed number of nodes (see cluster.py). While joining the member list is not known yet and
+        # after leaving the node does not request anymore. The ids of the members that left. The members are changed
+        # by the scheduler thread only (see membership_message), the lock lets the other threads read them.
+        self.cluster = {}
+        self.cluster_lock = threading.Lock()
+        self.joining = False
+        self.leaving = False
+        self.left = set()
+
+        # Topology of the network, None is a full mesh (see topology.py). The ids of the neighbours, the neighbour on
+        # the way to every other node and the stand-ins of the nodes that are not neighbours by id.
+        self.topology = None
+        self.neighbour_ids = None
+        self.next_hops = {}
+        self.routed = {}
+        self.routed_nodes = []
+        self.members_cache = (None, [])
+
+        # The ids awaited by a request with the connections and the suspected ids they were computed from (see
+        # awaited_ids), the members of the cluster and the topology reset it when they change
+        self.awaited_cache = (None, None, None)
+
+        # ROUTE messages for a neighbour that has not connected yet by its id, they are send when it connects. A
+        # node is ready when its own neighbours are connected, the neighbours of the other nodes may still be
+        # connecting. Routing runs on the connection threads as well, the lock keeps the messages in order.
+        self.pending_routes = {}
+        self.route_lock = threading.Lock()
+
+        # The mutual exclusion algorithm that decides when the critical section is granted
+        self.mutex = create_mutex(algorithm, self)
+
+        # Named resources that are requested and released on demand, each with its own election (see locktable.py)
+        self.lock_table = LockTable(self, lambda resource: create_mutex(algorithm, resource))
+
+        # The election state (state, timestamp, request queue and the state of the algorithm) is only touched by
+        # the scheduler thread, its single owner. The other threads post their work to the mailbox as a
+        # (handler, args) task, the scheduler runs the tasks one by one in between the timed transitions. None only
+        # wakes up the scheduler.
+        self.mailbox = queue.SimpleQueue()
+
+        # Optional write-ahead log of the election state (see wal.py), the Lamport timestamp up to which the log
+        # covers the clock and the deferred requests (id, timestamp) of before a crash that still have to be answered
+        self.wal = None
+        self.wal_clock = 0
+        self.recovered_deferred = []
+
+        # Failure detector of the connections, disabled by default (see failuredetector.py). The seconds between the
+        # heartbeats, the phi above which a connected node is suspected, when the last heartbeats were send and the
+        # ids of the suspected nodes, until a heartbeat of them arrives again. The detector runs on the main loop,
+        # the suspected ids are changed by the scheduler thread only (see suspect_member). They are replaced instead
+        # of modified, the other threads read them as they are.
+        self.heartbeat_interval = None
+        self.phi_threshold = PHI_THRESHOLD
+        self.last_heartbeat = 0.0
+        self.suspected = frozenset()
+
+        # Set while the node is connected with all the other nodes of the network, the election only runs then. A
+        # suspected node counts as connected, it is not waited for.
+        self.mesh_ready = threading.Event()
+        if n <= 1:
+            self.mesh_ready.set()
+
+        # Instrumentation, disabled by default (see metrics.py). The last state and since when the node is in it.
+        self.metrics = Metrics()
+        self.last_transition = (self.state, time.perf_counter())
+
+        # Trace of the messages and state transitions, disabled by default (see tracing.py)
+        self.tracer = None
+
         # Start the TCP/IP server
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.init_server()
 
         # Message counters to make sure everyone is able to track the total messages
@@ -76,23 +213,296 @@ class Node(threading.Thread):
         # Debugging on or off!
         self.debug = False
 
+    @property
+    def nodes_inbound(self):
+        """Return a list of the nodes that are connect with us N->(US). The list must not be modified."""
+        return self.peers.inbound
+
+    @property
+    def nodes_outbound(self):
+        """Return a list of the nodes that we are connected to (US)->N. The list must not be modified."""
+        return self.peers.outbound
+
     @property
     def all_nodes(self):
-        """Return a list of all the nodes, inbound and outbound, that are connected with this node."""
-        return self.nodes_inbound + self.nodes_outbound
+        """Return a list of all the nodes, inbound and outbound, that are connected with this node. The list is
+           cached by the peer registry and must not be modified."""
+        return self.peers.all
+
+    @property
+    def members(self):
+        """Return all the other nodes of the network for the mutual exclusion: the connected nodes plus the
+           stand-ins of the nodes that are reached through the neighbours (see set_topology)."""
+        peers = self.peers.all
+        if not self.routed_nodes:
+            return peers
+        if self.members_cache[0] is not peers:
+            # The registry replaces its list when the connections change
+            self.members_cache = (peers, peers + self.routed_nodes)
+        return self.members_cache[1]
+
+    @property
+    def live_nodes(self):
+        """Return the members that are not suspected by the failure detector, the nodes that are waited for."""
+        if not self.suspected:
+            return self.members
+        return [node for node in self.members if node.id not in self.suspected]
+
+    def member_ids(self):
+        """Returns the ids of all the other nodes of the network when they are known: the nodes of the topology or
+           the members of the cluster. None for a fixed number of nodes, their ids are learned from the connections."""
+        if self.next_hops:
+            return set(self.next_hops)
+        with self.cluster_lock:
+            if self.cluster:
+                return set(self.cluster)
+        return None
+
+    def awaited_ids(self):
+        """Returns the ids of the members whose answer a request waits for: all the other members of the network but
+           the suspected ones. A member that is not connected is waited for until it reconnects, is suspected or
+           leaves the cluster. None while the members are not all known yet, no request can be granted then."""
+        if self.joining:
+            return None
+        # Checked on every OK, the ids are only computed again when the connections or the suspected ids have been
+        # replaced (see PeerRegistry and suspect_member). A request compares them with its approvals, a set that
+        # is smaller than them is not compared any further.
+        peers = self.peers.all
+        (cached_peers, cached_suspected, awaited) = self.awaited_cache
+        if cached_peers is peers and cached_suspected is self.suspected:
+            return awaited
+
+        ids = self.member_ids()
+        if ids is None:
+            ids = {node.id for node in self.members}
+            if len(ids | self.suspected) < self.nodes_in_network - 1:
+                ids = None
+        awaited = None if ids is None else frozenset(ids - self.suspected)
+        self.awaited_cache = (peers, self.suspected, awaited)
+        return awaited
+
+    def find_member(self, node_id):
+        """Returns the connection or the stand-in of the node with the given id, or None."""
+        node = self.peers.find_by_id(node_id)
+        if node is None:
+            return self.routed.get(node_id)
+        return node
+
+    def is_member(self, node):
+        """Whether the node is one of the members, data can only be send to them."""
+        return node in self.peers or self.routed.get(node.id) is node
+
+    def set_topology(self, name, degree=None):
+        """Only connect with the neighbours of this node in the topology (see topology.py), the messages to the
+           other nodes are forwarded by the neighbours. Invoked before the node is connected, the nodes must have
+           the ids P1 .. Pn. The algorithm is created again, a tree based algorithm starts from the topology."""
+        topology = Topology(name, self.nodes_in_network, degree)
+        index = get_id_as_int(self.id) - 1
+        self.topology = topology
+        self.neighbour_ids = {"P%d" % (neighbour + 1) for neighbour in topology.neighbours(index)}
+        self.next_hops = {"P%d" % (target + 1): "P%d" % (hop + 1)
+                          for (target, hop) in topology.next_hops(index).items()}
+        self.routed = {node_id: RoutedNode(self, node_id) for node_id in self.next_hops
+                       if node_id not in self.neighbour_ids}
+        self.routed_nodes = list(self.routed.values())
+        self.members_cache = (None, [])
+        self.awaited_cache = (None, None, None)
+        self.mutex = create_mutex(self.mutex.name, self)
+        self.update_mesh_ready()
+
+    def is_neighbour(self, node_id):
+        """Whether the node with the given id is a neighbour, every node is in a full mesh."""
+        return self.neighbour_ids is None or node_id in self.neighbour_ids
+
+    def route(self, node_id, data, origin=None, hops=0):
+        """Send the data to a node that is not a neighbour, wrapped in a ROUTE message to the next hop. When the
+           next hop has not connected yet the message is held until it does."""
+        next_hop_id = self.next_hops.get(node_id)
+        if next_hop_id is None:
+            self.debug_print("route: No route to node %s", node_id)
+            return
+
+        data = {"timestamp": 0, "message": "ROUTE", "to": node_id, "from": origin or self.id, "hops": hops + 1,
+                "data": data}
+        with self.route_lock:
+            next_hop = self.peers.find_by_id(next_hop_id)
+            if next_hop is None:
+                self.pending_routes.setdefault(next_hop_id, []).append(data)
+            else:
+                next_hop.send(data)
+
+    def send_pending_routes(self, node):
+        """Send the ROUTE messages that have been held for the neighbour that has connected."""
+        if self.pending_routes:
+            with self.route_lock:
+                for data in self.pending_routes.pop(node.id, []):
+                    node.send(data)
+
+    def forward(self, node, data):
+        """Handle a ROUTE message that has arrived from the connected node. The data is received when it is for us,
+           otherwise the message is forwarded to the next hop. Invoked by the connection, the election state is not
+           touched."""
+        if data["to"] == self.id:
+            origin = self.find_member(data["from"])
+            if origin is not None:
+                self.receive(origin, data["data"])
+        elif data["hops"] < self.nodes_in_network:
+            if self.metrics.enabled:
+                self.metrics.count("forwarded")
+            if self.tracer is not None:
+                self.tracer.message(FORWARD, self, data["to"], data["data"], self.now())
+            self.route(data["to"], data["data"], data["from"], data["hops"])
+        else:
+            self.debug_print("forward: Dropped a message that went around for %d hops", data["hops"])
+
+    def set_cluster(self, members):
+        """Take the members of the cluster from a member list of (id, host, port) that includes this node (see
+           cluster.py). From now on the number of nodes in the network follows the members."""
+        with self.cluster_lock:
+            self.cluster = {member[0]: (member[1], member[2]) for member in members if member[0] != self.id}
+            self.left.difference_update(self.cluster)
+            self.nodes_in_network = len(self.cluster) + 1
+            self.awaited_cache = (None, None, None)
+        self.update_mesh_ready()
+
+    def add_member(self, id, host, port):
+        """A node has joined the cluster, it is waited for until it has connected."""
+        with self.cluster_lock:
+            self.cluster[id] = (host, port)
+            self.left.discard(id)
+            self.nodes_in_network = len(self.cluster) + 1
+            self.awaited_cache = (None, None, None)
+        self.update_mesh_ready()
+
+    def remove_member(self, id):
+        """A node has left the cluster, it is not waited for anymore."""
+        with self.cluster_lock:
+            self.cluster.pop(id, None)
+            self.left.add(id)
+            self.nodes_in_network = len(self.cluster) + 1
+            self.awaited_cache = (None, None, None)
+        self.update_mesh_ready()
+
+    def cluster_members(self):
+        """Returns the member list of the cluster as (id, host, port), this node included."""
+        with self.cluster_lock:
+            return [(self.id, self.host, self.port)] + [(id, host, port) for (id, (host, port)) in self.cluster.items()]
+
+    def connect_cluster(self, members, timeout=None):
+        """Run as a member of a cluster file (see cluster.py): connect with the members above this node in the list,
+           retrying while they are not listening yet, the members below connect with us. Returns True when the node
+           is connected with all the members before the timeout."""
+        self.post(self.set_cluster, members)
+        ids = [member[0] for member in members]
+        above = [(id, host, port) for (id, host, port) in members[:ids.index(self.id)]]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while not self.terminate_flag.is_set():
+            self.connect_with_nodes([(host, port) for (id, host, port) in above if self.peers.find_by_id(id) is None])
+            if self.wait_for_mesh(CONNECT_RETRY):
+                return True
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+        return False
+
+    def begin_join(self):
+        """Mark the node as joining a cluster before it is started, it does not run the election until it has joined
+           (see join_cluster). A node that is started first could take the critical section on its own."""
+        self.joining = True
+        self.update_mesh_ready()
+
+    def join_cluster(self, host, port, timeout=None):
+        """Join a running cluster through the member at host, port, the seed. The node is not ready until it has
+           connected with all the members the seed answers with. Returns True when that is the case before the
+           timeout. Invoke begin_join before the node is started, the members connect with it while it joins."""
+        if not self.joining and self.ident is not None:
+            raise RuntimeError("join_cluster: The node has been started before begin_join")
+        self.begin_join()
+        if not self.connect_with_node(host, port):
+            return False
+
+        self.peers.find_outbound(host, port).send(join_message(self.id, self.host, self.port))
+        return self.wait_for_mesh(timeout)
+
+    def leave_cluster(self, timeout=None):
+        """Leave the cluster: the node stops requesting, answers the requests it has deferred and tells the members
+           that it leaves, after which it may be stopped. Returns False when that has not been done before the
+           timeout."""
+        left = threading.Event()
+        self.post(self.leave_election, left)
+        self.wake_scheduler()
+        return left.wait(timeout)
+
+    def leave_election(self, left):
+        """Give up the critical sections and the requests of the node and send LEAVE, on the scheduler thread. The
+           deferred requests are answered before the LEAVE, the connections deliver in order."""
+        self.leaving = True
+        self.fail_waiters()
+        for election in [self] + list(self.lock_table):
+            election.holders = 0
+            if election.state != "DO-NOT-WANT":
+                election.release_critical_section()
+
+        for node in self.all_nodes:
+            node.send(leave_message())
+        left.set()
+
+    def connect_members(self, addresses):
+        """Connect with members that have been announced, in the background."""
+        threading.Thread(target=self.connect_with_nodes, args=(addresses,), daemon=True).start()
+
+    def membership_message(self, node, data):
+        """Invoked by a connection when a membership message (see cluster.py) has arrived, it is handled by
+           cluster_message on the scheduler thread, the members are read by the election."""
+        self.post(self.cluster_message, node, data)
+
+    def cluster_message(self, node, data):
+        """Handle a membership message of the connected node, on the scheduler thread (see membership_message). A
+           member that left is let go by member_disconnected once its connection is closed."""
+        message = data["message"]
+        if message == "JOIN":
+            if MEMBER_ID.fullmatch(str(data["id"])) is None:
+                # The requests are ordered by the number of the id, a node without one can not take part
+                self.debug_print("membership_message: Refused the invalid id %s", data["id"])
+                node.stop()
+                return
+
+            # We are the seed: the other members are told about the new node and it gets the member list
+            others = [other for other in self.all_nodes if other is not node]
+            self.add_member(data["id"], data["host"], data["port"])
+            for other in others:
+                other.send(joined_message(data["id"], data["host"], data["port"]))
+            node.send(members_message(self.cluster_members()))
+
+        elif message == "JOINED":
+            self.add_member(data["id"], data["host"], data["port"])
+
+        elif message == "MEMBERS":
+            self.set_cluster(data["members"])
+            self.joining = False
+            self.connect_members([(host, port) for (id, host, port) in data["members"]
+                                  if id != self.id and self.peers.find_by_id(id) is None])
+            self.update_mesh_ready()
+
+        elif message == "LEAVE":
+            self.debug_print("membership_message: %s leaves the cluster", node.id)
+            self.remove_member(node.id)
+            node.stop()
 
-    def debug_print(self, message):
-        """When the debug flag is set to True, all debug messages are printed in the console."""
+    def debug_print(self, message, *args):
+        """When the debug flag is set to True, all debug messages are printed in the console. The message is
+           formatted with the args (printf style) only then, so a disabled debug print costs no string building."""
         if self.debug:
-            print("DEBUG (" + self.id + "): " + message)
+            print("DEBUG (" + self.id + "): " + (message % args if args else str(message)))
 
     def init_server(self):
         """Initialization of the TCP/IP server to receive connections. It binds to the given host and port."""
         print("Initialisation of the Node on port: " + str(self.port) + " on node (" + self.id + ")")
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
         self.sock.settimeout(10.0)
-        self.sock.listen(1)
+        self.sock.listen(LISTEN_BACKLOG)
 
     def print_connections(self):
         """Prints the connection overview of the node. How many inbound and outbound connections have been made."""
@@ -105,13 +515,8 @@ class Node(threading.Thread):
             converted to JSON that is send over to the other node. exclude list gives all the nodes to which this
             data should not be sent."""
         self.timestamp = self.timestamp + 1
-        for n in self.nodes_inbound:
-            if n in exclude:
-                self.debug_print("Node send_to_nodes: Excluding node in sending the message")
-            else:
-                self.send_to_node(n, data)
-
-        for n in self.nodes_outbound:
+        exclude = set(exclude)
+        for n in self.members:
             if n in exclude:
                 self.debug_print("Node send_to_nodes: Excluding node in sending the message")
             else:
@@ -120,15 +525,26 @@ class Node(threading.Thread):
     def send_to_node(self, n, data):
         """ Send the data to the node n if it exists."""
         self.timestamp = self.timestamp + 1
-        if n in self.nodes_inbound or n in self.nodes_outbound:
+        if self.is_member(n):
+            self.lease_clock()
+            if self.tracer is not None:
+                self.tracer.message(SEND, self, n.id, data, self.now())
             n.send(data)
         else:
             self.debug_print("Node send_to_node: Could not send the data, node is not found!")
 
+    def lease_clock(self):
+        """Log a new lease of the clock in the write-ahead log before a timestamp beyond the current lease leaves the
+           node, see wal.py."""
+        if self.wal is not None and self.timestamp > self.wal_clock:
+            self.wal_clock = self.timestamp + CLOCK_LEASE
+            self.wal.append({"type": "clock", "timestamp": self.wal_clock})
+
     def connect_with_node(self, host, port, reconnect=False):
         """ Make a connection with another node that is running on host with port. When the connection is made,
             an event is triggered outbound_node_connected. When the connection is made with the node, it exchanges
             the id's of the node. First we send our id and then we receive the id of the node we are connected to.
+            Afterwards we offer the packet framings we support, old nodes ignore the offer (see framing.py).
             When the connection is made the method outbound_node_connected is invoked. If reconnect is True, the
             node will try to reconnect to the code whenever the node connection was closed. The method returns
             True when the node is connected with the specific host."""
@@ -138,14 +554,15 @@ class Node(threading.Thread):
             return False
 
         # Check if node is already connected with this node!
-        for node in self.nodes_outbound:
-            if node.host == host and node.port == port:
-                print("connect_with_node: Already connected with this node (" + node.id + ").")
-                return True
+        node = self.peers.find_outbound(host, port)
+        if node is not None:
+            print("connect_with_node: Already connected with this node (" + node.id + ").")
+            return True
 
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.debug_print("connecting to %s port %s" % (host, port))
+            sock.settimeout(ID_TIMEOUT)  # A node that hangs must not block us forever
+            self.debug_print("connecting to %s port %s", host, port)
             sock.connect((host, port))
 
             # Basic information exchange (not secure) of the id's of the nodes!
@@ -161,24 +578,26 @@ class Node(threading.Thread):
 
             # Fix bug: Cannot connect with nodes that are already connected with us!
             #          Send message and close the socket.
-            for node in self.nodes_inbound:
-                if node.host == host and node.id == connected_node_id:
-                    print("connect_with_node: This node (" + node.id + ") is already connected with us.")
-                    sock.send("CLOSING: Already having a connection together".encode('utf-8'))
-                    sock.close()
-                    return True
+            node = self.peers.find_by_id(connected_node_id)
+            if node is not None and self.peers.is_inbound(node) and node.host == host:
+                print("connect_with_node: This node (" + node.id + ") is already connected with us.")
+                sock.send("CLOSING: Already having a connection together".encode('utf-8'))
+                sock.close()
+                return True
 
+            # Register the connection before it starts receiving, otherwise replies to its first messages are lost
             thread_client = self.create_new_connection(sock, connected_node_id, host, port)
+            self.peers.add(thread_client, inbound=False)
             thread_client.start()
+            thread_client.offer_framing()
 
-            self.nodes_outbound.append(thread_client)
             self.outbound_node_connected(thread_client)
 
             # If reconnection to this host is required, it will be added to the list!
             if reconnect:
                 self.debug_print("connect_with_node: Reconnection check is enabled on node " + host + ":" + str(port))
                 self.reconnect_to_nodes.append({
-                    "host": host, "port": port, "tries": 0
+                    "host": host, "port": port, "trials": 0
                 })
 
             return True
@@ -187,11 +606,71 @@ class Node(threading.Thread):
             self.debug_print("TcpServer.connect_with_node: Could not connect with node. (" + str(e) + ")")
             return False
 
+    def connect_with_nodes(self, addresses, reconnect=False):
+        """Connect with all the nodes at the (host, port) addresses. The connections, including their id exchange,
+           are made in parallel. Returns the results of connect_with_node in the order of the addresses."""
+        if not addresses:
+            return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(addresses), CONNECT_WORKERS)) as executor:
+            return list(executor.map(lambda address: self.connect_with_node(address[0], address[1], reconnect),
+                                     addresses))
+
+    def wait_for_mesh(self, timeout=None):
+        """Wait until the node is connected with all the other nodes of the network. Returns False on a timeout."""
+        return self.mesh_ready.wait(timeout)
+
+    def update_mesh_ready(self):
+        """Set or clear the mesh ready barrier after a connection has been made or lost."""
+        neighbours = self.nodes_in_network - 1 if self.neighbour_ids is None else len(self.neighbour_ids)
+        if not self.joining and len({node.id for node in self.peers.all} | self.suspected) >= neighbours:
+            if not self.mesh_ready.is_set():
+                self.mesh_ready.set()
+                self.post(self.finish_recovery)
+                self.post(self.resume_waiters)
+                self.node_mesh_ready()
+        else:
+            self.mesh_ready.clear()
+
+    def open_wal(self, path, sync=SYNC_BATCH):
+        """Log the election state to the write-ahead log at path (see wal.py), before the node is started. When the
+           log contains the state of a node that crashed, its clock is restored and the requests it had deferred are
+           answered once the node is connected with all the other nodes again. The node always restarts in
+           DO-NOT-WANT, the algorithm is created again from the recovered clock. Returns True when a state has been
+           recovered."""
+        self.wal = WriteAheadLog(path, sync)
+        recovered = self.wal.recover()
+        if recovered is None:
+            return False
+
+        self.timestamp = max(self.timestamp, recovered["clock"])
+        self.wal_clock = recovered["clock"]
+        self.recovered_clock = self.timestamp
+        self.mutex = create_mutex(self.mutex.name, self)
+        self.recovered_deferred = [tuple(deferred) for deferred in recovered["deferred"]]
+        self.debug_print("open_wal: Recovered from %s, timestamp %d, %d deferred requests", recovered["state"],
+                         self.timestamp, len(self.recovered_deferred))
+        return True
+
+    def finish_recovery(self):
+        """Answer the requests that were deferred before the crash, the requesters may still be waiting for them.
+           The OK carries the timestamp of the request, so a requester that has moved on to a new request ignores
+           it."""
+        if not self.recovered_deferred:
+            return
+
+        for (node_id, request_timestamp) in self.recovered_deferred:
+            node = self.find_member(node_id)
+            if node is not None:
+                self.send_to_node(node, {"timestamp": request_timestamp, "message": "OK"})
+        self.recovered_deferred = []
+        self.wal.append({"type": "state", "state": self.state, "request_timestamp": self.request_timestamp})
+
     def disconnect_with_node(self, node):
         """Disconnect the TCP/IP connection with the specified node. It stops the node and joins the thread.
            The node will be deleted from the nodes_outbound list. Before closing, the method
            node_disconnect_with_outbound_node is invoked."""
-        if node in self.nodes_outbound:
+        if self.peers.is_outbound(node):
             self.node_disconnect_with_outbound_node(node)
             node.stop()
 
@@ -203,6 +682,8 @@ class Node(threading.Thread):
         """Stop this node and terminate all the connected nodes."""
         self.node_request_to_stop()
         self.terminate_flag.set()
+        self.wake_scheduler()
+        self.wake_main_loop()
 
     # This method can be overrided when a different nodeconnection is required!
     def create_new_connection(self, connection, id, host, port):
@@ -214,163 +695,613 @@ class Node(threading.Thread):
 
     def reconnect_nodes(self):
         """This method checks whether nodes that have the reconnection status are still connected. If not
-           connected these nodes are started again."""
-        for node_to_check in self.reconnect_to_nodes:
-            found_node = False
-            self.debug_print(
-                "reconnect_nodes: Checking node " + node_to_check["host"] + ":" + str(node_to_check["port"]))
-
-            for node in self.nodes_outbound:
-                if node.host == node_to_check["host"] and node.port == node_to_check["port"]:
-                    found_node = True
-                    node_to_check["trials"] = 0  # Reset the trials
-                    self.debug_print("reconnect_nodes: Node " + node_to_check["host"] + ":" + str(
-                        node_to_check["port"]) + " still running!")
-
-            if not found_node:  # Reconnect with node
+           connected these nodes are started again. After a failed trial the next one waits for an exponential
+           backoff (see failuredetector.py)."""
+        now = time.monotonic()
+        for node_to_check in list(self.reconnect_to_nodes):
+            self.debug_print("reconnect_nodes: Checking node %s:%s", node_to_check["host"], node_to_check["port"])
+
+            if self.peers.find_outbound(node_to_check["host"], node_to_check["port"]) is not None:
+                node_to_check["trials"] = 0  # Reset the trials
+                node_to_check["next_trial"] = 0.0
+                self.debug_print("reconnect_nodes: Node %s:%s still running!", node_to_check["host"],
+                                 node_to_check["port"])
+
+            elif now < node_to_check.get("next_trial", 0.0):
+                self.debug_print("reconnect_nodes: Backing off from node %s:%s", node_to_check["host"],
+                                 node_to_check["port"])
+
+            else:  # Reconnect with node
                 node_to_check["trials"] += 1
                 if self.node_reconnection_error(node_to_check["host"], node_to_check["port"], node_to_check["trials"]):
-                    self.connect_with_node(node_to_check["host"],
-                                           node_to_check["port"])  # Perform the actual connection
+                    # Perform the actual connection, a node that is connected with us instead is tried again later
+                    self.connect_with_node(node_to_check["host"], node_to_check["port"])
+                    if self.peers.find_outbound(node_to_check["host"], node_to_check["port"]) is None:
+                        node_to_check["next_trial"] = now + reconnect_backoff(node_to_check["trials"], self.random)
 
                 else:
-                    self.debug_print("reconnect_nodes: Removing node (" + node_to_check["host"] + ":" + str(
-                        node_to_check["port"]) + ") from the reconnection list!")
+                    self.debug_print("reconnect_nodes: Removing node (%s:%s) from the reconnection list!",
+                                     node_to_check["host"], node_to_check["port"])
                     self.reconnect_to_nodes.remove(node_to_check)
 
-    def run(self):
-        """The main loop of the thread that deals with connections from other nodes on the network. When a
-           node is connected it will exchange the node id's. First we receive the id of the connected node
-           and secondly we will send our node id to the connected node. When connected the method
-           inbound_node_connected is invoked."""
-        while not self.terminate_flag.is_set():  # Check whether the thread needs to be closed
+    def enable_failure_detector(self, interval=HEARTBEAT_INTERVAL, threshold=PHI_THRESHOLD):
+        """Send heartbeats every interval seconds and suspect the connected nodes whose phi passes the threshold (see
+           failuredetector.py). Use None as interval to disable it again."""
+        self.heartbeat_interval = interval
+        self.phi_threshold = threshold
+        for node in self.all_nodes:
+            node.detector = PhiAccrualDetector(interval or HEARTBEAT_INTERVAL)
+
+    def loop_timeout(self):
+        """Seconds the main loop may wait for a connection before it has to check the peers again or the next
+           reconnection is due."""
+        timeout = ID_TIMEOUT if self.heartbeat_interval is None else min(ID_TIMEOUT, self.heartbeat_interval)
+        due = self.next_reconnection()
+        if due is not None:
+            timeout = min(timeout, max(due - time.monotonic(), 0.0))
+        return timeout
+
+    def next_reconnection(self):
+        """Returns the time (time.monotonic) the next reconnection is due, None when all the nodes to reconnect are
+           connected."""
+        return min((entry.get("next_trial", 0.0) for entry in list(self.reconnect_to_nodes)
+                    if self.peers.find_outbound(entry["host"], entry["port"]) is None), default=None)
+
+    def wake_main_loop(self):
+        """Wake up the main loop so that it reconnects a node that has disconnected right away, see loop_timeout.
+           May be invoked from any thread."""
+        if self.loop_wakeup is not None:
             try:
-                self.debug_print("Node: Wait for incoming connection")
-                connection, client_address = self.sock.accept()
+                self.loop_wakeup[1].send(b'\0')
+            except OSError:
+                pass  # The node has stopped
+
+    def check_peers(self):
+        """Send the heartbeats and suspect the connected nodes that have been silent for too long, invoked by the main
+           loop. Does nothing when the failure detector is disabled."""
+        if self.heartbeat_interval is None:
+            return
+
+        now = time.monotonic()
+        if now - self.last_heartbeat < self.heartbeat_interval:
+            return
+
+        self.last_heartbeat = now
+        for node in self.all_nodes:
+            phi = node.detector.phi(now)
+            if phi > self.phi_threshold:
+                self.suspect_node(node, phi)
+                continue
+
+            node.heartbeat()
+            if node.id in self.suspected and node.detector.heartbeats > 0:
+                self.trust_node(node)
+
+    def suspect_node(self, node, phi):
+        """The connected node is suspected to have failed. It is disconnected and no longer waited for until a
+           heartbeat of it arrives over a new connection. A node we connected to ourselves is reconnected with an
+           exponential backoff in the number of times it has been suspected, see reconnect_nodes."""
+        silence = node.detector.silence()
+        self.debug_print("suspect_node: %s silent for %.3f seconds, phi %.1f", node.id, silence, phi)
+        if self.metrics.enabled:
+            self.metrics.count("suspected")
+            self.metrics.observe("detection", silence)
+
+        if self.peers.is_outbound(node):
+            entry = self.add_reconnect_entry(node)
+            entry["suspicions"] = entry.get("suspicions", 0) + 1
+            entry["next_trial"] = time.monotonic() + reconnect_backoff(entry["suspicions"], self.random)
+
+        # Suspected before the connection is closed, see member_disconnected
+        self.post(self.suspect_member, node, phi, silence)
+        node.stop()
+
+    def suspect_member(self, node, phi, silence):
+        """Stop waiting for the suspected node, on the scheduler thread (see suspect_node)."""
+        self.suspected = self.suspected | {node.id}
+        if self.callback is not None:
+            self.callback("node_suspected", self, node, {"phi": phi, "silence": silence})
+
+    def trust_node(self, node):
+        """A heartbeat of a suspected node has arrived, it is waited for again."""
+        self.debug_print("trust_node: %s", node.id)
+        entry = self.find_reconnect_entry(node)
+        if entry is not None:
+            entry["suspicions"] = 0
+        self.post(self.trust_member, node)
+
+    def trust_member(self, node):
+        """Wait for the trusted node again, on the scheduler thread (see trust_node). The main loop may trust it more
+           than once before this has run."""
+        if node.id not in self.suspected:
+            return
+        self.suspected = self.suspected - {node.id}
+        if self.callback is not None:
+            self.callback("node_trusted", self, node, {})
+
+    def find_reconnect_entry(self, node):
+        """Returns the entry of the reconnection list with the address of the node, or None."""
+        return next((entry for entry in self.reconnect_to_nodes
+                     if (entry["host"], entry["port"]) == (node.host, node.port)), None)
 
-                # Basic information exchange (not secure) of the id's of the nodes!
-                connected_node_id = connection.recv(4096).decode('utf-8')
-                connection.send(self.id.encode('utf-8'))
+    def add_reconnect_entry(self, node):
+        """Make sure the node is reconnected when the connection is lost, returns its reconnection entry."""
+        entry = self.find_reconnect_entry(node)
+        if entry is None:
+            entry = {"host": node.host, "port": node.port, "trials": 0}
+            self.reconnect_to_nodes.append(entry)
+        return entry
+
+    def run(self):
+        """The main loop of the thread that deals with connections from other nodes on the network. The server
+           socket and the accepted connections that have not send their id yet are watched with a selector, so
+           the accept loop never waits for the id exchange of a single node. A transport that serves its connections
+           on this thread registers them with the same selector, see create_selector and handle_io. The election is
+           driven by a separate scheduler thread."""
+        scheduler = threading.Thread(target=self.run_scheduler)
+        scheduler.start()
 
-                thread_client = self.create_new_connection(
-                    connection, connected_node_id, client_address[0], client_address[1])
-                thread_client.start()
+        selector = self.create_selector()
+        self.sock.setblocking(False)
+        selector.register(self.sock, selectors.EVENT_READ)
 
-                self.nodes_inbound.append(thread_client)
-                self.inbound_node_connected(thread_client)
+        # Accepted connections waiting for their id: socket -> (client address, time accepted)
+        pending = {}
 
-            except socket.timeout:
-                self.debug_print('Node: Connection timeout!')
-            except Exception as e:
-                raise e
+        while not self.terminate_flag.is_set():  # Check whether the thread needs to be closed
+            self.debug_print("Node: Wait for incoming connection")
+            for (key, events) in selector.select(self.loop_timeout()):
+                if key.fileobj is self.sock:
+                    try:
+                        connection, client_address = self.sock.accept()
+                    except BlockingIOError:
+                        continue
+                    connection.setblocking(False)
+                    selector.register(connection, selectors.EVENT_READ)
+                    pending[connection] = (client_address, time.monotonic())
+
+                elif key.fileobj in pending:
+                    selector.unregister(key.fileobj)
+                    (client_address, accepted_at) = pending.pop(key.fileobj)
+                    self.accept_connection(key.fileobj, client_address)
+
+                else:
+                    self.handle_io(key, events)
 
+            for (connection, (client_address, accepted_at)) in list(pending.items()):
+                if time.monotonic() - accepted_at > ID_TIMEOUT:
+                    self.debug_print('Node: Connection timeout!')
+                    selector.unregister(connection)
+                    del pending[connection]
+                    connection.close()
+
+            self.check_peers()
             self.reconnect_nodes()
-            if len(self.all_nodes) == self.nodes_in_network - 1:
-                self.election()
-            # All nodes have not connected
-            time.sleep(0.01)
+
+        for connection in pending:
+            connection.close()
 
         # Thread needs to be terminated
+        scheduler.join()
         self.close()
+        selector.close()
+
+    def create_selector(self):
+        """Returns the selector of the main loop, see run. The connections of the threaded transport are served by
+           their own threads, they are not registered with it, only the socket pair of wake_main_loop is."""
+        selector = selectors.DefaultSelector()
+        self.loop_wakeup = socket.socketpair()
+        self.loop_wakeup[0].setblocking(False)
+        selector.register(self.loop_wakeup[0], selectors.EVENT_READ)
+        return selector
+
+    def handle_io(self, key, events):
+        """Handle the events of a file object that the transport has registered with the selector of the main loop,
+           besides the server socket and the accepted connections. The threaded transport only registers the wake
+           ups, see wake_main_loop."""
+        if key.fileobj is self.loop_wakeup[0]:
+            try:
+                while self.loop_wakeup[0].recv(4096):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    def accept_connection(self, connection, client_address):
+        """Exchange the id's with a node that connected with us, invoked when its id has arrived. First we receive
+           the id of the connected node and secondly we will send our node id to the connected node. When connected
+           the method inbound_node_connected is invoked. The connection holds its packets until the connected node
+           has send its first packet, otherwise they could be received together with our id."""
+        try:
+            # Basic information exchange (not secure) of the id's of the nodes!
+            connected_node_id = connection.recv(4096).decode('utf-8')
+            if connected_node_id == "":
+                raise ConnectionError("closed before sending its id")
+            connection.setblocking(True)
+            connection.send(self.id.encode('utf-8'))
+
+        except Exception as e:
+            self.debug_print("Node accept_connection: Could not exchange the id's (" + str(e) + ")")
+            connection.close()
+            return
+
+        thread_client = self.create_new_connection(
+            connection, connected_node_id, client_address[0], client_address[1])
+        thread_client.hold_until_received()
+        self.peers.add(thread_client, inbound=True)
+        thread_client.start()
+
+        self.inbound_node_connected(thread_client)
+
+    def run_scheduler(self):
+        """Main loop of the election scheduler thread, the owner of the election state. It waits for the next task
+           of the mailbox until the next timed transition of the election, there is no polling. The election is
+           re-evaluated after every task."""
+        while not self.terminate_flag.is_set():
+            try:
+                task = self.mailbox.get(timeout=self.scheduler_timeout())
+            except queue.Empty:
+                continue
+
+            if task is not None:
+                (handler, args) = task
+                if self.metrics.enabled:
+                    self.metrics.observe("mailbox", self.mailbox.qsize())
+                handler(*args)
+
+        self.fail_waiters()
+
+    def wake_scheduler(self):
+        """Wake up the scheduler so that it re-evaluates the election immediately."""
+        self.mailbox.put(None)
+
+    def post(self, handler, *args):
+        """Let the scheduler thread run handler(*args), the way other threads change the election state. The tasks
+           run in the order they have been posted."""
+        self.mailbox.put((handler, args))
+
+    def receive(self, node, data):
+        """Invoked by a connection when a message of the mutual exclusion has arrived, it is handled by node_message
+           on the scheduler thread."""
+        self.post(self.node_message, node, data)
+
+    def scheduler_timeout(self):
+        """Runs the election and returns how long the scheduler may sleep before the next timed transition. None
+           means that there is no timed transition pending and the scheduler only has to wake up on an event."""
+        if not self.mesh_ready.is_set() or self.leaving:
+            # All nodes have not connected, or the node leaves the cluster
+            return None
+
+        if not self.load_generator:
+            return None
+
+        self.election()
+        if self.state == "WANTED":
+            return None
+        return max(self.next_execution - self.now(), 0)
 
     def election(self):
-        if self.next_execution - time.time() <= 0:
+        """Performs the timed transitions of the election: DO-NOT-WANT -> WANTED when the time-out interval has
+           passed and HELD -> DO-NOT-WANT when the critical section timeout has passed. WANTED -> HELD is not timed,
+           it is done by node_message as soon as the last OK arrives."""
+        if self.next_execution - self.now() <= 0:
             if self.state == "DO-NOT-WANT":
-                self.state = "WANTED"
-                self.request_timestamp = self.timestamp
-                self.send_to_nodes(data={
-                    "timestamp": self.request_timestamp,
-                    "message": "GIVE"
-                })
+                self.request_critical_section()
             elif self.state == "WANTED":
-                if len(self.all_nodes) == self.election_approvals:
-                    self.election_approvals = 0
-                    self.state = "HELD"
+                pass
             elif self.state == "HELD":
-                self.state = "DO-NOT-WANT"
-                for (node, data) in self.request_que:
-                    self.node_message(node, data)
+                self.release_critical_section()
+                if self.request_next:
+                    # The OKs of the release are piggybacked on the request (see mutex.py)
+                    self.request_critical_section()
             else:
                 raise RuntimeError("System in invalid state")
 
-            self.next_execution = time.time() + self.get_timeout()
+    def request_critical_section(self):
+        """Move to WANTED and let the mutual exclusion algorithm ask for the critical section."""
+        self.state = "WANTED"
+        self.election_approvals = 0
+        # The request is an event of the clock, its timestamp is later than every request that has been received
+        self.timestamp = self.timestamp + 1
+        self.request_timestamp = self.timestamp
+        waiter = self.next_waiter(self)
+        if waiter is not None:
+            (self.request_priority, self.request_mode) = (waiter.priority, waiter.mode)
+        else:
+            self.request_priority = self.priority
+            self.request_mode = SHARED if self.read_ratio and self.random.random() < self.read_ratio else EXCLUSIVE
+        self.node_state_changed()
+        self.mutex.request()
+
+    def enter_critical_section(self):
+        """Move to HELD, invoked by the mutual exclusion algorithm when the critical section is granted."""
+        self.election_approvals = 0
+        self.state = "HELD"
+        self.next_execution = self.now() + self.get_timeout()
+        self.node_state_changed()
+        if not self.load_generator:
+            self.grant_waiter(self)
+        self.wake_scheduler()
+
+    def release_critical_section(self, request_waiter=True):
+        """Move to DO-NOT-WANT, the mutual exclusion algorithm immediately answers the deferred requests.
+            request_waiter: Whether the caller requests again in the same step for the next waiter, when it does not
+                            the answers can not wait for the request."""
+        if self.metrics.enabled:
+            self.metrics.observe("request_que", len(self.request_que))
+        self.state = "DO-NOT-WANT"
+        self.next_execution = self.now() + self.get_timeout()
+        if self.leaving:
+            self.request_next = False
+        elif self.load_generator:
+            # Without a time-out interval the node requests again in the same step, see election
+            self.request_next = self.next_execution <= self.now() and self.mesh_ready.is_set()
+        else:
+            # The next waiter requests again in the same step, see release_holder
+            self.request_next = request_waiter and len(self.waiters) > 0 and self.mesh_ready.is_set()
+        self.node_state_changed()
+        self.mutex.release()
+
+    def now(self):
+        """The clock of the election timers, a simulation replaces it with its virtual clock."""
+        return time.time()
 
     def get_timeout(self):
         if self.state == "DO-NOT-WANT" or self.state == "WANTED":
-            return random.uniform(5.0, self.time_p)
+            return self.random.uniform(self.time_p_min, self.time_p)
         elif self.state == "HELD":
-            return random.uniform(10, self.time_cs)
+            return self.random.uniform(self.time_cs_min, self.time_cs)
         raise RuntimeError("System in invalid state")
 
     def outbound_node_connected(self, node):
         """This method is invoked when a connection with a outbound node was successfull. The node made
            the connection itself."""
-        self.debug_print("outbound_node_connected: " + node.id)
+        self.debug_print("outbound_node_connected: %s", node.id)
+        if self.metrics.enabled:
+            node.ping()
         if self.callback is not None:
             self.callback("outbound_node_connected", self, node, {})
+        self.node_connected(node)
+        self.wake_scheduler()
 
     def inbound_node_connected(self, node):
         """This method is invoked when a node successfully connected with us."""
-        self.debug_print("inbound_node_connected: " + node.id)
+        self.debug_print("inbound_node_connected: %s", node.id)
+        if self.metrics.enabled:
+            node.ping()
         if self.callback is not None:
             self.callback("inbound_node_connected", self, node, {})
+        self.node_connected(node)
+        self.wake_scheduler()
+
+    def node_connected(self, node):
+        """Let the mutual exclusion algorithm know about the new connection and update the mesh ready barrier."""
+        self.send_pending_routes(node)
+        self.post(self.mutex_connected, node)
+        self.update_mesh_ready()
+
+    def mutexes(self):
+        """Returns the mutual exclusion algorithm of the node and those of the resources of the lock table."""
+        return [self.mutex] + [resource.mutex for resource in self.lock_table]
+
+    def mutex_connected(self, node):
+        for mutex in self.mutexes():
+            mutex.on_connected(node)
+
+    def mutex_suspected(self, node):
+        for mutex in self.mutexes():
+            mutex.on_suspected(node)
 
     def node_disconnected(self, node):
         """While the same nodeconnection class is used, the class itself is not able to
            determine if it is a inbound or outbound connection. This function is making
            sure the correct method is used."""
-        self.debug_print("node_disconnected: " + node.id)
+        self.debug_print("node_disconnected: %s", node.id)
 
-        if node in self.nodes_inbound:
-            del self.nodes_inbound[self.nodes_inbound.index(node)]
+        inbound = self.peers.remove(node)
+        if inbound is True:
             self.inbound_node_disconnected(node)
-
-        if node in self.nodes_outbound:
-            del self.nodes_outbound[self.nodes_outbound.index(node)]
+        elif inbound is False:
             self.outbound_node_disconnected(node)
+            if self.heartbeat_interval is not None and not self.terminate_flag.is_set():
+                # The connected node may have suspected us, with the failure detector the connection is restored
+                self.add_reconnect_entry(node)
+            if self.find_reconnect_entry(node) is not None:
+                self.wake_main_loop()
+        if inbound is not None and not self.terminate_flag.is_set():
+            self.post(self.member_disconnected, node)
+
+    def member_disconnected(self, node):
+        """The connection with the node has been lost, on the scheduler thread after its suspicion or its leave (see
+           node_disconnected). A node that is suspected or that left is not waited for anymore."""
+        if node.id in self.suspected or node.id in self.left:
+            self.mutex_suspected(node)
+        self.update_mesh_ready()
 
     def inbound_node_disconnected(self, node):
         """This method is invoked when a node, that was previously connected with us, is in a disconnected
            state."""
-        self.debug_print("inbound_node_disconnected: " + node.id)
+        self.debug_print("inbound_node_disconnected: %s", node.id)
         if self.callback is not None:
             self.callback("inbound_node_disconnected", self, node, {})
 
     def outbound_node_disconnected(self, node):
         """This method is invoked when a node, that we have connected to, is in a disconnected state."""
-        self.debug_print("outbound_node_disconnected: " + node.id)
+        self.debug_print("outbound_node_disconnected: %s", node.id)
         if self.callback is not None:
             self.callback("outbound_node_disconnected", self, node, {})
 
+    def defer_request(self, node, data):
+        """Put the request of the node in the request queue, it is answered when we release the critical
+           section. The queue is a heap in the order of the requests (see mutex.py)."""
+        push_request(self.request_que, node, data)
+        if self.wal is not None:
+            self.wal.append({"type": "defer", "id": node.id, "timestamp": data["timestamp"]})
+
     def node_message(self, node, data):
-        """This method is invoked when a node send us a message."""
-        self.timestamp = max(self.timestamp, data["timestamp"])
+        """This method is invoked when a node send us a message, on the scheduler thread (see receive). The messages
+           of the election are handled by the mutual exclusion algorithm, those of a named resource by the algorithm
+           of the resource."""
+        self.timestamp = max(self.timestamp + 1, data["timestamp"])
+        if self.tracer is not None:
+            self.tracer.message(RECEIVE, self, node.id, data, self.now())
+        if "resource" in data:
+            self.lock_table.get(data["resource"]).mutex.on_message(node, data)
+        else:
+            self.mutex.on_message(node, data)
+
+    def acquire(self, name=None, timeout=None, priority=None, mode=EXCLUSIVE):
+        """Wait until this node holds the critical section, or the named resource of the lock table (see
+           locktable.py) when a name is given. Returns False when it has not been granted within timeout seconds or
+           the node stops, the request is then cancelled. The critical section of the node itself can only be
+           acquired when the load generator is disabled. May be invoked from any thread but the scheduler thread,
+           on an event loop use acquire_async. The callers with a higher priority go first, the priority of the node
+           when it is None. With mode SHARED the caller only reads, it may hold the critical section together with
+           other readers (see mutex.py)."""
+        self.check_acquire(name, mode)
+        waiter = Waiter(priority=self.priority if priority is None else priority, mode=mode)
+        self.post(self.start_waiter, name, waiter)
+        if waiter.event.wait(timeout) and waiter.granted:
+            return True
+        self.post(self.cancel_waiter, name, waiter)
+        return False
+
+    async def acquire_async(self, name=None, timeout=None, priority=None, mode=EXCLUSIVE):
+        """Asyncio version of acquire, the task that awaits it may be cancelled."""
+        self.check_acquire(name, mode)
+        waiter = Waiter(asyncio.get_running_loop(), self.priority if priority is None else priority, mode)
+        self.post(self.start_waiter, name, waiter)
+        try:
+            if await asyncio.wait_for(asyncio.shield(waiter.future), timeout):
+                return True
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            self.post(self.cancel_waiter, name, waiter)
+            raise
+        self.post(self.cancel_waiter, name, waiter)
+        return False
+
+    def release(self, name=None):
+        """Release the critical section, or the named resource, that has been acquired. May be invoked from any
+           thread. Held SHARED it is released when the last reader releases."""
+        self.post(self.release_holder, name)
+
+    def critical_section(self, name=None, timeout=None, priority=None, mode=EXCLUSIVE):
+        """Returns a context manager that acquires the critical section, or the named resource, for the duration
+           of a with or async with block. Raises TimeoutError when it is not granted within timeout seconds."""
+        return CriticalSection(self, name, timeout, priority, mode)
+
+    def check_acquire(self, name, mode=EXCLUSIVE):
+        if name is None and self.load_generator:
+            raise RuntimeError("The critical section of the node is taken by the load generator")
+        if mode not in MODES:
+            raise ValueError("Unknown mode: " + str(mode))
+
+    def election_of(self, name):
+        """Returns the election of the named resource, or the node itself when name is None. The node and the
+           resources share the interface the waiters need: state, waiters, holders and the transitions."""
+        return self if name is None else self.lock_table.get(name)
+
+    def start_waiter(self, name, waiter):
+        election = self.election_of(name)
+        election.waiters.append(waiter)
+        self.request_for_waiters(election)
+
+    def next_waiter(self, election, mode=EXCLUSIVE):
+        """Returns the first of the most urgent waiters of the election that may hold it in the mode, any waiter when
+           it is EXCLUSIVE and the readers when it is SHARED, or None. A new request takes the priority and the mode
+           of the next waiter, they do not change while it waits."""
+        return max((waiter for waiter in election.waiters if mode == EXCLUSIVE or waiter.mode == SHARED),
+                   key=lambda waiter: waiter.priority, default=None)
+
+    def request_for_waiters(self, election):
+        """Request the critical section of the election when a caller is waiting for it and it is not requested or
+           held already. The election only starts once the mesh is ready."""
+        if election.waiters and election.state == "DO-NOT-WANT" and self.mesh_ready.is_set():
+            election.request_critical_section()
+
+    def resume_waiters(self):
+        """Request the critical sections that have been waited for before the mesh was ready."""
+        for election in [self] + list(self.lock_table):
+            self.request_for_waiters(election)
+
+    def grant_waiter(self, election):
+        """The critical section of the election has been granted, it is handed to the next waiter. Granted SHARED it
+           is handed to all the readers that are waiting at once. When there is no waiter that may hold it, they
+           have given up, it is released again right away."""
+        waiter = self.next_waiter(election, election.request_mode)
+        while waiter is not None:
+            election.waiters.remove(waiter)
+            election.holders += 1
+            waiter.wake(True)
+            waiter = self.next_waiter(election, SHARED) if election.request_mode == SHARED else None
+        if election.holders == 0:
+            # A writer may still wait, it requests after the algorithm has returned. It may give up in the mean time,
+            # the answers of the release are sent right away instead of waiting for its request.
+            election.release_critical_section(request_waiter=False)
+            self.post(self.request_for_waiters, election)
+
+    def release_holder(self, name):
+        """One of the callers that hold the critical section of the election releases it, the last one releases the
+           critical section itself."""
+        election = self.election_of(name)
+        if election.holders == 0 or election.state != "HELD":
+            self.debug_print("release_holder: The critical section is not held")
+            return
+        election.holders -= 1
+        if election.holders == 0:
+            election.release_critical_section()
+            self.request_for_waiters(election)
+
+    def cancel_waiter(self, name, waiter):
+        """The caller gave up waiting, the critical section is released for it when it has been granted in the mean
+           time. A waiter that is still queued is dropped."""
+        election = self.election_of(name)
+        if waiter.granted:
+            self.release_holder(name)
+        elif waiter in election.waiters:
+            election.waiters.remove(waiter)
+
+    def fail_waiters(self):
+        """Wake up all the callers that are still waiting, the node has stopped."""
+        for election in [self] + list(self.lock_table):
+            while election.waiters:
+                election.waiters.popleft().wake(False)
+
+    def node_state_changed(self):
+        """This method is invoked when the election state of the node has changed."""
+        self.debug_print("node_state_changed: %s", self.state)
+        if self.wal is not None:
+            self.wal.append({"type": "state", "state": self.state, "request_timestamp": self.request_timestamp})
+        if self.metrics.enabled:
+            now = time.perf_counter()
+            self.metrics.observe(self.last_transition[0] + "->" + self.state, now - self.last_transition[1])
+            self.metrics.mark(self.state)
+            self.last_transition = (self.state, now)
+        if self.tracer is not None:
+            self.tracer.state(self, self.state, None, self.request_timestamp, self.now())
+        if self.callback is not None:
+            self.callback("node_state_changed", self, {}, {"state": self.state, "mode": self.request_mode})
 
-        if data["message"] == "GIVE":
-            if self.state == "DO-NOT-WANT":
-                self.send_ok_response(node)
-            elif self.state == "HELD":
-                self.request_que.append((node, data))
-            elif self.state == "WANTED":
-                if data["timestamp"] == self.request_timestamp:
-                    # In case of equal timestamps, the process with the lower ID wins.
-                    if get_id_as_int(self.id) > get_id_as_int(node.id):
-                        self.request_que.append((node, data))
-                    else:
-                        self.send_ok_response(node)
-                elif data["timestamp"] < self.request_timestamp:
-                    # This nodes request timestamp is bigger
-                    self.send_ok_response(node)
-                else:
-                    # This nodes timestamp is smaller, que the request
-                    self.request_que.append((node, data))
-        elif data["message"] == "OK":
-            self.election_approvals += 1
+    def resource_state_changed(self, resource):
+        """This method is invoked when the state of a named resource of the lock table has changed."""
+        self.debug_print("resource_state_changed: %s %s", resource.name, resource.state)
+        if self.tracer is not None:
+            self.tracer.state(self, resource.state, resource.name, resource.request_timestamp, self.now())
+        if self.callback is not None:
+            self.callback("resource_state_changed", self, {}, {"resource": resource.name, "state": resource.state,
+                                                               "mode": resource.request_mode})
+
+    def node_mesh_ready(self):
+        """This method is invoked when the node has become connected with all the other nodes of the network."""
+        self.debug_print("node_mesh_ready")
+        if self.callback is not None:
+            self.callback("node_mesh_ready", self, {}, {})
 
     def node_disconnect_with_outbound_node(self, node):
         """This method is invoked just before the connection is closed with the outbound node. From the node
            this request is created."""
-        self.debug_print("node wants to disconnect with oher outbound node: " + node.id)
+        self.debug_print("node wants to disconnect with oher outbound node: %s", node.id)
         if self.callback is not None:
             self.callback("node_disconnect_with_outbound_node", self, node, {})
 
@@ -387,10 +1318,36 @@ class Node(threading.Thread):
            specific logic to take action when a lot of trials have been done. If the method returns True, the
            node will try to perform the reconnection. If the method returns False, the node will stop reconnecting
            to this node. The node will forever tries to perform the reconnection."""
-        self.debug_print("node_reconnection_error: Reconnecting to node " + host + ":" + str(port) + " (trials: " + str(
-            trials) + ")")
+        self.debug_print("node_reconnection_error: Reconnecting to node %s:%s (trials: %d)", host, port, trials)
         return True
 
+    def enable_metrics(self, enabled=True):
+        """Enable or disable the instrumentation of the node and of all its connections."""
+        self.metrics.enabled = enabled
+        for node in self.all_nodes:
+            node.metrics.enabled = enabled
+        self.last_transition = (self.state, time.perf_counter())
+
+    def enable_trace(self, tracer):
+        """Record the messages and the state transitions of the node to the trace recorder, shared by the nodes of
+           a process (see tracing.py). Use None to disable it again, the recorder is closed by its owner."""
+        self.tracer = tracer
+
+    def get_stats(self):
+        """Returns a snapshot of the metrics of the node, its state and request queue, and the metrics of every
+           connection by the id of the connected node."""
+        stats = self.metrics.snapshot()
+        stats["state"] = self.state
+        stats["request_que"] = len(self.request_que)
+        stats["resources"] = len(self.lock_table)
+        stats["peers"] = {node.id: node.get_stats() for node in self.all_nodes}
+        return stats
+
+    def ping_nodes(self):
+        """Measure the round trip time to all the connected nodes, see NodeConnection.ping."""
+        for node in self.all_nodes:
+            node.ping()
+
     def __str__(self):
         return f"{self.id},{self.state}"
 
@@ -399,23 +1356,34 @@ class Node(threading.Thread):
 
     def close(self):
         print("Node stopping...")
-        for t in self.nodes_inbound:
-            t.stop()
-
-        for t in self.nodes_outbound:
+        nodes = self.all_nodes
+        for t in nodes:
             t.stop()
 
         time.sleep(1)
 
-        for t in self.nodes_inbound:
-            t.join()
-
-        for t in self.nodes_outbound:
+        for t in nodes:
             t.join()
 
         self.sock.settimeout(None)
         self.sock.close()
+        if self.loop_wakeup is not None:
+            for wakeup_socket in self.loop_wakeup:
+                wakeup_socket.close()
+        if self.wal is not None:
+            self.wal.close()
         print("Node stopped")
 
     def send_ok_response(self, node):
         self.send_to_node(n=node, data={"timestamp": self.timestamp, "message": "OK"})
+
+    def send_ok_responses(self, nodes):
+        """Answer OK to all the nodes at once, the replies are one event of the Lamport clock."""
+        self.timestamp = self.timestamp + 1
+        self.lease_clock()
+        data = {"timestamp": self.timestamp, "message": "OK"}
+        for n in nodes:
+            if self.is_member(n):
+                if self.tracer is not None:
+                    self.tracer.message(SEND, self, n.id, data, self.now())
+                n.send(data)
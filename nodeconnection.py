@@ -1,14 +1,202 @@
+import collections
 import socket
-import time
 import threading
-import json
+import time
+
+from cluster import MEMBERSHIP_MESSAGES
+from codec import JSON, JsonCodec, choose_codec, create_codec
+from failuredetector import HEARTBEAT_INTERVAL, HEARTBEAT_MESSAGES, PhiAccrualDetector, heartbeat_message
+from framing import EOT, EOT_CHAR, LENGTH, MAX_FRAME_SIZE, FrameError, FrameReader, HANDSHAKE_MESSAGES, \
+    choose_framing, encode_frame, handshake_message
+from metrics import RTT_MESSAGES, Metrics, ping_message, pong_message
+from topology import ROUTE_MESSAGES
 
 """
 Implementation based of https://github.com/macsnoeren/python-p2p-network
 """
 
+# Maximum number of bytes of a connection that have been queued but not written yet. A connected node that lets them
+# grow beyond it does not read anymore, the connection is closed instead of letting the sender wait: the sender is the
+# scheduler thread of the node, it would stall the election for all the other nodes. The same bound as the selector
+# and asyncio transports.
+MAX_WRITE_BUFFER = 1024 * 1024
+
+
+class ConnectionProtocol:
+    """The part of a connection with another node that is the same for every transport: the encoding of the data
+       with the negotiated codec, the framing and codec handshake, the handling of the received packets and the
+       instrumentation. The transport queues and writes the framed packets (send_packet) and reads the frames with
+       the frame reader, see NodeConnection, SelectorNodeConnection (selectornode.py) and AsyncNodeConnection
+       (asyncnode.py). It has no instance dict of its own, a transport may keep its state in slots."""
+
+    __slots__ = ()
+
+    def init_protocol(self, main_node, id, host, port, buffer_size=65536):
+        """Set up the state of the protocol, invoked by the constructor of the transport.
+            main_node: The Node class that owns the connection.
+            id: The id of the connected node (at the other side of the TCP/IP connection).
+            host: The host/ip of the connected node.
+            port: The port of the connected node.
+            buffer_size: The initial size of the receive buffer, see FrameReader."""
+        self.host = host
+        self.port = port
+        self.main_node = main_node
+
+        # The id of the connected node
+        self.id = str(id)  # Make sure the ID is a string
+
+        # Framing of the packets that are send, the framing of the received packets is kept by the frame reader. Both
+        # start as EOT and may be switched by the handshake (see framing.py).
+        self.framing = EOT
+        self.frame_reader = FrameReader(EOT, buffer_size=buffer_size)
+
+        # Encoding of the packets, negotiated by the same handshake (see codec.py), and the optional features the
+        # connected node has announced
+        self.codec = JsonCodec()
+        self.features = set()
+
+        # Makes the switch of the framing atomic with the queueing of packets, the transport queues under it
+        self.send_lock = threading.RLock()
+
+        # While set the transport holds the queued packets, see hold_until_received
+        self.held = False
+        self.send_stats = {"packets": 0, "writes": 0, "bytes": 0, "max_queue_depth": 0, "blocked": 0}
+
+        # Instrumentation of the connection, enabled together with the one of the main node (see metrics.py)
+        self.metrics = Metrics(main_node.metrics.enabled)
+
+        # Arrival of the heartbeats of the connected node, see failuredetector.py
+        self.detector = PhiAccrualDetector(main_node.heartbeat_interval or HEARTBEAT_INTERVAL)
+
+    def send(self, data, encoding_type='utf-8'):
+        """Send the data to the connected node. The data can be pure text (str), dict object (send as json) and bytes object.
+           The data is encoded and framed with the codec and framing that have been negotiated with the connected node
+           (see codec.py and framing.py). When the socket is corrupted the node connection is closed."""
+        try:
+            if self.metrics.enabled:
+                started = time.perf_counter()
+                payload = self.codec.encode(data, encoding_type)
+                self.metrics.observe("encode", time.perf_counter() - started)
+                self.metrics.count_message("send", data)
+            else:
+                payload = self.codec.encode(data, encoding_type)
+
+        except TypeError as type_error:
+            self.main_node.debug_print('This data is invalid')
+            self.main_node.debug_print(type_error)
+            return
+
+        self.send_packet(payload)
+
+    def hold_until_received(self):
+        """Hold the outbound packets until the first data of the connected node has been received. Used on inbound
+           connections: the connected node reads our id with a single recv, which must not contain packets too."""
+        self.held = True
+
+    @property
+    def queue_depth(self):
+        """Number of packets waiting in the outbound queue."""
+        return len(self.send_queue)
+
+    def get_stats(self):
+        """Returns a snapshot of the metrics of the connection together with the statistics of the outbound queue."""
+        return dict(self.metrics.snapshot(), send=self.get_send_stats())
+
+    def ping(self):
+        """Measure the round trip time to the connected node, it is recorded in the rtt histogram when the PONG
+           arrives."""
+        self.send(ping_message())
+
+    def heartbeat(self):
+        """Send a heartbeat to the connected node, see failuredetector.py."""
+        self.send(heartbeat_message())
+
+    def handle_rtt(self, data):
+        """Answer a PING and record the round trip time of a PONG."""
+        if data["message"] == "PING":
+            self.send(pong_message(data))
+        elif self.metrics.enabled and isinstance(data.get("sent"), float):
+            self.metrics.observe("rtt", time.perf_counter() - data["sent"])
+
+    def offer_framing(self):
+        """Start the framing and codec handshake, invoked by the node that made the connection."""
+        self.send(handshake_message("HELLO", self.main_node.framings, self.main_node.codecs, self.main_node.features))
+
+    def handle_handshake(self, data):
+        """Handle a message of the framing and codec handshake. The sending framing is switched right after our last
+           handshake message and the receiving framing right after the last handshake message of the connected node.
+           The packets that are queued before the switch keep their framing, they have been framed when they were
+           queued."""
+        if data["message"] == "HELLO":
+            framing = choose_framing(data["framing"], self.main_node.framings)
+            codec = choose_codec(data.get("codec", [JSON]), self.main_node.codecs) if framing == LENGTH else JSON
+            self.features = set(data.get("features", []))
+            with self.send_lock:
+                self.send(handshake_message("HELLO-ACK", framing, codec, self.main_node.features))
+                self.framing = framing
+                self.codec = create_codec(codec, self.main_node.id)
+
+        elif data["message"] == "HELLO-ACK":
+            self.frame_reader.framing = data["framing"]
+            self.features = set(data.get("features", []))
+            with self.send_lock:
+                self.send(handshake_message("HELLO-DONE", data["framing"], data.get("codec", JSON)))
+                self.framing = data["framing"]
+                self.codec = create_codec(data.get("codec", JSON), self.main_node.id)
+
+        elif data["message"] == "HELLO-DONE":
+            self.frame_reader.framing = self.framing
+
+        self.main_node.debug_print("%s: framing with %s is %s", type(self).__name__, self.id, self.framing)
+
+    def parse_packet(self, packet):
+        """Parse the packet and determines wheter it has been send in str, json or byte format. It returns
+           the according data."""
+        if self.metrics.enabled:
+            started = time.perf_counter()
+            data = self.codec.decode(packet)
+            self.metrics.observe("decode", time.perf_counter() - started)
+            self.metrics.count_message("received", data)
+            return data
+
+        return self.codec.decode(packet)
+
+    def process_packet(self, packet):
+        """Parse a received packet and hand it to the main node, handshake, round trip time and heartbeat messages
+           are handled by the connection, messages for other nodes are forwarded (see topology.py) and the membership
+           messages go to the node (see cluster.py)."""
+        data = self.parse_packet(packet)
+        if isinstance(data, dict) and data.get("message") in HANDSHAKE_MESSAGES:
+            self.handle_handshake(data)
+        elif isinstance(data, dict) and data.get("message") in RTT_MESSAGES:
+            self.handle_rtt(data)
+        elif isinstance(data, dict) and data.get("message") in HEARTBEAT_MESSAGES:
+            self.detector.heartbeat()
+        elif isinstance(data, dict) and data.get("message") in ROUTE_MESSAGES:
+            self.main_node.forward(self, data)
+        elif isinstance(data, dict) and data.get("message") in MEMBERSHIP_MESSAGES:
+            self.main_node.membership_message(self, data)
+        else:
+            self.main_node.receive(self, data)
+
+    def set_info(self, key, value):
+        if self.info is None:
+            self.info = {}
+        self.info[key] = value
+
+    def get_info(self, key):
+        return (self.info or {})[key]
+
+    def __str__(self):
+        return '{}: {}:{} <-> {}:{} ({})'.format(type(self).__name__, self.main_node.host, self.main_node.port,
+                                                 self.host, self.port, self.id)
+
+    def __repr__(self):
+        return '<{}: Node {}:{} <-> Connection {}:{}>'.format(type(self).__name__, self.main_node.host,
+                                                              self.main_node.port, self.host, self.port)
+
 
-class NodeConnection(threading.Thread):
+class NodeConnection(ConnectionProtocol, threading.Thread):
     """The class NodeConnection is used by the class Node and represent the TCP/IP socket connection with another node.
        Both inbound (nodes that connect with the server) and outbound (nodes that are connected to) are represented by
        this class. The class contains the client socket and hold the id information of the connecting node. Communication
@@ -32,18 +220,22 @@ class NodeConnection(threading.Thread):
             port: The port of the server of the main node."""
 
         super(NodeConnection, self).__init__()
+        self.init_protocol(main_node, id, host, port)
 
-        self.host = host
-        self.port = port
-        self.main_node = main_node
         self.sock = sock
         self.terminate_flag = threading.Event()
 
-        # The id of the connected node
-        self.id = str(id)  # Make sure the ID is a string
-
         # End of transmission character for the network streaming messages.
-        self.EOT_CHAR = 0x04.to_bytes(1, 'big')
+        self.EOT_CHAR = EOT_CHAR
+
+        # Outbound queue of framed packets. It is drained by the writer thread, so a slow node does not block the
+        # senders. The queue is guarded by the send lock of the protocol.
+        self.send_condition = threading.Condition(self.send_lock)
+        self.send_queue = collections.deque()
+        self.writer = threading.Thread(target=self.run_writer)
+
+        # Bytes queued or being written by the writer
+        self.unwritten = 0
 
         # Datastore to store additional information concerning the node.
         self.info = {}
@@ -51,42 +243,75 @@ class NodeConnection(threading.Thread):
         # Use socket timeout to determine problems with the connection
         self.sock.settimeout(10.0)
 
+        # The messages are small, do not let Nagle's algorithm delay them
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
         self.main_node.debug_print(
             "NodeConnection.send: Started with client (" + self.id + ") '" + self.host + ":" + str(self.port) + "'")
 
-    def send(self, data, encoding_type='utf-8'):
-        """Send the data to the connected node. The data can be pure text (str), dict object (send as json) and bytes object.
-           When sending bytes object, it will be using standard socket communication. A end of transmission character 0x04
-           utf-8/ascii will be used to decode the packets ate the other node. When the socket is corrupted the node connection
-           is closed."""
-        if isinstance(data, str):
-            try:
-                self.sock.sendall(data.encode(encoding_type) + self.EOT_CHAR)
+    def send_packet(self, payload):
+        """Frame the payload and put it in the outbound queue, the caller never waits. When the queue is full the
+           connected node does not read anymore, the packet is dropped and the connection is closed like the
+           selector and asyncio transports do. The queue is full when the bytes that have not been written grow
+           beyond MAX_WRITE_BUFFER. The dropped packets are lost: Ricart-Agrawala keeps waiting for the node and
+           repeats its request when the connection is restored or stops waiting when the node is suspected, the
+           other algorithms do not recover the lost messages."""
+        if len(payload) > MAX_FRAME_SIZE:
+            self.main_node.debug_print("nodeconnection send: Packet of %d bytes is too large", len(payload))
+            return
+
+        with self.send_condition:
+            if self.terminate_flag.is_set():
+                return
+
+            frame = encode_frame(payload, self.framing)
+            if self.unwritten + len(frame) > MAX_WRITE_BUFFER:
+                self.send_stats["blocked"] += 1
+                self.main_node.debug_print("nodeconnection send: Node %s is not reading anymore", self.id)
+                self.stop()
+                return
+
+            self.send_queue.append(frame)
+            self.unwritten += len(frame)
+            self.send_stats["packets"] += 1
+            self.send_stats["max_queue_depth"] = max(self.send_stats["max_queue_depth"], len(self.send_queue))
+            self.send_condition.notify_all()
+
+    def run_writer(self):
+        """The main loop of the writer thread. All the packets that are queued when the writer wakes up are coalesced
+           into a single sendall."""
+        while True:
+            with self.send_condition:
+                self.send_condition.wait_for(
+                    lambda: (self.send_queue and not self.held) or self.terminate_flag.is_set())
+                if not self.send_queue:
+                    break
+
+                packets = b''.join(self.send_queue)
+                self.send_queue.clear()
 
-            except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
-                self.main_node.debug_print("nodeconnection send: Error sending data to node: " + str(e))
-                self.stop()  # Stopping node due to failure
-
-        elif isinstance(data, dict):
             try:
-                json_data = json.dumps(data)
-                json_data = json_data.encode(encoding_type) + self.EOT_CHAR
-                self.sock.sendall(json_data)
-
-            except TypeError as type_error:
-                self.main_node.debug_print('This dict is invalid')
-                self.main_node.debug_print(type_error)
+                self.sock.sendall(packets)
+                self.send_stats["writes"] += 1
+                self.send_stats["bytes"] += len(packets)
+                with self.send_lock:
+                    self.unwritten -= len(packets)
 
             except Exception as e:  # Fixed issue #19: When sending is corrupted, close the connection
                 self.main_node.debug_print("nodeconnection send: Error sending data to node: " + str(e))
                 self.stop()  # Stopping node due to failure
+                break
 
-        elif isinstance(data, bytes):
-            bin_data = data + self.EOT_CHAR
-            self.sock.sendall(bin_data)
+    def release_hold(self):
+        with self.send_condition:
+            self.held = False
+            self.send_condition.notify_all()
 
-        else:
-            self.main_node.debug_print('datatype used is not valid plese use str, dict (will be send as json) or bytes')
+    def get_send_stats(self):
+        """Returns the statistics of the outbound queue: the packets queued, the writes done, the bytes written, the
+           current and maximum queue depth and how many times the queue overflowed and the connection was closed."""
+        with self.send_lock:
+            return dict(self.send_stats, queue_depth=len(self.send_queue))
 
     # This method should be implemented by yourself! We do not know when the message is
     # correct.
@@ -95,36 +320,38 @@ class NodeConnection(threading.Thread):
 
     # Stop the node client. Please make sure you join the thread.
     def stop(self):
-        """Terminates the connection and the thread is stopped."""
+        """Terminates the connection and the thread is stopped. The receiving side of the socket is shut down, so the
+           thread does not wait for the socket timeout when the connected node is silent. The writer still sends the
+           packets that have been queued."""
         self.terminate_flag.set()
-
-    def parse_packet(self, packet):
-        """Parse the packet and determines wheter it has been send in str, json or byte format. It returns
-           the according data."""
+        with self.send_condition:
+            self.send_condition.notify_all()
         try:
-            packet_decoded = packet.decode('utf-8')
-
-            try:
-                return json.loads(packet_decoded)
-
-            except json.decoder.JSONDecodeError:
-                return packet_decoded
-
-        except UnicodeDecodeError:
-            return packet
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass  # Closed already
 
     # Required to implement the Thread. This is the main loop of the node client.
     def run(self):
         """The main loop of the thread to handle the connection with the node. Within the
            main loop the thread waits to receive data from the node. If data is received
-           the method node_message will be invoked of the main node to be processed."""
-        buffer = b''  # Hold the stream that comes in!
+           the method receive will be invoked of the main node to be processed. The sending is done by
+           a separate writer thread."""
+        self.writer.start()
 
         while not self.terminate_flag.is_set():
-            chunk = b''
+            received = 0
 
             try:
-                chunk = self.sock.recv(4096)
+                # The data is received directly into the buffer of the frame reader
+                received = self.frame_reader.recv_into(self.sock)
+                if received == 0:
+                    self.terminate_flag.set()  # The connection was closed by the other node
+                else:
+                    if self.held:
+                        self.release_hold()
+                    if self.metrics.enabled:
+                        self.metrics.count("bytes_received", received)
 
             except socket.timeout:
                 self.main_node.debug_print("NodeConnection: timeout")
@@ -134,39 +361,21 @@ class NodeConnection(threading.Thread):
                 self.main_node.debug_print('Unexpected error')
                 self.main_node.debug_print(e)
 
-            # BUG: possible buffer overflow when no EOT_CHAR is found => Fix by max buffer count or so?
-            if chunk != b'':
-                buffer += chunk
-                eot_pos = buffer.find(self.EOT_CHAR)
-
-                while eot_pos > 0:
-                    packet = buffer[:eot_pos]
-                    buffer = buffer[eot_pos + 1:]
-
-                    self.main_node.timestamp += 1
-                    self.main_node.node_message(self, self.parse_packet(packet))
-
-                    eot_pos = buffer.find(self.EOT_CHAR)
+            if received > 0:
+                try:
+                    for packet in self.frame_reader.frames():
+                        if len(packet) > 0:
+                            self.process_packet(packet)
 
-            time.sleep(0.01)
+                except FrameError as e:
+                    self.terminate_flag.set()  # The stream can not be trusted anymore
+                    self.main_node.debug_print('NodeConnection: ' + str(e))
 
         # IDEA: Invoke (event) a method in main_node so the user is able to send a bye message to the node before it is closed?
+        self.stop()  # Wake up the writer, the terminate flag may have been set by this thread
+        self.writer.join()
         self.sock.settimeout(None)
         self.sock.close()
         self.main_node.node_disconnected(
             self)  # Fixed issue #19: Send to main_node when a node is disconnected. We do not know whether it is inbounc or outbound.
         self.main_node.debug_print("NodeConnection: Stopped")
-
-    def set_info(self, key, value):
-        self.info[key] = value
-
-    def get_info(self, key):
-        return self.info[key]
-
-    def __str__(self):
-        return 'NodeConnection: {}:{} <-> {}:{} ({})'.format(self.main_node.host, self.main_node.port, self.host,
-                                                             self.port, self.id)
-
-    def __repr__(self):
-        return '<NodeConnection: Node {}:{} <-> Connection {}:{}>'.format(self.main_node.host, self.main_node.port,
-                                                                          self.host, self.port)
\ No newline at end of file
@@ -0,0 +1,86 @@
+import threading
+
+"""
+Registry of the connections of a node, indexed by id and by address.
+"""
+
+
+class PeerRegistry:
+    """Keeps the inbound and outbound connections of a node. Lookups by connection, id and (host, port) are dictionary
+       lookups and the lists of connections are cached, they are only rebuilt when a connection is added or removed.
+       The cached lists must not be modified by the caller. Adding and removing is thread safe, readers always see a
+       consistent list without locking."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Connection -> True when inbound, False when outbound
+        self.direction = {}
+        self.by_id = {}
+        self.by_address = {}
+
+        self.inbound = []
+        self.outbound = []
+        self.all = []
+
+    def __len__(self):
+        return len(self.all)
+
+    def __contains__(self, connection):
+        return connection in self.direction
+
+    def add(self, connection, inbound):
+        """Register a new connection. Outbound connections are indexed by the address of the server they connected
+           to, inbound connections by the address of the client."""
+        with self.lock:
+            self.direction[connection] = inbound
+            self.by_id[connection.id] = connection
+            self.by_address[(connection.host, connection.port)] = connection
+            self.rebuild()
+
+    def extend(self, connections, inbound):
+        """Register many connections with the same direction, the lists are only rebuilt once."""
+        with self.lock:
+            for connection in connections:
+                self.direction[connection] = inbound
+                self.by_id[connection.id] = connection
+                self.by_address[(connection.host, connection.port)] = connection
+            self.rebuild()
+
+    def remove(self, connection):
+        """Remove the connection. Returns True when it was inbound, False when it was outbound and None when it was
+           not registered."""
+        with self.lock:
+            inbound = self.direction.pop(connection, None)
+            if inbound is None:
+                return None
+
+            if self.by_id.get(connection.id) is connection:
+                del self.by_id[connection.id]
+            if self.by_address.get((connection.host, connection.port)) is connection:
+                del self.by_address[(connection.host, connection.port)]
+            self.rebuild()
+            return inbound
+
+    def rebuild(self):
+        """Rebuild the cached lists, invoked with the lock held."""
+        self.inbound = [connection for (connection, inbound) in self.direction.items() if inbound]
+        self.outbound = [connection for (connection, inbound) in self.direction.items() if not inbound]
+        self.all = self.inbound + self.outbound
+
+    def is_inbound(self, connection):
+        return self.direction.get(connection) is True
+
+    def is_outbound(self, connection):
+        return self.direction.get(connection) is False
+
+    def find_by_id(self, id):
+        """Returns the connection with the node with the given id, or None."""
+        return self.by_id.get(id)
+
+    def find_outbound(self, host, port):
+        """Returns the outbound connection with the node running its server on host and port, or None."""
+        connection = self.by_address.get((host, port))
+        if connection is not None and self.is_outbound(connection):
+            return connection
+        return None
@@ -0,0 +1,350 @@
+import collections
+import selectors
+import socket
+import threading
+import time
+
+from framing import MAX_FRAME_SIZE, FrameError, encode_frame
+from mutex import RICART_AGRAWALA
+from node import Node
+from nodeconnection import ConnectionProtocol
+
+"""
+Selector transport for the Node. One I/O thread per node, the thread of the node itself, multiplexes the server
+socket and the sockets of all the connections with a selector (epoll or kqueue), instead of running a reader and a
+writer thread per connection. The connections are plain objects with slots and a small receive buffer that only grows
+for large frames, so a connection costs a few kilobytes and no thread. The received messages are dispatched to the
+node like the threaded connection does, the election still runs on the scheduler thread (see Node.post).
+Packets that are send from any thread are queued on the connection, the I/O thread writes them out without blocking
+and is woken up through a socket pair when a connection has packets to write.
+"""
+
+# Initial size of the receive buffer of a connection, see FrameReader
+RECV_BUFFER = 4096
+
+# Bytes that may wait to be written to a connection before the connected node is considered stalled and the connection
+# is closed
+MAX_WRITE_BUFFER = 1024 * 1024
+
+
+class SelectorNodeConnection(ConnectionProtocol):
+    """The counterpart of NodeConnection that is served by the I/O thread of a SelectorNode. It has no thread of its
+       own: the I/O thread reads from the socket when it is readable and writes the queued packets when the
+       connection asks for it. The state is kept in slots.
+        main_node: The SelectorNode that owns this connection.
+        sock: The socket of the connection.
+        id: The id of the connected node (at the other side of the TCP/IP connection).
+        host: The host/ip of the connected node.
+        port: The port of the connected node."""
+
+    __slots__ = ("main_node", "sock", "id", "host", "port", "terminated", "framing", "frame_reader", "codec",
+                 "features", "send_lock", "send_queue", "send_buffer", "sending", "held", "send_stats", "metrics",
+                 "detector", "info")
+
+    def __init__(self, main_node, sock, id, host, port):
+        self.init_protocol(main_node, id, host, port, buffer_size=RECV_BUFFER)
+        self.sock = sock
+        self.terminated = False
+
+        # Framed packets waiting for the I/O thread and the bytes of the last write that did not fit in the socket
+        # buffer. Sending is set while the connection waits for the I/O thread, the send lock of the protocol makes
+        # that atomic with the queueing of packets and the switch of the framing.
+        self.send_queue = collections.deque()
+        self.send_buffer = bytearray()
+        self.sending = False
+
+        # Datastore to store additional information concerning the node, created on first use
+        self.info = None
+
+        # The I/O thread may write to the socket as soon as the connection is known to the node, it must never block
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.main_node.debug_print(
+            "SelectorNodeConnection: Started with client (" + self.id + ") '" + self.host + ":" + str(self.port) + "'")
+
+    def start(self):
+        """Let the I/O thread of the main node serve the connection."""
+        self.main_node.io_request(self.main_node.register_connection, self)
+
+    def send_packet(self, payload):
+        """Frame the payload and queue it, the I/O thread is asked to write when it is not asked already."""
+        if len(payload) > MAX_FRAME_SIZE:
+            self.main_node.debug_print("SelectorNodeConnection send: Packet of %d bytes is too large", len(payload))
+            return
+
+        with self.send_lock:
+            if self.terminated:
+                return
+
+            self.send_queue.append(encode_frame(payload, self.framing))
+            self.send_stats["packets"] += 1
+            self.send_stats["max_queue_depth"] = max(self.send_stats["max_queue_depth"], len(self.send_queue))
+            if self.sending or self.held:
+                return
+            self.sending = True
+
+        self.main_node.io_request(self.main_node.write_connection, self)
+
+    def flush(self):
+        """Write the queued packets as far as the socket takes them without blocking, invoked by the I/O thread.
+           Returns True when everything has been written. A connected node that lets the unwritten bytes grow
+           beyond MAX_WRITE_BUFFER is disconnected."""
+        while True:
+            with self.send_lock:
+                if self.send_queue:
+                    self.send_buffer += b''.join(self.send_queue)
+                    self.send_queue.clear()
+                elif not self.send_buffer:
+                    self.sending = False
+                    return True
+
+            written = self.sock.send(self.send_buffer)
+            self.send_stats["writes"] += 1
+            self.send_stats["bytes"] += written
+            del self.send_buffer[:written]
+            if self.send_buffer:
+                if len(self.send_buffer) > MAX_WRITE_BUFFER:
+                    self.send_stats["blocked"] += 1
+                    raise ConnectionError("node " + self.id + " is not reading anymore")
+                return False
+
+    def release_hold(self):
+        with self.send_lock:
+            self.held = False
+            if self.sending or not self.send_queue:
+                return
+            self.sending = True
+        self.main_node.write_connection(self)
+
+    def receive_packets(self):
+        """Read what the socket has and process the complete packets, invoked by the I/O thread. Returns False when
+           the connection has been closed by the connected node."""
+        try:
+            received = self.frame_reader.recv_into(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return True
+        if received == 0:
+            return False
+
+        if self.held:
+            self.release_hold()
+        if self.metrics.enabled:
+            self.metrics.count("bytes_received", received)
+
+        for packet in self.frame_reader.frames():
+            if len(packet) > 0:
+                self.process_packet(packet)
+        return True
+
+    def get_send_stats(self):
+        """Returns the statistics of the outbound queue, see NodeConnection.get_send_stats. The bytes that did not fit
+           in the socket buffer are reported as write_buffer."""
+        with self.send_lock:
+            return dict(self.send_stats, queue_depth=len(self.send_queue), write_buffer=len(self.send_buffer))
+
+    def stop(self):
+        """Terminates the connection, the I/O thread writes the packets that have been queued and closes it."""
+        with self.send_lock:
+            if self.terminated:
+                return
+            self.terminated = True
+        self.main_node.io_request(self.main_node.close_connection, self)
+
+    def join(self, timeout=None):
+        """There is no thread to wait for, the connection is closed by the I/O thread."""
+        pass
+
+
+class SelectorNode(Node):
+    """Node whose connections are all served by its own thread with a selector, see SelectorNodeConnection. The
+       mutual exclusion logic and the callbacks are inherited from Node, only the transport is replaced. Besides the
+       I/O thread a node runs the scheduler thread, two threads however many nodes it is connected with.
+        host: The host name or ip address that is used to bind the TCP/IP server to.
+        port: The port number that is used to bind the TCP/IP server to.
+        id: (optional) This id will be associated with the node.
+        callback: (optional) The callback that is invokes when events happen inside the network.
+        n: The number of nodes in the network.
+        algorithm: (optional) The mutual exclusion algorithm, see mutex.py."""
+
+    def __init__(self, host, port, id=None, callback=None, n=1, algorithm=RICART_AGRAWALA):
+        super(SelectorNode, self).__init__(host, port, id=id, callback=callback, n=n, algorithm=algorithm)
+        self.selector = selectors.DefaultSelector()
+
+        # Work for the I/O thread that is requested by other threads, (handler, connection) pairs, and the socket
+        # pair that wakes it up. Only one wake up is pending at a time.
+        self.io_requests = collections.deque()
+        self.io_lock = threading.Lock()
+        self.io_wakeup_pending = False
+        (self.wakeup_receiver, self.wakeup_sender) = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+
+        # The thread of the last reconnection round and whether it still runs, see reconnect_nodes
+        self.reconnecting = None
+        self.reconnect_running = False
+
+    def create_new_connection(self, connection, id, host, port):
+        return SelectorNodeConnection(self, connection, id, host, port)
+
+    def io_request(self, handler, connection):
+        """Let the I/O thread run handler(connection). On the I/O thread itself it runs at once."""
+        if threading.current_thread() is self:
+            handler(connection)
+            return
+
+        self.io_requests.append((handler, connection))
+        with self.io_lock:
+            if self.io_wakeup_pending:
+                return
+            self.io_wakeup_pending = True
+        try:
+            self.wakeup_sender.send(b'\0')
+        except OSError:
+            pass  # The node has stopped
+
+    def run_io_requests(self):
+        """Run the requests of the other threads. The wake ups are drained before the next wake up is allowed, so a
+           request that comes in while they are run always leaves a wake up behind."""
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        with self.io_lock:
+            self.io_wakeup_pending = False
+
+        while self.io_requests:
+            (handler, connection) = self.io_requests.popleft()
+            handler(connection)
+
+    def register_connection(self, connection):
+        if connection.terminated:
+            return
+        try:
+            self.selector.get_key(connection.sock)
+        except KeyError:
+            self.selector.register(connection.sock, selectors.EVENT_READ, connection)
+
+    def write_connection(self, connection):
+        """Write the queued packets of the connection, the socket is watched for room when they do not fit."""
+        if connection.sock.fileno() < 0:
+            return
+        try:
+            done = connection.flush()
+        except OSError as e:
+            self.debug_print("SelectorNode: Error sending data to node " + connection.id + ": " + str(e))
+            self.close_connection(connection)
+            return
+
+        events = selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE
+        try:
+            if self.selector.get_key(connection.sock).events != events:
+                self.selector.modify(connection.sock, events, connection)
+        except KeyError:
+            # Not registered yet, the connection has been send to before it was started. It is registered here with
+            # the events it needs, otherwise what did not fit would never be written.
+            if not connection.terminated:
+                self.selector.register(connection.sock, events, connection)
+
+    def read_connection(self, connection):
+        try:
+            if connection.receive_packets():
+                return
+        except FrameError as e:
+            self.debug_print('SelectorNodeConnection: ' + str(e))
+        except OSError as e:
+            self.debug_print('SelectorNodeConnection: ' + str(e))
+        self.close_connection(connection)
+
+    def close_connection(self, connection):
+        """Close the connection and let the node know that it is gone. What is still queued is written as far as the
+           socket takes it without blocking."""
+        with connection.send_lock:
+            connection.terminated = True
+        if connection.sock.fileno() < 0:
+            return
+
+        try:
+            self.selector.unregister(connection.sock)
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            connection.flush()
+        except OSError:
+            pass
+        connection.sock.close()
+
+        self.node_disconnected(connection)
+        self.debug_print("SelectorNodeConnection: Stopped")
+
+    def stop(self):
+        super(SelectorNode, self).stop()
+        self.io_request(lambda connection: None, None)
+
+    def create_selector(self):
+        """The connections and the wake ups of the other threads are served by the main loop of Node.run."""
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        return self.selector
+
+    def handle_io(self, key, events):
+        """Handle the events of a connection or a wake up, invoked by the main loop on the I/O thread."""
+        if key.fileobj is self.wakeup_receiver:
+            self.run_io_requests()
+            return
+
+        if events & selectors.EVENT_WRITE:
+            self.write_connection(key.data)
+        if events & selectors.EVENT_READ and not key.data.terminated:
+            self.read_connection(key.data)
+
+    def reconnect_nodes(self):
+        """Reconnect the nodes on a thread of its own, connect_with_node waits for the connection and the id of the
+           node and the I/O thread must not. One reconnection round runs at a time and only when a node is due."""
+        if self.reconnect_running:
+            return
+
+        now = time.monotonic()
+        if not any(self.peers.find_outbound(entry["host"], entry["port"]) is None and
+                   now >= entry.get("next_trial", 0.0) for entry in list(self.reconnect_to_nodes)):
+            return
+
+        self.reconnect_running = True
+        self.reconnecting = threading.Thread(target=self.reconnect_round)
+        self.reconnecting.start()
+
+    def reconnect_round(self):
+        """One reconnection round on its own thread, the main loop is woken up afterwards to wait for the next one
+           that is due (see loop_timeout)."""
+        try:
+            super(SelectorNode, self).reconnect_nodes()
+        finally:
+            self.reconnect_running = False
+            self.wake_main_loop()
+
+    def next_reconnection(self):
+        """While a reconnection round runs no node is due, the round wakes up the main loop when it is done."""
+        if self.reconnect_running:
+            return None
+        return super(SelectorNode, self).next_reconnection()
+
+    def wake_main_loop(self):
+        self.io_request(lambda connection: None, None)
+
+    def close(self):
+        print("Node stopping...")
+        if self.reconnecting is not None:
+            self.reconnecting.join()
+        self.run_io_requests()
+        for connection in self.all_nodes:
+            self.close_connection(connection)
+
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+        self.sock.settimeout(None)
+        self.sock.close()
+        if self.wal is not None:
+            self.wal.close()
+        print("Node stopped")
+
+    def __repr__(self):
+        return '<SelectorNode {}:{} id: {}>'.format(self.host, self.port, self.id)
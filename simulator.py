@@ -0,0 +1,263 @@
+import collections
+import heapq
+import random
+
+from mutex import RICART_AGRAWALA
+from node import Node
+from topology import ROUTE_MESSAGES, Topology
+
+"""
+In-memory transport for the Node. The nodes of a simulation run in one thread on a virtual clock: sending a message
+schedules its delivery on an event queue and the election timers of the nodes are events on the same queue. Time
+only advances from one event to the next, so a simulated run does not wait for the critical section and time-out
+intervals, no sockets are opened and a run is reproducible from its seed. This makes it possible to measure how the
+mutual exclusion algorithms scale to thousands of nodes without the overhead of the sockets.
+Messages are delivered in order per connection after the latency (plus a random jitter) and may be dropped with the
+loss probability. The mutual exclusion algorithms expect reliable connections like TCP, so a lossy run will stall.
+"""
+
+
+class SimNodeConnection:
+    """The simulated counterpart of NodeConnection, one side of an in-memory channel between two nodes. The data is
+       handed to the other side as is, it is not encoded.
+        main_node: The SimNode that owns this connection.
+        simulator: The simulator that delivers the messages.
+        id: The id of the connected node.
+        host: The host of the connected node, always "sim".
+        port: The port of the connected node, its index in the simulation."""
+
+    def __init__(self, main_node, simulator, id, host, port):
+        self.main_node = main_node
+        self.simulator = simulator
+        self.id = str(id)
+        self.host = host
+        self.port = port
+        self.terminated = False
+
+        # The connection at the other side of the channel and the virtual time of the last delivery, later messages
+        # are never delivered before it
+        self.other = None
+        self.delivered_at = 0.0
+
+        # There is no handshake, the nodes of a simulation all have the same features
+        self.features = set(main_node.features)
+
+        # The simulated connections are not instrumented, the simulator counts the messages
+        self.metrics = main_node.metrics
+        self.send_stats = {"packets": 0}
+
+        # Datastore to store additional information concerning the node.
+        self.info = {}
+
+    def send(self, data, encoding_type='utf-8'):
+        """Send the data to the connected node, it is delivered by the simulator."""
+        if not self.terminated:
+            self.send_stats["packets"] += 1
+            self.simulator.transmit(self, data)
+
+    def deliver(self, data):
+        """Invoked by the simulator when a message of the connected node arrives."""
+        if not self.terminated:
+            if isinstance(data, dict) and data.get("message") in ROUTE_MESSAGES:
+                self.main_node.forward(self, data)
+            else:
+                self.main_node.receive(self, data)
+
+    def stop(self):
+        """Terminates the connection, messages in transit are dropped."""
+        if not self.terminated:
+            self.terminated = True
+            self.main_node.node_disconnected(self)
+
+    @property
+    def queue_depth(self):
+        return 0
+
+    def get_send_stats(self):
+        return dict(self.send_stats)
+
+    def get_stats(self):
+        return {"counters": {}, "histograms": {}, "marks": {}, "send": self.get_send_stats()}
+
+    def ping(self):
+        """The round trip time is not measured, it is the latency of the simulation."""
+        pass
+
+    def set_info(self, key, value):
+        self.info[key] = value
+
+    def get_info(self, key):
+        return self.info[key]
+
+    def __str__(self):
+        return 'SimNodeConnection: {} <-> {}'.format(self.main_node.id, self.id)
+
+    def __repr__(self):
+        return '<SimNodeConnection: Node {} <-> Connection {}>'.format(self.main_node.id, self.id)
+
+
+class SimNode(Node):
+    """Node that runs in a simulation. The mutual exclusion logic and the callbacks are inherited from Node, the
+       election timers run on the virtual clock of the simulator and the random intervals are drawn from a random
+       generator that is seeded by the simulator.
+        simulator: The simulator that runs the node.
+        index: The index of the node in the simulation, used as its port.
+        id: (optional) This id will be associated with the node.
+        callback: (optional) The callback that is invokes when events happen inside the network.
+        n: The number of nodes in the network.
+        algorithm: (optional) The mutual exclusion algorithm, see mutex.py."""
+
+    def __init__(self, simulator, index, id=None, callback=None, n=1, algorithm=RICART_AGRAWALA):
+        self.simulator = simulator
+        super(SimNode, self).__init__("sim", index, id=id, callback=callback, n=n, algorithm=algorithm)
+        self.random = random.Random(simulator.random.random())
+
+        # A wake up of the scheduler is pending, and the generation of the scheduler timer: a timer of an older
+        # generation has been replaced and is ignored
+        self.wakeup_pending = False
+        self.generation = 0
+
+    def init_server(self):
+        """There is no server, the connections are created by the simulator."""
+        self.sock = None
+
+    def now(self):
+        return self.simulator.now
+
+    def start(self):
+        """Start the election of the node."""
+        self.wake_scheduler()
+
+    def wake_scheduler(self):
+        """Schedule a run of the scheduler at the current virtual time."""
+        if not self.wakeup_pending:
+            self.wakeup_pending = True
+            self.simulator.schedule(0, self.run_scheduler)
+
+    def run_scheduler(self, generation=None):
+        """Run the election once and schedule the next timed transition, see Node.scheduler_timeout."""
+        if generation is None:
+            self.wakeup_pending = False
+        elif generation != self.generation:
+            return
+
+        if self.terminate_flag.is_set():
+            return
+
+        self.generation += 1
+        timeout = self.scheduler_timeout()
+        if timeout is not None:
+            self.simulator.schedule(timeout, self.run_scheduler, self.generation)
+
+    def post(self, handler, *args):
+        """The simulation runs in one thread, the handler runs at once."""
+        handler(*args)
+
+    def create_new_connection(self, connection, id, host, port):
+        """Create the connection object for a new peer, connection is the simulator."""
+        return SimNodeConnection(self, connection, id, host, port)
+
+    def close(self):
+        for node in self.all_nodes:
+            node.stop()
+
+    def __repr__(self):
+        return '<SimNode {} id: {}>'.format(self.port, self.id)
+
+
+class Simulator:
+    """Runs simulated nodes on a virtual clock. The events are kept in a heap ordered by their virtual time, events
+       at the same time run in the order they have been scheduled.
+        seed: Seed of all the random numbers of the simulation, the same seed gives the same run.
+        latency: Seconds a message is in transit.
+        jitter: A random amount of seconds up to jitter is added to the latency of every message.
+        loss: Probability that a message is dropped."""
+
+    def __init__(self, seed=0, latency=0.0, jitter=0.0, loss=0.0):
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        self.now = 0.0
+        self.events = []
+        self.sequence = 0
+        self.nodes = []
+        self.connections = 0
+
+        # Messages send by type, and the number of messages dropped
+        self.messages = collections.Counter()
+        self.dropped = 0
+
+    def schedule(self, delay, callback, *args):
+        """Run callback(*args) after delay virtual seconds."""
+        self.schedule_at(self.now + delay, callback, *args)
+
+    def schedule_at(self, at, callback, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (at, self.sequence, callback, args))
+
+    def transmit(self, connection, data):
+        """Schedule the delivery of the data at the other side of the connection."""
+        self.messages[data.get("message") if isinstance(data, dict) else type(data).__name__] += 1
+        if self.loss > 0 and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+
+        delay = self.latency
+        if self.jitter > 0:
+            delay += self.random.uniform(0, self.jitter)
+
+        # In order per connection, like TCP
+        at = max(self.now + delay, connection.delivered_at)
+        connection.delivered_at = at
+        self.schedule_at(at, connection.other.deliver, dict(data) if isinstance(data, dict) else data)
+
+    def create_nodes(self, n, callback=None, algorithm=RICART_AGRAWALA, node_class=SimNode, topology=None,
+                     degree=None):
+        """Create n nodes with the ids P1 .. Pn, connect them to a full mesh, or to the given topology (see
+           topology.py), and start them."""
+        nodes = [node_class(self, i, id=f"P{i + 1}", callback=callback, n=n, algorithm=algorithm)
+                 for i in range(n)]
+        if topology is not None:
+            for node in nodes:
+                node.set_topology(topology, degree)
+            edges = Topology(topology, n, degree).edges()
+        else:
+            edges = [(i, j) for i in range(n) for j in range(i + 1, n)]
+
+        inbound = [[] for _ in range(n)]
+        outbound = [[] for _ in range(n)]
+        for (i, j) in edges:
+            connection = nodes[i].create_new_connection(self, nodes[j].id, nodes[j].host, nodes[j].port)
+            other = nodes[j].create_new_connection(self, nodes[i].id, nodes[i].host, nodes[i].port)
+            (connection.other, other.other) = (other, connection)
+            outbound[i].append(connection)
+            inbound[j].append(other)
+        self.connections = len(edges)
+
+        for i in range(n):
+            nodes[i].peers.extend(outbound[i], inbound=False)
+            nodes[i].peers.extend(inbound[i], inbound=True)
+
+        self.nodes.extend(nodes)
+        for node in nodes:
+            node.update_mesh_ready()
+            node.start()
+        return nodes
+
+    def run(self, until=None, stop=None):
+        """Run the events in order. Stops when there are no events left, when the virtual time would pass until or
+           when stop() returns True after an event. Returns the number of events that have been run."""
+        count = 0
+        while self.events:
+            if until is not None and self.events[0][0] > until:
+                self.now = until
+                break
+
+            (self.now, sequence, callback, args) = heapq.heappop(self.events)
+            callback(*args)
+            count += 1
+            if stop is not None and stop():
+                break
+        return count
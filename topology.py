@@ -0,0 +1,129 @@
+import collections
+
+"""
+Topologies of the network. By default every node connects with every other node, a full mesh of n(n-1)/2 connections.
+A topology connects every node with a few neighbours only:
+  mesh: every pair of nodes, the original network.
+  ring: node i with i - 1 and i + 1, 2 connections per node.
+  tree: a tree of the given degree with P1 at the root, node i is the parent of degree * i + 1 .. degree * i + degree.
+  regular: node i with i +- 1 .. i +- degree / 2, every node has the same number of neighbours, the degree
+           must be even.
+  clustered: clusters of degree consecutive nodes are full meshes, the first node of every cluster is its head and
+             the heads form a binary tree.
+Messages to a node that is not a neighbour are forwarded over the shortest path in a ROUTE message, every node
+computes its next hops from the topology with a breadth first search (see Topology.next_hops). The nodes are numbered
+by their ids P1 .. Pn, so all the nodes of a network derive the same topology from its name, the degree and n.
+"""
+
+MESH = "mesh"
+RING = "ring"
+TREE = "tree"
+REGULAR = "regular"
+CLUSTERED = "clustered"
+
+TOPOLOGIES = (MESH, RING, TREE, REGULAR, CLUSTERED)
+
+# The degree of a topology when none is given: the branching of a tree, the neighbours of a node of a regular
+# topology and the size of a cluster
+DEFAULT_DEGREE = {MESH: 0, RING: 2, TREE: 2, REGULAR: 4, CLUSTERED: 4}
+
+# Messages that are forwarded to a node that is not a neighbour. They are handled by the connection, like the
+# heartbeats, nodes that do not know them pass them to the mutual exclusion algorithm that ignores them.
+ROUTE_MESSAGES = ("ROUTE",)
+
+
+class Topology:
+    """The neighbours of the n nodes of a topology, the nodes are indexed 0 .. n - 1 (node P1 has index 0).
+        name: The topology, see TOPOLOGIES.
+        n: The number of nodes.
+        degree: (optional) The degree of the topology, see DEFAULT_DEGREE."""
+
+    def __init__(self, name, n, degree=None):
+        if name not in TOPOLOGIES:
+            raise ValueError("Unknown topology: " + str(name))
+        self.name = name
+        self.n = n
+        self.degree = DEFAULT_DEGREE[name] if degree is None else degree
+        if name != MESH and self.degree < 1:
+            raise ValueError("The degree of a topology must be at least 1")
+        # Every node is linked to as many nodes before as after it, an odd degree can't be met
+        if name == REGULAR and self.degree % 2:
+            raise ValueError("The degree of a regular topology must be even")
+
+    def neighbours(self, index):
+        """Returns the sorted indexes of the neighbours of the node."""
+        n = self.n
+        neighbours = set()
+        if self.name == MESH:
+            neighbours.update(range(n))
+
+        elif self.name == RING:
+            neighbours.update(((index - 1) % n, (index + 1) % n))
+
+        elif self.name == TREE:
+            if index > 0:
+                neighbours.add((index - 1) // self.degree)
+            neighbours.update(range(self.degree * index + 1, min(self.degree * index + self.degree + 1, n)))
+
+        elif self.name == REGULAR:
+            for offset in range(1, self.degree // 2 + 1):
+                neighbours.update(((index - offset) % n, (index + offset) % n))
+
+        elif self.name == CLUSTERED:
+            cluster = index // self.degree
+            neighbours.update(range(cluster * self.degree, min((cluster + 1) * self.degree, n)))
+            if index == cluster * self.degree:
+                # The head of the cluster, connected with the heads of the parent and child clusters
+                if cluster > 0:
+                    neighbours.add((cluster - 1) // 2 * self.degree)
+                neighbours.update(child * self.degree for child in (2 * cluster + 1, 2 * cluster + 2)
+                                  if child * self.degree < n)
+
+        neighbours.discard(index)
+        return sorted(neighbours)
+
+    def edges(self):
+        """Returns the connections of the topology as (i, j) pairs with i < j, node i connects with node j."""
+        return [(i, j) for i in range(self.n) for j in self.neighbours(i) if i < j]
+
+    def next_hops(self, index):
+        """Returns the neighbour on a shortest path from the node to every other node that can be reached, as a
+           dict of the index of the destination to the index of the neighbour."""
+        next_hops = {}
+        frontier = collections.deque()
+        for neighbour in self.neighbours(index):
+            next_hops[neighbour] = neighbour
+            frontier.append(neighbour)
+
+        while frontier:
+            node = frontier.popleft()
+            for neighbour in self.neighbours(node):
+                if neighbour != index and neighbour not in next_hops:
+                    next_hops[neighbour] = next_hops[node]
+                    frontier.append(neighbour)
+        return next_hops
+
+
+class RoutedNode:
+    """Stands in for a node that is not a neighbour towards the mutual exclusion algorithm, like a connection does
+       for a neighbour. The data that is send to it is forwarded by the neighbours, see Node.route.
+        main_node: The node that sends through this stand-in.
+        id: The id of the node that is not a neighbour."""
+
+    def __init__(self, main_node, id):
+        self.main_node = main_node
+        self.id = id
+        self.host = None
+        self.port = None
+
+        # There is no handshake, only nodes that know the routing are reached and they know all the features
+        self.features = set(main_node.features)
+
+    def send(self, data, encoding_type='utf-8'):
+        self.main_node.route(self.id, data)
+
+    def __str__(self):
+        return 'RoutedNode: {} -> {}'.format(self.main_node.id, self.id)
+
+    def __repr__(self):
+        return '<RoutedNode: Node {} -> Node {}>'.format(self.main_node.id, self.id)
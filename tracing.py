@@ -0,0 +1,407 @@
+#!/usr/bin/python
+
+import argparse
+import collections
+import heapq
+import json
+import mmap
+import os
+import struct
+import threading
+
+from metrics import Histogram
+
+"""
+Binary trace of the protocol: every message of the mutual exclusion that a node sends, receives or forwards and every
+state transition, to see the message flow of a run afterwards. Recording a record is a struct.pack_into into a ring
+buffer under a lock, a flusher thread writes the ring to the file, so the nodes never wait for the disk. When the ring
+is full the new records are dropped and counted.
+The file starts with MAGIC, followed by records of RECORD.size bytes:
+  kind, node, peer, name, resource, time (ns), clock, timestamp
+The node, peer, name (message type or state) and resource are indexes in the names of the trace, 0 is none. A name
+is defined by a NAME record before its first use: the kind, the index and up to NAME_SIZE bytes of utf-8. The clock
+is the Lamport clock of the node after the event, the timestamp that of the message (the request timestamp for a
+state).
+The analysis (python tracing.py analyze) reads the traces through mmap and streams over the records, the memory it
+needs does not grow with the size of the traces. Traces of several processes are merged by time, their clocks
+must be in sync for the times between the processes to mean something.
+"""
+
+MAGIC = b"MXTRACE2"
+
+SEND = 1
+RECEIVE = 2
+FORWARD = 3
+STATE = 4
+NAME = 5
+
+KINDS = {SEND: "send", RECEIVE: "receive", FORWARD: "forward", STATE: "state"}
+
+# The names are indexed with 32 bits, a trace may define as many names as the nodes can hold in memory
+RECORD = struct.Struct("<B3xIIIIqqq")
+NAME_RECORD = struct.Struct("<B3xI36s")
+NAME_SIZE = 36
+
+# Records in the ring buffer, and the seconds between two flushes when the ring does not fill up
+RING_CAPACITY = 65536
+FLUSH_INTERVAL = 0.5
+
+# Examples of every kind of violation that are reported by the analysis
+MAX_EXAMPLES = 10
+
+
+class TraceRecorder:
+    """Records the events of one or more nodes to a trace file, see Node.enable_trace. The file is overwritten.
+        path: The file of the trace.
+        capacity: Records in the ring buffer.
+        flush_interval: Seconds between two flushes of the ring."""
+
+    def __init__(self, path, capacity=RING_CAPACITY, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+        # The ring of records, head counts the records recorded and tail those written to the file. The slots from
+        # tail to head are only touched by the flusher.
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.head = 0
+        self.tail = 0
+        self.lock = threading.Lock()
+
+        # Index of every name that has been defined in the trace
+        self.names = {None: 0}
+
+        # Records recorded and dropped, flushes and bytes written
+        self.stats = {"records": 0, "dropped": 0, "flushes": 0, "bytes": 0}
+
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.closed = False
+        self.wakeup = threading.Event()
+        self.flusher = threading.Thread(target=self.run_flusher, daemon=True)
+        self.flusher.start()
+
+    def record(self, kind, node, peer, name, resource, time, clock, timestamp):
+        """Record an event, the names are str or None. Returns False when the ring is full and the event is
+           dropped."""
+        names = self.names
+        with self.lock:
+            if node not in names or peer not in names or name not in names or resource not in names:
+                if not self.define_names((node, peer, name, resource)):
+                    self.stats["dropped"] += 1
+                    return False
+
+            if self.head - self.tail >= self.capacity or self.closed:
+                self.stats["dropped"] += 1
+                return False
+
+            RECORD.pack_into(self.buffer, self.head % self.capacity * RECORD.size, kind, names[node], names[peer],
+                             names[name], names[resource], int(time * 1e9), clock, timestamp or 0)
+            self.head += 1
+            self.stats["records"] += 1
+            if self.head - self.tail >= self.capacity // 2:
+                self.wakeup.set()
+        return True
+
+    def define_names(self, values):
+        """Record a NAME record for every value that has no index yet, invoked with the lock held. Returns False
+           when the ring has no room for them and the record that uses them."""
+        new_names = [value for value in dict.fromkeys(values) if value not in self.names]
+        if self.head - self.tail + len(new_names) >= self.capacity or self.closed:
+            return False
+
+        for value in new_names:
+            self.names[value] = len(self.names)
+            NAME_RECORD.pack_into(self.buffer, self.head % self.capacity * RECORD.size, NAME, self.names[value],
+                                  str(value).encode("utf-8")[:NAME_SIZE])
+            self.head += 1
+        return True
+
+    def message(self, kind, node, peer, data, time):
+        """Record a message of the mutual exclusion that node sends to, receives from or forwards to peer."""
+        if isinstance(data, dict):
+            self.record(kind, node.id, peer, data.get("message"), data.get("resource"), time, node.timestamp,
+                        data.get("timestamp"))
+
+    def state(self, node, state, resource, request_timestamp, time):
+        """Record a state transition of the node, or of a named resource of its lock table."""
+        self.record(STATE, node.id, None, state, resource, time, node.timestamp, request_timestamp)
+
+    def run_flusher(self):
+        """The main loop of the flusher thread, it flushes when the ring is half full or the interval has passed."""
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write the records from tail to head to the file. The recording goes on meanwhile."""
+        with self.lock:
+            (tail, head) = (self.tail, self.head)
+        if tail == head:
+            return
+
+        view = memoryview(self.buffer)
+        start = tail % self.capacity * RECORD.size
+        end = head % self.capacity * RECORD.size
+        if start < end:
+            self.file.write(view[start:end])
+        else:
+            self.file.write(view[start:])
+            self.file.write(view[:end])
+        self.file.flush()
+
+        with self.lock:
+            self.tail = head
+            self.stats["flushes"] += 1
+            self.stats["bytes"] += (head - tail) * RECORD.size
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        """Write the remaining records and close the file, later events are dropped."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.wakeup.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
+
+
+def process_trace(directory):
+    """Returns a recorder for the nodes of this process, its trace is named after the process id in the directory.
+       The traces of all the processes of a run are analyzed together."""
+    return TraceRecorder(os.path.join(directory, "%d.trace" % os.getpid()))
+
+
+def read_trace(path):
+    """Yields the events of a trace file as (time, kind, node, peer, name, resource, clock, timestamp) with the time
+       in seconds and the names as str (or None). A last record that has not been written completely is ignored."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Not a trace file: " + str(path))
+        if f.seek(0, 2) == len(MAGIC):
+            return
+
+        # The records are unpacked from a view of the mapped file, nothing is copied. The mapping is closed when
+        # it is garbage collected, the generator may be left before the end.
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            # Read ahead, the pages that have been read may be dropped
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+    records = (len(mapped) - len(MAGIC)) // RECORD.size
+    names = [None]
+    offset = len(MAGIC)
+    for (kind, node, peer, name, resource, time, clock, timestamp) in RECORD.iter_unpack(
+            memoryview(mapped)[len(MAGIC):len(MAGIC) + records * RECORD.size]):
+        if kind == NAME:
+            (kind, index, value) = NAME_RECORD.unpack_from(mapped, offset)
+            names.append(value.rstrip(b"\0").decode("utf-8", "replace"))
+        else:
+            yield (time / 1e9, kind, names[node], names[peer], names[name], names[resource], clock, timestamp)
+        offset += RECORD.size
+
+
+def read_traces(paths):
+    """Yields the events of all the trace files merged by time."""
+    return heapq.merge(*[read_trace(path) for path in paths], key=lambda event: event[0])
+
+
+def counts(values):
+    """Returns the snapshot of a Counter of whole numbers, like Histogram.snapshot but with exact percentiles. The
+       numbers are few different values, messages and hops, so the counter stays small."""
+    total = sum(values.values())
+    if total == 0:
+        return {"count": 0}
+
+    ordered = sorted(values.items())
+
+    def percentile(p):
+        seen = 0
+        for (value, count) in ordered:
+            seen += count
+            if seen >= p / 100.0 * total:
+                return value
+        return ordered[-1][0]
+
+    return {
+        "count": total,
+        "mean": sum(value * count for (value, count) in ordered) / total,
+        "min": ordered[0][0],
+        "max": ordered[-1][0],
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99)
+    }
+
+
+def ms(snapshot):
+    """Returns the snapshot of a Histogram of seconds in milliseconds."""
+    return {key: value * 1000 if key != "count" else value for (key, value) in snapshot.items()}
+
+
+def analyze(paths):
+    """Replay the traces and return:
+         rounds: the messages send per critical section entry (a round ends when a node becomes HELD), per election
+                 (the critical section of the nodes or a named resource), in total and per message type.
+         wanted: the time spend in WANTED, the request to grant latency, of all the nodes and per node.
+         critical_path: per entry, the chain of messages that lead to the grant, from the state transition that
+                        started it (usually the release of the previous holder) to HELD. Hops are the messages of the
+                        chain, network the time they were in transit, the rest is processing at the nodes.
+         lamport: events that break the order of the Lamport clocks, the clock of a node that goes back and a receive
+                  that leaves the clock behind the timestamp of the message. Receives of messages that are not
+                  send in the traces are counted apart, they are expected when not all the traces are analyzed.
+       A message is matched with its send by the sender, receiver, type, resource and timestamp."""
+    events = 0
+    kinds = collections.Counter()
+
+    round_messages = collections.defaultdict(collections.Counter)
+    rounds = collections.Counter()
+    by_type = collections.Counter()
+
+    wanted_since = {}
+    wanted = Histogram()
+    wanted_per_node = collections.defaultdict(Histogram)
+
+    # The chain that lead to the last event of every node as (started, hops, network), and the messages in flight
+    # with the chain of their send and the time they were send
+    causes = {}
+    in_flight = collections.defaultdict(collections.deque)
+    hops = collections.Counter()
+    path_time = Histogram()
+    network_time = Histogram()
+    slowest = None
+
+    clocks = {}
+    violations = collections.Counter()
+    examples = []
+    unmatched = 0
+
+    def violation(kind, time, node, description):
+        violations[kind] += 1
+        if len(examples) < MAX_EXAMPLES:
+            examples.append({"kind": kind, "time": time, "node": node, "event": description})
+
+    for (time, kind, node, peer, name, resource, clock, timestamp) in read_traces(paths):
+        events += 1
+        kinds[KINDS.get(kind, kind)] += 1
+
+        # The messages are forwarded by the connections, the clock they see may be older than that of the last
+        # event of the node
+        if kind != FORWARD:
+            if node in clocks and clock < clocks[node]:
+                violation("clock_went_back", time, node, "%s %s, clock %d after %d" % (KINDS.get(kind), name, clock,
+                                                                                      clocks[node]))
+            clocks[node] = max(clock, clocks.get(node, clock))
+
+        if kind == SEND or kind == FORWARD:
+            round_messages[resource]["ROUTE" if kind == FORWARD else name] += 1
+            if kind == SEND:
+                (started, chain_hops, network) = causes.get(node, (time, 0, 0.0))
+                in_flight[(node, peer, name, resource, timestamp)].append((started, chain_hops, network, time))
+
+        elif kind == RECEIVE:
+            if clock < timestamp:
+                violation("receive_behind_message", time, node, "%s from %s with timestamp %d, clock %d" % (
+                    name, peer, timestamp, clock))
+
+            key = (peer, node, name, resource, timestamp)
+            if in_flight.get(key):
+                (started, chain_hops, network, sent) = in_flight[key].popleft()
+                if not in_flight[key]:
+                    del in_flight[key]
+                causes[node] = (started, chain_hops + 1, network + max(time - sent, 0.0))
+            else:
+                unmatched += 1
+                causes[node] = (time, 0, 0.0)
+
+        elif kind == STATE:
+            election = (node, resource)
+            if name == "WANTED":
+                wanted_since[election] = time
+            elif name == "HELD":
+                if election in wanted_since:
+                    waited = time - wanted_since.pop(election)
+                    wanted.record(waited)
+                    wanted_per_node[node].record(waited)
+
+                messages = round_messages.pop(resource, collections.Counter())
+                rounds[sum(messages.values())] += 1
+                by_type.update(messages)
+
+                (started, chain_hops, network) = causes.get(node, (time, 0, 0.0))
+                hops[chain_hops] += 1
+                path_time.record(time - started)
+                network_time.record(network)
+                if slowest is None or time - started > slowest["seconds"]:
+                    slowest = {"node": node, "resource": resource, "time": time, "seconds": time - started,
+                               "hops": chain_hops}
+
+            # The next messages of the node are caused by this transition
+            causes[node] = (time, 0, 0.0)
+
+    return {
+        "events": events,
+        "kinds": dict(kinds),
+        "rounds": {
+            "messages_per_round": counts(rounds),
+            "messages_per_round_by_type": {message: count / sum(rounds.values()) for (message, count) in
+                                           sorted(by_type.items())}
+        },
+        "wanted_ms": dict(ms(wanted.snapshot()),
+                          per_node={node: ms(histogram.snapshot()) for (node, histogram) in
+                                    sorted(wanted_per_node.items())}),
+        "critical_path": {
+            "hops": counts(hops),
+            "duration_ms": ms(path_time.snapshot()),
+            "network_ms": ms(network_time.snapshot()),
+            "slowest": slowest
+        },
+        "lamport": {
+            "violations": sum(violations.values()),
+            "by_kind": dict(violations),
+            "examples": examples,
+            "unmatched_receives": unmatched,
+            "unreceived_messages": sum(len(messages) for messages in in_flight.values())
+        }
+    }
+
+
+def dump(paths, limit=None):
+    """Print the events of the traces as text, merged by time."""
+    for (i, (time, kind, node, peer, name, resource, clock, timestamp)) in enumerate(read_traces(paths)):
+        if limit is not None and i >= limit:
+            break
+        print("%.6f %-3s %-7s %-3s %-13s %s clock %d timestamp %d" % (
+            time, node, KINDS.get(kind, kind), peer or "", name, "[" + resource + "]" if resource else "", clock,
+            timestamp))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline analysis of the protocol traces of the nodes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_analyze = subparsers.add_parser("analyze", help="messages per round, critical paths, Lamport order and "
+                                                           "time spend in WANTED, as json")
+    parser_analyze.add_argument("traces", nargs="+", help="trace files, merged by time")
+    parser_analyze.add_argument("--output", help="write the results to this file instead of stdout")
+
+    parser_dump = subparsers.add_parser("dump", help="print the events as text")
+    parser_dump.add_argument("traces", nargs="+", help="trace files, merged by time")
+    parser_dump.add_argument("--limit", type=int, help="print at most this many events")
+
+    args = parser.parse_args()
+    if args.command == "analyze":
+        results = analyze(args.traces)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+    elif args.command == "dump":
+        dump(args.traces, args.limit)
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+
+"""
+Write-ahead log of the election state of a node, so that a node that crashed can rejoin the mutual exclusion. Every
+record is a line of json, appended before the node acts on it:
+  state: the node has moved to a new state, DO-NOT-WANT also means that all the deferred requests have been answered.
+  defer: the request of a node has been deferred, the requester waits for our OK.
+  clock: the Lamport timestamp may have reached this value. It is logged ahead in leases of CLOCK_LEASE, so the clock
+         is only logged once every CLOCK_LEASE ticks and a recovered node never reuses a timestamp it has send.
+  snapshot: the complete state, written by the compaction that replaces the log once it has grown.
+A recovered node starts in DO-NOT-WANT, whatever state it crashed in, and answers the requests it had deferred when
+it is connected with the other nodes again. This is only safe when the OK messages are checked against the request
+they answer, like Ricart-Agrawala does (see mutex.py). The other algorithms keep state the log does not cover, like
+the votes of Maekawa and the token of Suzuki-Kasami.
+The sync policy decides when the log is forced to disk with fsync:
+  always: after every record, no record is lost when the machine crashes.
+  batch: after every BATCH_SIZE records and on close, a crash of the process loses nothing, a crash of the machine
+         the last records.
+  none: only on close.
+"""
+
+SYNC_ALWAYS = "always"
+SYNC_BATCH = "batch"
+SYNC_NONE = "none"
+SYNC_POLICIES = (SYNC_ALWAYS, SYNC_BATCH, SYNC_NONE)
+
+CLOCK_LEASE = 1024
+BATCH_SIZE = 64
+
+# The log is compacted into one snapshot record after this many records
+COMPACT_AFTER = 10000
+
+
+def initial_state():
+    return {"state": "DO-NOT-WANT", "request_timestamp": None, "clock": 0, "deferred": []}
+
+
+def apply_record(state, record):
+    """Apply a record of the log to the state, see initial_state."""
+    record_type = record.get("type")
+    if record_type == "snapshot":
+        state.update(record["snapshot"])
+    elif record_type == "state":
+        state["state"] = record["state"]
+        state["request_timestamp"] = record.get("request_timestamp")
+        if record["state"] == "DO-NOT-WANT":
+            state["deferred"] = []
+    elif record_type == "defer":
+        state["deferred"].append([record["id"], record["timestamp"]])
+    elif record_type == "clock":
+        state["clock"] = max(state["clock"], record["timestamp"])
+
+
+class WriteAheadLog:
+    """Append only log of the election state of a node. The log keeps the state it describes up to date, so it can
+       be compacted without asking the node.
+        path: The file of the log.
+        sync: The sync policy, see SYNC_POLICIES.
+        batch_size: Records between two syncs with the batch policy.
+        compact_after: Records after which the log is compacted."""
+
+    def __init__(self, path, sync=SYNC_BATCH, batch_size=BATCH_SIZE, compact_after=COMPACT_AFTER):
+        if sync not in SYNC_POLICIES:
+            raise ValueError("Unknown sync policy: " + str(sync))
+
+        self.path = path
+        self.sync = sync
+        self.batch_size = batch_size
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+
+        self.state = initial_state()
+        self.file = None
+        self.records = 0  # Records in the file
+        self.unsynced = 0
+
+        # Records and bytes appended, fsyncs and compactions done and the seconds spend doing it
+        self.stats = {"records": 0, "bytes": 0, "syncs": 0, "compactions": 0, "seconds": 0.0}
+
+    def recover(self):
+        """Read the log and open it for appending. Returns the recovered state, or None when the log is empty. A
+           last record that is incomplete, because the process died while writing it, is ignored."""
+        recovered = False
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        apply_record(self.state, json.loads(line))
+                    except ValueError:
+                        break
+                    self.records += 1
+                    recovered = True
+
+        # Rewrite the log, this also drops an incomplete last record
+        self.compact()
+        return dict(self.state, deferred=list(self.state["deferred"])) if recovered else None
+
+    def append(self, record):
+        """Apply the record to the state and append it to the log."""
+        started = time.perf_counter()
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.lock:
+            apply_record(self.state, record)
+            self.file.write(line)
+            self.records += 1
+            self.unsynced += 1
+            self.stats["records"] += 1
+            self.stats["bytes"] += len(line)
+
+            if self.sync == SYNC_ALWAYS or (self.sync == SYNC_BATCH and self.unsynced >= self.batch_size):
+                self.flush()
+
+            if self.records >= self.compact_after:
+                self.compact()
+
+            self.stats["seconds"] += time.perf_counter() - started
+
+    def flush(self):
+        """Force the appended records to disk, invoked with the lock held."""
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.stats["syncs"] += 1
+
+    def compact(self):
+        """Replace the log with a single snapshot of the state. The snapshot is written to a new file that replaces
+           the log atomically, a crash during the compaction leaves the old log."""
+        if self.file is not None:
+            self.file.close()
+
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write((json.dumps({"type": "snapshot", "snapshot": self.state}, separators=(",", ":")) + "\n")
+                    .encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+        # Unbuffered, every record is written to the file at once
+        self.file = open(self.path, "ab", buffering=0)
+        self.records = 1
+        self.unsynced = 0
+        self.stats["compactions"] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                if self.sync != SYNC_ALWAYS:
+                    self.flush()
+                self.file.close()
+                self.file = None